@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the dataset scripts on a synthetic SPL dataset.
+
+Every case runs in a fresh process, so its peak memory is measured on its own:
+the peak RSS of the case process or of its largest worker process, whichever is
+higher (not their sum). The throughput in files/s and MB/s
+of the fastest repetition is reported, written to a JSON file and, if a baseline
+JSON is given, compared against it. A throughput drop or memory increase beyond
+the tolerance is reported as a regression and makes the script exit with 1.
+
+Everything runs offline on the CPU. The augment case needs torch and
+torchvision, it is reported as failed when those are missing.
+
+Usage: benchmark.py [--images int] [--size WxH] [--workers int] [--repeat int] [--cases str [str... ]]
+                    [--dataset ./path] [--output results.json] [--baseline baseline.json] [--tolerance float]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic_dataset import generate_dataset, parse_size
+
+SCRIPTS_DIR = str(Path(__file__).resolve().parents[1] / 'scripts')
+
+
+def _folder_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def _images(dataset):
+    folder = os.path.join(dataset, 'images')
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.jpg')]
+
+
+def bench_convert(dataset, workers):
+    from convert_dataset_annotations import convert_files
+
+    # converting a copy, the converter writes the label files next to the XML files
+    work_dir = os.path.join(dataset, 'bench_xml')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    shutil.copytree(os.path.join(dataset, 'xml'), work_dir)
+    paths = sorted(str(path) for path in Path(work_dir).glob('*.xml'))
+    total_bytes = _folder_bytes(paths)
+
+    start = time.perf_counter()
+    convert_files(paths, workers=workers, quiet=True)
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(work_dir)
+    return {'seconds': seconds, 'files': len(paths), 'bytes': total_bytes}
+
+
+def bench_augment(dataset, workers):
+    from data_augmentor import Image_Augmentor
+
+    images = _images(dataset)
+    augmentor = Image_Augmentor(dataset)
+
+    start = time.perf_counter()
+    augmentor.apply_augmentations(['colorjitter', 'gaussian_blur'], prefix='bench', ratio=1.0, workers=workers)
+    seconds = time.perf_counter() - start
+
+    for folder in ('images', 'labels'):
+        shutil.rmtree(os.path.join(dataset, folder, 'bench'))
+    return {'seconds': seconds, 'files': len(images), 'bytes': _folder_bytes(images)}
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _split_copy(dataset):
+    # splitting a linked copy, the splitter writes the .txt files into the dataset, which may be a real one
+    work_dir = os.path.join(dataset, 'bench_split')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for folder in ('images', 'labels'):
+        shutil.copytree(os.path.join(dataset, folder), os.path.join(work_dir, folder), copy_function=_link_or_copy)
+    return work_dir
+
+
+def bench_split_random(dataset, workers):
+    from data_splitter import split_image_names, write_txt_files
+
+    work_dir = _split_copy(dataset)
+    start = time.perf_counter()
+    for name, split in zip(['train', 'val', 'test'], split_image_names(work_dir, [70, 20, 10])):
+        write_txt_files(work_dir, name, split)
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(work_dir)
+    return {'seconds': seconds, 'files': len(_images(dataset)), 'bytes': None}
+
+
+def bench_split_hash(dataset, workers):
+    from data_splitter import stream_split
+
+    work_dir = _split_copy(dataset)
+    start = time.perf_counter()
+    stream_split(work_dir, [70, 20, 10])
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(work_dir)
+    return {'seconds': seconds, 'files': len(_images(dataset)), 'bytes': None}
+
+
+def bench_filter(dataset, workers):
+    from filter_dataset import Label_Filter, filter_dataset
+
+    destination = os.path.join(dataset, 'bench_filtered')
+    shutil.rmtree(destination, ignore_errors=True)
+    images = _images(dataset)
+
+    start = time.perf_counter()
+    filter_dataset(dataset, destination, Label_Filter(keep=[0, 1]), workers=workers)
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(destination)
+    return {'seconds': seconds, 'files': len(images), 'bytes': _folder_bytes(images)}
+
+
+CASES = {
+    'convert': bench_convert,
+    'augment': bench_augment,
+    'split_random': bench_split_random,
+    'split_hash': bench_split_hash,
+    'filter': bench_filter,
+}
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory in MB of this process or of its largest (waited for) child process,
+    whichever is higher.
+
+    ru_maxrss of RUSAGE_CHILDREN is the peak of the single largest child, so the memory of several
+    workers running at the same time is not added up.
+    """
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale / 1e6
+
+
+def _run_case(name, dataset, workers, queue):
+    sys.path.insert(0, SCRIPTS_DIR)
+    try:
+        result = CASES[name](dataset, workers)
+        result['peak_rss_mb'] = peak_rss_mb()
+    except BaseException as e:
+        # the scripts exit on missing dependencies, which is reported instead of aborting the suite
+        result = {'error': f'{type(e).__name__}: {e}'}
+    queue.put(result)
+
+
+def run_case(name, dataset, workers, repeat):
+    """
+    Runs a case `repeat` times, each in a fresh process, and returns the fastest repetition.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=_run_case, args=(name, dataset, workers, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+
+        if 'error' in result:
+            return result
+        results.append(result)
+
+    best = min(results, key=lambda result: result['seconds'])
+    best['peak_rss_mb'] = max(result['peak_rss_mb'] for result in results)
+    best['files_per_s'] = best['files'] / best['seconds']
+    best['mb_per_s'] = best['bytes'] / 1e6 / best['seconds'] if best['bytes'] else None
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the results against a baseline and returns the list of regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None or 'error' in result or 'error' in reference:
+            continue
+
+        speed = result['files_per_s'] / reference['files_per_s']
+        memory = result['peak_rss_mb'] / reference['peak_rss_mb']
+        print(f"{name:>14} throughput x{speed:.2f}, peak memory x{memory:.2f} of the baseline")
+        if speed < 1 - tolerance:
+            regressions.append(f"{name}: throughput dropped to {speed:.0%} of the baseline")
+        if memory > 1 + tolerance:
+            regressions.append(f"{name}: peak memory grew to {memory:.0%} of the baseline")
+    return regressions
+
+
+def main(args):
+    dataset = args.dataset or tempfile.mkdtemp(prefix='dnt_benchmark_')
+    if not os.path.exists(os.path.join(dataset, 'images')):
+        print(f"Generating {args.images} synthetic images in {dataset}")
+        generate_dataset(dataset, args.images, args.size)
+
+    results = {}
+    print(f"{'Case':>14} {'Seconds':>9} {'Files/s':>10} {'MB/s':>8} {'Peak MB':>9}")
+    for name in args.cases:
+        result = results[name] = run_case(name, dataset, args.workers, args.repeat)
+        if 'error' in result:
+            print(f"{name:>14} failed: {result['error']}")
+            continue
+        mb_per_s = f"{result['mb_per_s']:>8.1f}" if result['mb_per_s'] else f"{'-':>8}"
+        print(f"{name:>14} {result['seconds']:>9.3f} {result['files_per_s']:>10.1f} {mb_per_s} "
+              f"{result['peak_rss_mb']:>9.1f}")
+
+    if not args.dataset:
+        shutil.rmtree(dataset)
+
+    report = {
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpu_count': os.cpu_count()},
+        'config': {'images': args.images, 'size': list(args.size), 'workers': args.workers, 'repeat': args.repeat},
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('config') != report['config']:
+            print("Warning: the baseline was measured with a different configuration")
+
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=200,
+                        help="the number of synthetic images to generate (default: 200)")
+    parser.add_argument('--size', type=parse_size, default=(640, 480),
+                        help="the synthetic image size as WIDTHxHEIGHT (default: 640x480)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of worker processes passed to the scripts (default: 1)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="the number of repetitions per case, the fastest is reported (default: 3)")
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES),
+                        help="the cases to run (default: all)")
+    parser.add_argument('--dataset', type=Path,
+                        help="an existing (synthetic) dataset to use, or the folder to generate it in "
+                             "(default: a temporary folder which is removed afterwards)")
+    parser.add_argument('--output', type=Path, default='benchmark_results.json',
+                        help="the JSON file the results are written to (default: benchmark_results.json)")
+    parser.add_argument('--baseline', type=Path,
+                        help="a results JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="the relative throughput drop or memory increase reported as a regression (default: 0.2)")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Checks the startup time of the dnt command and its subcommands against a budget.
+
+Every command runs `dnt [COMMAND] --help` in a fresh interpreter, the fastest of
+--repeat runs is its startup time. The heavy modules which were imported on the
+way are reported as well: none of them is needed to parse arguments, so a tool
+which imports torch, torchvision or ultralytics before parsing its arguments
+shows up here even on a machine which is fast enough to stay within the budget.
+A command which is slower than the budget or imports a heavy module is reported
+as a regression and makes the script exit with 1.
+
+Usage: startup_time.py [--budget float] [--repeat int] [--commands str [str... ]] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = str(Path(__file__).resolve().parents[1])
+sys.path.insert(0, ROOT_DIR)
+
+from dnt.cli import COMMANDS
+
+HEAVY_MODULES = ('torch', 'torchvision', 'ultralytics', 'onnx', 'onnxruntime')
+
+# runs the command in the fresh interpreter and prints the heavy modules it imported, instead of its help
+PROBE = f'''
+import contextlib, io, json, sys
+sys.path.insert(0, {ROOT_DIR!r})
+from dnt.cli import main
+with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+    try:
+        main(sys.argv[1:])
+    except SystemExit:
+        pass
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+'''
+
+
+def measure_command(command, repeat):
+    """
+    Runs `dnt [command] --help` `repeat` times and returns the fastest wall time and the heavy modules imported.
+    """
+    arguments = [command, '--help'] if command else ['--help']
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', PROBE, *arguments], capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            return {'error': process.stderr.strip().splitlines()[-1]}
+    return {'seconds': min(times), 'heavy_modules': json.loads(process.stdout)}
+
+
+def main(args):
+    results, regressions = {}, []
+    print(f"{'Command':>12} {'Seconds':>9}  Heavy modules")
+    for command in args.commands:
+        name = command or 'dnt'
+        result = results[name] = measure_command(command, args.repeat)
+        if 'error' in result:
+            print(f"{name:>12} failed: {result['error']}")
+            regressions.append(f"{name}: failed")
+            continue
+
+        print(f"{name:>12} {result['seconds']:>9.3f}  {', '.join(result['heavy_modules']) or '-'}")
+        if result['seconds'] > args.budget:
+            regressions.append(f"{name}: starts in {result['seconds']:.2f}s, the budget is {args.budget}s")
+        if result['heavy_modules']:
+            regressions.append(f"{name}: imports {', '.join(result['heavy_modules'])} before parsing its arguments")
+
+    report = {
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpu_count': os.cpu_count()},
+        'config': {'budget': args.budget, 'repeat': args.repeat},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help="the maximum startup time of a command in seconds (default: 0.5)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="the number of runs per command, the fastest is reported (default: 3)")
+    parser.add_argument('--commands', nargs='+', choices=list(COMMANDS), default=[''] + list(COMMANDS),
+                        help="the commands to check (default: dnt itself and all commands)")
+    parser.add_argument('--output', type=Path,
+                        help="a JSON file to write the results to")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Generates a synthetic SPL dataset for benchmarking the scripts offline.
+
+Creates random images with YOLO labels in the layout of config/train_*.yaml
+(images/ and labels/ folders) and a matching Dataset_maker_faire style VOC XML
+annotation for every image in an xml/ folder. The dataset only depends on the
+seed, so benchmark runs on different machines use identical data.
+
+Usage: synthetic_dataset.py DESTINATION [--images int] [--size WxH] [--max-objects int] [--seed int]
+"""
+
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# same classes as config/train_*.yaml, with their Dataset_maker_faire names
+CLASS_NAMES = ['ball', 'robot', 'goalpost', 'goalspot']
+
+
+def voc_xml(filename, width, height, objects):
+    """
+    Formats the objects, as (class id, xmin, ymin, xmax, ymax) tuples, as a VOC XML annotation.
+    """
+    parts = [f'<annotation><filename>{filename}</filename>'
+             f'<size><width>{width}</width><height>{height}</height><depth>3</depth></size>']
+    for class_id, xmin, ymin, xmax, ymax in objects:
+        parts.append(f'<object><name>{CLASS_NAMES[class_id]}</name><bndbox><xmin>{xmin}</xmin><ymin>{ymin}</ymin>'
+                     f'<xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox></object>')
+    parts.append('</annotation>\n')
+    return '\n'.join(parts)
+
+
+def generate_dataset(destination, images=100, size=(640, 480), max_objects=5, seed=0):
+    """
+    Generates the synthetic dataset and returns the number of bytes written.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    for folder in ('images', 'labels', 'xml'):
+        os.makedirs(os.path.join(destination, folder), exist_ok=True)
+
+    # blurred noise compresses more like a camera frame than pure noise does
+    base = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+
+    total_bytes = 0
+    for index in range(images):
+        name = f'frame_{index:07d}'
+        noise = rng.integers(-24, 24, (height // 8, width // 8, 3))
+        small = np.clip(base.astype(np.int64) + noise, 0, 255).astype(np.uint8)
+        image_path = os.path.join(destination, 'images', name + '.jpg')
+        Image.fromarray(small).resize((width, height), Image.BILINEAR).save(image_path, quality=90)
+
+        count = int(rng.integers(1, max_objects + 1))
+        class_ids = rng.integers(0, len(CLASS_NAMES), count)
+        box_sizes = rng.integers(8, np.array([width, height]) // 3, (count, 2))
+        corners = rng.integers(0, np.array([width, height]) - box_sizes, (count, 2))
+        objects = [(int(c), int(x), int(y), int(x + w), int(y + h))
+                   for c, (x, y), (w, h) in zip(class_ids, corners, box_sizes)]
+
+        with open(os.path.join(destination, 'labels', name + '.txt'), 'w') as file:
+            file.write(''.join(f'{c} {(x1 + x2) / 2 / width:.8f} {(y1 + y2) / 2 / height:.8f} '
+                               f'{(x2 - x1) / width:.8f} {(y2 - y1) / height:.8f}\n'
+                               for c, x1, y1, x2, y2 in objects))
+        with open(os.path.join(destination, 'xml', name + '.xml'), 'w') as file:
+            file.write(voc_xml(name + '.jpg', width, height, objects))
+
+        total_bytes += os.path.getsize(image_path)
+
+    return total_bytes
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('destination', type=Path,
+                        help="the folder in which the images, labels and xml folders are created")
+    parser.add_argument('--images', type=int, default=100,
+                        help="the number of images to generate (default: 100)")
+    parser.add_argument('--size', type=parse_size, default=(640, 480),
+                        help="the image size as WIDTHxHEIGHT (default: 640x480)")
+    parser.add_argument('--max-objects', type=int, default=5,
+                        help="the maximum number of objects per image (default: 5)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the seed of the generated data (default: 0)")
+    args = parser.parse_args()
+
+    total_bytes = generate_dataset(args.destination, args.images, args.size, args.max_objects, args.seed)
+    print(f"Generated {args.images} images ({total_bytes / 1e6:.1f} MB) in {args.destination}")
@@ -0,0 +1,6 @@
+"""
+The dnt command, a single entry point to the dataset, training and inference
+tools of this repository. See dnt/cli.py.
+"""
+
+__version__ = '0.1.0'
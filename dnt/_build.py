@@ -0,0 +1,14 @@
+"""
+The build backend of the dnt package: setuptools, refusing to build regular wheels.
+
+dnt runs the scripts of the checkout it is installed from, a regular install only
+copies the dnt package and can't find them. Editable installs (pip3 install -e .)
+are built by setuptools as usual.
+"""
+
+from setuptools.build_meta import *  # noqa: F401,F403
+
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    raise RuntimeError("dnt runs the scripts of the repository checkout, so it can only be installed editable: "
+                       "pip3 install -e .")
@@ -0,0 +1,93 @@
+"""
+Runs the tools of this repository as subcommands of a single `dnt` command.
+
+`dnt COMMAND [arguments]` runs the script of COMMAND with the arguments, exactly
+as running the script itself does, so `dnt split --sourcepath datasets/custom/`
+equals `./scripts/data_splitter.py --sourcepath datasets/custom/`. Only the
+standard library is imported here and no script is loaded before it is needed.
+The scripts import torch, torchvision and ultralytics only after their arguments
+are parsed, so `dnt --help`, `dnt COMMAND --help` and invalid arguments return
+without waiting seconds for those imports. benchmarks/startup_time.py checks this.
+
+The scripts are run from the repository, which holds the configs and datasets
+they use, so install the package editable: `pip3 install -e .`
+
+Usage: dnt COMMAND [arguments]
+"""
+
+import argparse
+import os
+import runpy
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# the script of every subcommand, relative to the repository, and its description
+COMMANDS = {
+    'convert': ('scripts/convert_dataset_annotations.py', 'convert Dataset_maker_faire XML annotations to YOLO labels'),
+    'filter': ('scripts/filter_dataset.py', 'filter the labels of a dataset by class and box size'),
+    'filter-mf': ('scripts/filter_mf_files.py', 'keep only the ball and robot labels of the Dataset_maker_faire'),
+    'split': ('scripts/data_splitter.py', 'split a dataset into train.txt, val.txt and test.txt'),
+    'augment': ('scripts/data_augmentor.py', 'write augmented copies of a ratio of the images of a dataset'),
+    'pipeline': ('scripts/pipeline.py', 'build a dataset with the stages of a pipeline YAML, re-running what changed'),
+    'validate': ('scripts/validate_dataset.py', 'check a dataset for corrupt images, bad labels and orphans'),
+    'dedup': ('scripts/dedup_dataset.py', 'group or prune near-duplicate images'),
+    'crop': ('scripts/crop_dataset.py', 'build a dataset of crops or tiles around the objects'),
+    'manifest': ('scripts/dataset_manifest.py', 'build and query the image manifest of a dataset'),
+    'labels': ('scripts/label_store.py', 'build and query the packed label store of a dataset'),
+    'cache': ('scripts/shard_cache.py', 'build the memory-mapped shard cache of the training images'),
+    'train': ('train.py', 'train a model'),
+    'sweep': ('sweep.py', 'run a sweep of training runs in parallel'),
+    'export': ('scripts/model_export.py', 'export weights to ONNX and INT8 and report their accuracy and latency'),
+    'evaluate': ('evaluate.py', 'evaluate a model on a split from cached predictions, sweeping thresholds'),
+    'predict': ('predict.py', 'run a model on images and videos'),
+}
+
+
+def parse_arguments(argv=None) -> argparse.Namespace:
+    """
+    Parse the command and return it together with the arguments for its script.
+    """
+    commands = '\n'.join(f'  {name:<10} {description}' for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog = 'dnt',
+        description = f'Dataset, training and inference tools of the DNT object detection.\n\ncommands:\n{commands}',
+        epilog = 'This program is used for the Leren & Beslissen course at the University of Amsterdam. '
+                 'Run dnt COMMAND --help for the arguments of a command.',
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('command',
+                        choices=COMMANDS,
+                        metavar='COMMAND',
+                        help='the command to run, see the list above')
+
+    parser.add_argument('arguments',
+                        nargs=argparse.REMAINDER,
+                        help='arguments passed to the command')
+
+    return parser.parse_args(argv)
+
+
+def run_command(command, arguments):
+    """
+    Runs the script of a command with the arguments as its command line, like `python script arguments` does.
+    """
+    script = os.path.join(ROOT_DIR, COMMANDS[command][0])
+    if not os.path.isfile(script):
+        print(f"\nError\n-----\n{script} not found, dnt runs the scripts of a checkout of the repository, "
+              f"install the repository editable with pip3 install -e .\n")
+        exit(1)
+
+    # the script sees the same sys.argv and sys.path as when it is run directly
+    sys.argv = [script, *arguments]
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name='__main__')
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    run_command(args.command, args.arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import cv2
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+
+import yaml
+
+from shard_cache import dataset_images
+from yolo_labels import label_path, read_labels, yolo_to_xyxy
+
+CACHE_VERSION = 1
+# the predictions are cached at the confidence threshold of ultralytics validation, higher ones are swept
+CACHE_CONF = 0.001
+# the IoU thresholds of mAP50-95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+def file_digest(path):
+    """
+    Returns the SHA-1 content hash of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(args, images):
+    """
+    Returns everything the cached predictions depend on: the weights, the inference settings and
+    the images, which are identified by their path, size and mtime.
+    """
+    digest = hashlib.sha1()
+    for image in images:
+        stat = os.stat(image)
+        digest.update(f'{image}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return {'version': CACHE_VERSION, 'weights': file_digest(args.weights), 'imgsz': args.imgsz,
+            'conf': CACHE_CONF, 'iou': args.nms_iou, 'max_det': args.max_det, 'images': digest.hexdigest()}
+
+def predict_images(args, images):
+    """
+    Runs the model once over the images with the pipeline of predict.py.
+
+    Returns the predictions as flat arrays: the detections of image i are the rows offsets[i]:offsets[i + 1]
+    of the xyxy pixel boxes, confidences and classes, sorted by decreasing confidence.
+    """
+    import predict
+
+    predict.import_inference()
+    model = predict.load_model(args.weights, args.device)
+    pipeline = predict.Pipeline(model, args.imgsz, args.batch_size, args.threads, CACHE_CONF, args.nms_iou,
+                                args.max_det)
+
+    def frames():
+        for index, image in enumerate(images):
+            frame = cv2.imread(image)
+            if frame is None:
+                print(f'Skipping unreadable image: {image}')
+                continue
+            yield index, frame
+
+    shapes = np.zeros((len(images), 2), dtype=np.int32)
+    detections = [np.empty((0, 6), dtype=np.float32)] * len(images)
+    for index, shape, det in pipeline.run_frames(frames()):
+        shapes[index] = shape
+        detections[index] = det[np.argsort(-det[:, 4], kind='stable')]
+
+    det = np.concatenate(detections)
+    return {'images': np.array(images), 'shapes': shapes,
+            'offsets': np.concatenate([[0], np.cumsum([len(d) for d in detections])]).astype(np.int64),
+            'boxes': det[:, :4].astype(np.float32), 'conf': det[:, 4].astype(np.float32),
+            'cls': det[:, 5].astype(np.int16)}
+
+def load_predictions(args, images):
+    """
+    Returns the cached predictions of the images, running the model only if the cache is missing or
+    the weights, the inference settings or the images changed.
+    """
+    key = cache_key(args, images)
+    if os.path.exists(args.cache):
+        with np.load(args.cache) as data:
+            if json.loads(str(data['key'])) == key:
+                print(f'Using the cached predictions in {args.cache}')
+                return {name: data[name] for name in data.files if name != 'key'}
+
+    start = time.perf_counter()
+    predictions = predict_images(args, images)
+    # replacing the cache at once, so an interrupted run keeps the previous one
+    with open(args.cache + '.tmp', 'wb') as file:
+        np.savez_compressed(file, key=np.array(json.dumps(key)), **predictions)
+    os.replace(args.cache + '.tmp', args.cache)
+    print(f'Cached the predictions of {len(images)} images in {args.cache} ({time.perf_counter() - start:.1f}s)')
+    return predictions
+
+def load_labels(images, shapes):
+    """
+    Reads the labels of the images as flat arrays like the predictions: the xyxy pixel boxes, the classes
+    and the index of the image of every label. Unreadable images have no labels, like no predictions.
+    """
+    boxes, classes, indices = [], [], []
+    for index, (image, (height, width)) in enumerate(zip(images, shapes)):
+        path = label_path(str(image))
+        if not height or not os.path.exists(path):
+            continue
+        ids, yolo_boxes = read_labels(path)
+        boxes.append(yolo_to_xyxy(yolo_boxes, width, height).reshape(-1, 4))
+        classes.append(ids)
+        indices.append(np.full(len(ids), index))
+
+    counts = np.bincount(np.concatenate(indices or [np.empty(0, np.int64)]), minlength=len(images))
+    return {'boxes': np.concatenate(boxes or [np.empty((0, 4))]),
+            'cls': np.concatenate(classes or [np.empty(0, np.int64)]),
+            'image': np.concatenate(indices or [np.empty(0, np.int64)]),
+            'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)}
+
+def overlapping_pairs(predictions, labels):
+    """
+    Returns every overlapping pair of a prediction and a label of the same image as the arrays of the
+    prediction indices, the label indices and their IoU, computed for all images at once.
+    """
+    pred_counts, label_counts = np.diff(predictions['offsets']), np.diff(labels['offsets'])
+    counts = pred_counts * label_counts
+    image = np.repeat(np.arange(len(counts)), counts)
+    # the position of every pair within the pairs of its image
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pred = predictions['offsets'][image] + within // label_counts[image]
+    label = labels['offsets'][image] + within % label_counts[image]
+
+    a, b = predictions['boxes'][pred].astype(np.float64), labels['boxes'][label]
+    inter = np.prod(np.clip(np.minimum(a[:, 2:], b[:, 2:]) - np.maximum(a[:, :2], b[:, :2]), 0, None), axis=1)
+    iou = inter / (np.prod(a[:, 2:] - a[:, :2], axis=1) + np.prod(b[:, 2:] - b[:, :2], axis=1) - inter + 1e-7)
+    keep = iou > 0
+    return pred[keep], label[keep], iou[keep]
+
+def unique_matches(pred, label, iou):
+    """
+    Matches every prediction to its label of the highest IoU, then every label to the prediction of the
+    highest IoU among those, like the ultralytics confusion matrix does.
+    """
+    for by_label in (False, True):
+        order = np.argsort(-iou, kind='stable')
+        pred, label, iou = pred[order], label[order], iou[order]
+        first = np.unique(label if by_label else pred, return_index=True)[1]
+        pred, label, iou = pred[first], label[first], iou[first]
+    return pred, label
+
+def match_predictions(pairs, predictions, labels, thresholds):
+    """
+    Returns whether every prediction is a true positive at every IoU threshold, as a (predictions,
+    thresholds) bool array, matching like ultralytics validation does: in order of decreasing confidence,
+    every prediction takes the label of its class with the highest IoU which no earlier prediction took.
+
+    The r-th candidate of every image is matched in round r, for all images and thresholds at once.
+    A prediction is only matched by the predictions of higher confidence and of its class, so the result
+    holds for every confidence threshold and class subset.
+    """
+    pred, label, iou = pairs
+    keep = (predictions['cls'][pred] == labels['cls'][label])
+    # only the predictions which overlap a label of their class enough can be matched at all
+    keep &= np.isin(pred, pred[keep & (iou >= thresholds.min())])
+    pred, label, iou = pred[keep], label[keep], iou[keep]
+
+    # the rank of every candidate within its image, the predictions of an image are sorted by confidence
+    candidates = np.unique(pred)
+    image = np.searchsorted(predictions['offsets'], candidates, side='right') - 1
+    first = np.searchsorted(image, image)
+    rank = (np.arange(len(candidates)) - first)[np.searchsorted(candidates, pred)]
+
+    # the pairs of every round grouped by prediction, the labels of a prediction in index order
+    order = np.lexsort((label, pred, rank))
+    pred, label, iou, rank = pred[order], label[order], iou[order], rank[order]
+    bounds = np.searchsorted(rank, np.arange(rank.max() + 2 if len(rank) else 1))
+
+    tp = np.zeros((len(predictions['conf']), len(thresholds)), dtype=bool)
+    taken = np.zeros((len(labels['cls']), len(thresholds)), dtype=bool)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        round_pred, round_label = pred[start:end], label[start:end]
+        starts = np.flatnonzero(np.r_[True, round_pred[1:] != round_pred[:-1]])
+        available = np.where(taken[round_label], 0., iou[start:end, None])
+        best = np.maximum.reduceat(available, starts, axis=0)
+        correct = best >= thresholds
+
+        # the first label of the highest available IoU of every prediction and threshold
+        segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(round_pred)]))
+        rows = np.where(available == best[segment], np.arange(len(round_pred))[:, None], len(round_pred))
+        chosen = np.minimum.reduceat(rows, starts, axis=0)
+
+        segments, columns = np.nonzero(correct)
+        tp[round_pred[starts[segments]], columns] = True
+        taken[round_label[chosen[segments, columns]], columns] = True
+    return tp
+
+def average_precision(tpc, instances):
+    """
+    Returns the 101-point interpolated AP of every column of the cumulative true positives of a class,
+    by decreasing confidence, and the interpolated precision at the recall points of the first column.
+    """
+    recall = tpc / (instances + 1e-16)
+    precision = tpc / np.arange(1, len(tpc) + 1)[:, None]
+
+    # the precision drops to zero beyond the highest recall
+    columns = tpc.shape[1]
+    recall = np.vstack([np.zeros(columns), recall, recall[-1], np.ones(columns)])
+    precision = np.vstack([np.ones(columns), precision, np.zeros((2, columns))])
+    # the precision envelope, the highest precision at any higher recall
+    precision = np.flip(np.maximum.accumulate(np.flip(precision, axis=0), axis=0), axis=0)
+
+    curves = np.array([np.interp(RECALL_POINTS, recall[:, column], precision[:, column])
+                       for column in range(columns)])
+    ap = np.sum((curves[:, 1:] + curves[:, :-1]) / 2 * np.diff(RECALL_POINTS), axis=1)
+    return ap, curves[0]
+
+def rank_classes(tp, predictions, labels):
+    """
+    Sorts the predictions of every class by decreasing confidence once and accumulates their true
+    positives, so the predictions above any confidence threshold are a prefix of them.
+
+    Returns per class the sorted confidences, the cumulative true positives and the number of labels
+    and of images with labels.
+    """
+    ranked = {}
+    for c in np.union1d(predictions['cls'], labels['cls']).tolist():
+        in_class = np.flatnonzero(predictions['cls'] == c)
+        order = in_class[np.argsort(-predictions['conf'][in_class], kind='stable')]
+        ranked[c] = {'conf': predictions['conf'][order], 'tpc': np.cumsum(tp[order], axis=0, dtype=np.int32),
+                     'instances': int(np.count_nonzero(labels['cls'] == c)),
+                     'images': len(np.unique(labels['image'][labels['cls'] == c]))}
+    return ranked
+
+def evaluate(ranked, labels, classes, conf, columns):
+    """
+    Computes the metrics of a class subset from the predictions above a confidence threshold.
+
+    Returns the metrics of every class with labels and their mean: precision, recall and F1 at the
+    threshold and the AP at every IoU threshold, together with the precision-recall curves.
+    """
+    per_class, curves = {}, {}
+    for c in classes:
+        if c not in ranked or not ranked[c]['instances']:
+            continue
+        instances = ranked[c]['instances']
+        # the confidences are sorted in decreasing order
+        count = int(np.searchsorted(-ranked[c]['conf'], -conf, side='right'))
+        tpc = ranked[c]['tpc'][:count]
+        true_positives = int(tpc[-1, 0]) if count else 0
+        if count:
+            ap, curves[c] = average_precision(tpc, instances)
+        else:
+            ap, curves[c] = np.zeros(columns), np.zeros(len(RECALL_POINTS))
+        per_class[c] = {'images': ranked[c]['images'], 'instances': instances,
+                        'precision': true_positives / count if count else 0., 'recall': true_positives / instances,
+                        'ap': ap}
+
+    rows = list(per_class.values())
+    precision = float(np.mean([row['precision'] for row in rows])) if rows else 0.
+    recall = float(np.mean([row['recall'] for row in rows])) if rows else 0.
+    summary = {'images': len(np.unique(labels['image'][np.isin(labels['cls'], classes)])),
+               'instances': sum(row['instances'] for row in rows), 'precision': precision, 'recall': recall,
+               'f1': 2 * precision * recall / max(precision + recall, 1e-16),
+               'ap': np.mean([row['ap'] for row in rows], axis=0) if rows else np.zeros(columns)}
+    return summary, per_class, curves
+
+def confusion_matrix(pairs, predictions, labels, classes, conf, iou_threshold):
+    """
+    Returns the confusion matrix of a class subset like ultralytics computes it, with the predicted
+    classes as rows and the true classes as columns, the last row and column being the background.
+    """
+    position = np.full(max(classes) + 1, len(classes))
+    position[classes] = np.arange(len(classes))
+    use_pred = (predictions['conf'] > conf) & np.isin(predictions['cls'], classes)
+    use_label = np.isin(labels['cls'], classes)
+
+    pred, label, iou = pairs
+    keep = use_pred[pred] & use_label[label] & (iou > iou_threshold)
+    pred, label = unique_matches(pred[keep], label[keep], iou[keep])
+
+    matrix = np.zeros((len(classes) + 1, len(classes) + 1), dtype=np.int64)
+    np.add.at(matrix, (position[predictions['cls'][pred]], position[labels['cls'][label]]), 1)
+    missed = use_label.copy()
+    missed[label] = False
+    np.add.at(matrix, (len(classes), position[labels['cls'][missed]]), 1)
+    spurious = use_pred.copy()
+    spurious[pred] = False
+    np.add.at(matrix, (position[predictions['cls'][spurious]], len(classes)), 1)
+    return matrix
+
+def parse_classes(subsets, names):
+    """
+    Returns the class ids of every comma separated class subset, given by name or id, or of all classes.
+    """
+    ids = {name: index for index, name in names.items()}
+    parsed = []
+    for subset in subsets or [','.join(names.values())]:
+        classes = []
+        for value in subset.split(','):
+            if value.isdigit() and int(value) in names:
+                classes.append(int(value))
+            elif value in ids:
+                classes.append(ids[value])
+            else:
+                raise ValueError(f'Unknown class {value}, choose from {", ".join(names.values())}')
+        parsed.append(sorted(set(classes)))
+    return parsed
+
+def print_results(results, iou_thresholds):
+    extra = [f'mAP{round(t * 100)}' for t in iou_thresholds[len(IOU_THRESHOLDS):]]
+    first = results['sweep'][0]
+    print(f'\nClasses at confidence {first["conf"]}')
+    print(f'{"Class":>12} {"Images":>8} {"Instances":>10} {"P":>7} {"R":>7} {"mAP50":>7} {"mAP50-95":>9}')
+    for name, row in [('all', first), *first['per_class'].items()]:
+        print(f'{name:>12} {row["images"]:>8} {row["instances"]:>10} {row["precision"]:>7.3f} '
+              f'{row["recall"]:>7.3f} {row["mAP50"]:>7.3f} {row["mAP50-95"]:>9.3f}')
+
+    print(f'\n{"Classes":>24} {"Conf":>6} {"P":>7} {"R":>7} {"F1":>7} {"mAP50":>7} {"mAP50-95":>9} '
+          + ' '.join(f'{name:>7}' for name in extra))
+    for row in results['sweep']:
+        print(f'{",".join(row["classes"]):>24} {row["conf"]:>6.3f} {row["precision"]:>7.3f} {row["recall"]:>7.3f} '
+              f'{row["f1"]:>7.3f} {row["mAP50"]:>7.3f} {row["mAP50-95"]:>9.3f} '
+              + ' '.join(f'{row[name]:>7.3f}' for name in extra))
+
+    for subset, matrix in results['confusion_matrices'].items():
+        print(f'\nConfusion matrix of {subset} at confidence {matrix["conf"]} and IoU {matrix["iou"]}, '
+              f'predicted classes as rows, true classes as columns')
+        print(' ' * 12 + ''.join(f'{name:>12}' for name in matrix['classes']))
+        for name, row in zip(matrix['classes'], matrix['matrix']):
+            print(f'{name:>12}' + ''.join(f'{count:>12}' for count in row))
+
+def run_evaluation(predictions, labels, subsets, confs, names, args):
+    """
+    Evaluates every class subset at every confidence threshold and computes their confusion matrices
+    and precision-recall curves, all from the same matched predictions.
+    """
+    iou_thresholds = np.concatenate([IOU_THRESHOLDS, args.iou or []])
+    pairs = overlapping_pairs(predictions, labels)
+    tp = match_predictions(pairs, predictions, labels, iou_thresholds)
+    ranked = rank_classes(tp, predictions, labels)
+
+    results = {'sweep': [], 'pr_curves': {}, 'confusion_matrices': {}}
+    for classes in subsets:
+        subset = ','.join(names[c] for c in classes)
+        for conf in confs:
+            summary, per_class, curves = evaluate(ranked, labels, classes, conf, len(iou_thresholds))
+            row = {'classes': [names[c] for c in classes], 'conf': conf}
+            for name, values in [(None, summary), *per_class.items()]:
+                standard, extra = np.split(values['ap'], [len(IOU_THRESHOLDS)])
+                metrics = {key: value for key, value in values.items() if key != 'ap'}
+                metrics.update({'mAP50': float(standard[0]), 'mAP50-95': float(standard.mean())})
+                metrics.update({f'mAP{round(t * 100)}': float(ap) for t, ap in
+                                zip(iou_thresholds[len(IOU_THRESHOLDS):], extra)})
+                if name is None:
+                    row.update(metrics, per_class={})
+                else:
+                    row['per_class'][names[name]] = metrics
+            results['sweep'].append(row)
+            if conf == confs[0]:
+                results['pr_curves'][subset] = {'recall': RECALL_POINTS.tolist(),
+                                                **{names[c]: curve.tolist() for c, curve in curves.items()}}
+
+        matrix = confusion_matrix(pairs, predictions, labels, classes, args.cm_conf, args.cm_iou)
+        results['confusion_matrices'][subset] = {'conf': args.cm_conf, 'iou': args.cm_iou,
+                                                 'classes': [names[c] for c in classes] + ['background'],
+                                                 'matrix': matrix.tolist()}
+    return results, iou_thresholds
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse command line arguments and return them.
+    """
+    parser = argparse.ArgumentParser(
+        prog = 'DNT evaluate.py',
+        description = 'Evaluates a model on a split of a dataset from predictions cached on disk, so '
+                      'thresholds and class subsets are swept without running the model again.',
+        epilog = 'This program is used for the Leren & Beslissen course at the University of Amsterdam.')
+
+    parser.add_argument('--weights',
+                        required=True,
+                        help='Trained weights (.pt) or an exported model (i.e. .onnx)')
+
+    parser.add_argument('--train-config',
+                        required=True,
+                        help='YAML training config listing the split and the class names')
+
+    parser.add_argument('--split',
+                        choices=['val', 'test'],
+                        default='val',
+                        help='The split of the training config to evaluate on')
+
+    parser.add_argument('--datasets-dir',
+                        default=os.path.join(ROOT_DIR, 'datasets'),
+                        help='The folder relative to which the dataset path of the config is resolved')
+
+    parser.add_argument('--cache',
+                        help='The prediction cache, by default next to the weights and named after them, '
+                             'the training config and the split')
+
+    parser.add_argument('--conf',
+                        type=float,
+                        nargs='+',
+                        default=[CACHE_CONF, 0.1, 0.25, 0.5],
+                        help=f'Confidence thresholds to evaluate at, at least {CACHE_CONF}')
+
+    parser.add_argument('--iou',
+                        type=float,
+                        nargs='+',
+                        help='IoU thresholds to report the mAP at, besides mAP50 and mAP50-95')
+
+    parser.add_argument('--classes',
+                        nargs='+',
+                        help='Class subsets to evaluate, each comma separated names or ids, i.e. ball,robot '
+                             '(default: all classes)')
+
+    parser.add_argument('--cm-conf',
+                        type=float,
+                        default=0.25,
+                        help='Confidence threshold of the confusion matrices')
+
+    parser.add_argument('--cm-iou',
+                        type=float,
+                        default=0.45,
+                        help='IoU threshold of the confusion matrices')
+
+    parser.add_argument('--output',
+                        help='JSON file to write the metrics, the PR curves and the confusion matrices to')
+
+    parser.add_argument('--imgsz',
+                        type=int,
+                        default=640,
+                        help='Inference image size')
+
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=8,
+                        help='Number of frames per inference batch')
+
+    parser.add_argument('--threads',
+                        type=int,
+                        default=2,
+                        help='Number of preprocessing threads')
+
+    parser.add_argument('--nms-iou',
+                        type=float,
+                        default=0.7,
+                        help='IoU threshold for non-maximum suppression, part of the cached predictions')
+
+    parser.add_argument('--max-det',
+                        type=int,
+                        default=300,
+                        help='Maximum number of detections per frame')
+
+    parser.add_argument('--device',
+                        default='cpu',
+                        help='Device to run on, i.e. cpu or cuda device=0')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    try:
+        with open(args.train_config) as file:
+            names = yaml.safe_load(file)['names']
+        names = dict(enumerate(names)) if isinstance(names, list) else names
+        subsets = parse_classes(args.classes, names)
+        try:
+            images = dataset_images(args.train_config, args.datasets_dir, args.split)
+        except KeyError:
+            raise ValueError(f'{args.train_config} has no {args.split} split')
+        if not images:
+            raise ValueError(f'The {args.split} split of {args.train_config} lists no images')
+        if not all(0 < iou <= 1 for iou in args.iou or []):
+            raise ValueError('IoU thresholds must be in (0, 1]')
+        if min(args.conf) < CACHE_CONF:
+            raise ValueError(f'The predictions are cached at confidence {CACHE_CONF}, --conf can\'t be lower')
+    except (OSError, KeyError, ValueError) as e:
+        print(f'\nError\n-----\n{e}.\n')
+        exit(1)
+
+    if args.cache is None:
+        args.cache = (f'{os.path.splitext(args.weights)[0]}_{os.path.splitext(os.path.basename(args.train_config))[0]}'
+                      f'_{args.split}.npz')
+
+    predictions = load_predictions(args, images)
+    labels = load_labels(predictions['images'], predictions['shapes'])
+
+    start = time.perf_counter()
+    results, iou_thresholds = run_evaluation(predictions, labels, subsets, args.conf, names, args)
+    elapsed = time.perf_counter() - start
+
+    print_results(results, iou_thresholds)
+    print(f'\nEvaluated {len(results["sweep"])} settings on {len(images)} images with {len(predictions["conf"])} '
+          f'cached predictions in {1000 * elapsed:.1f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'weights': args.weights, 'cache': args.cache, **results}, file, indent=1)
+        print(f'Results written to {args.output}')
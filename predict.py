@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import cv2
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import argparse
+from pathlib import Path
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+
+from yolo_labels import format_labels, xyxy_to_yolo
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+# marks the end of a stream in the pipeline queues
+END = None
+
+class StageTimer:
+    """
+    Thread-safe accumulator of the time spent per pipeline stage.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, count=1):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def milliseconds_per_frame(self, stage):
+        return 1000 * self.seconds.get(stage, 0.) / max(1, self.counts.get(stage, 0))
+
+def source_root(sources):
+    """
+    Returns the deepest folder containing all sources, the frame names are relative to it.
+    """
+    root = os.path.commonpath([os.path.abspath(source) for source in sources])
+    return root if os.path.isdir(root) else os.path.dirname(root)
+
+def iterate_frames(sources, root=None):
+    """
+    Yields (name, image) for every image and video frame in the sources.
+
+    Sources are image files, video files or directories containing those. The name
+    of a frame is its path relative to the root without the extension (by default
+    relative to the deepest folder containing all sources), so equally named files
+    in different folders don't collide. The name of a video frame is the video name
+    followed by the frame number.
+    """
+    root = root or source_root(sources)
+    for source in sources:
+        if os.path.isdir(source):
+            yield from iterate_frames(sorted(os.path.join(source, name) for name in os.listdir(source)
+                                             if name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)),
+                                      root)
+            continue
+
+        stem = Path(os.path.relpath(os.path.abspath(source), root)).with_suffix('').as_posix()
+        if source.lower().endswith(VIDEO_EXTENSIONS):
+            capture = cv2.VideoCapture(source)
+            index = 0
+            while True:
+                success, frame = capture.read()
+                if not success:
+                    break
+                yield f'{stem}_{index:06d}', frame
+                index += 1
+            capture.release()
+        else:
+            frame = cv2.imread(source)
+            if frame is None:
+                print(f'Skipping unreadable image: {source}')
+                continue
+            yield stem, frame
+
+class Pipeline:
+    """
+    Streams frames through the model in batches.
+
+    One thread decodes the sources, `threads` threads letterbox the frames and the
+    calling thread runs inference and postprocessing on batches of `batch` frames.
+    The bounded queues between the stages keep the memory use flat. Every frame
+    gets a sequence number when decoded, so the frames are yielded in their input
+    order however the preprocessing threads interleave. An error in any stage
+    stops all stages and is raised from run.
+    """
+
+    def __init__(self, model, imgsz, batch, threads, conf, iou, max_det):
+        self.model = model
+        self.batch = batch
+        self.threads = threads
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.letterbox = LetterBox((imgsz, imgsz), auto=False, stride=model.stride)
+        self.timer = StageTimer()
+        self._errors = []
+        self._stop = threading.Event()
+
+    def _fail(self, error):
+        self._errors.append(error)
+        self._stop.set()
+
+    def _put(self, target, item):
+        # gives up once the pipeline is stopped, so no stage blocks forever on a stage which has died
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, source):
+        # returns END once the pipeline is stopped
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return END
+
+    def _decode(self, frames):
+        try:
+            frames = iter(frames)
+            index = 0
+            while True:
+                start = time.perf_counter()
+                item = next(frames, END)
+                if item is END:
+                    break
+                self.timer.add('decode', time.perf_counter() - start)
+                if not self._put(self._decoded, (index, *item)):
+                    break
+                index += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.threads):
+                self._put(self._decoded, END)
+
+    def _preprocess(self):
+        try:
+            while (item := self._get(self._decoded)) is not END:
+                index, name, frame = item
+                start = time.perf_counter()
+                im = self.letterbox(image=frame)
+                im = np.ascontiguousarray(im[..., ::-1].transpose(2, 0, 1))
+                self.timer.add('preprocess', time.perf_counter() - start)
+                if not self._put(self._preprocessed, (index, name, frame.shape[:2], im)):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self._preprocessed, END)
+
+    def _batches(self):
+        # frames which arrive ahead of their turn wait in pending until all frames before them are batched
+        finished, batch, pending, next_index = 0, [], {}, 0
+        while finished < self.threads:
+            item = self._get(self._preprocessed)
+            if item is END:
+                finished += 1
+                continue
+            index, *frame = item
+            pending[index] = frame
+            while next_index in pending:
+                batch.append(pending.pop(next_index))
+                next_index += 1
+                if len(batch) == self.batch:
+                    yield batch
+                    batch = []
+        if batch and not self._stop.is_set():
+            yield batch
+
+    def run(self, sources):
+        """
+        Yields (name, original (height, width), detections) for every frame, the
+        detections being an (N, 6) array of x1, y1, x2, y2, confidence, class.
+        """
+        yield from self.run_frames(iterate_frames(sources))
+
+    def run_frames(self, frames):
+        """
+        Like run, for an iterable of (name, image) frames instead of sources.
+        """
+        # fresh queues, a stopped run may leave frames behind in the old ones
+        self._decoded = queue.Queue(maxsize=self.batch * 4)
+        self._preprocessed = queue.Queue(maxsize=self.batch * 4)
+        self._stop.clear()
+        self._errors.clear()
+        threads = [threading.Thread(target=self._decode, args=(frames,), daemon=True)]
+        threads += [threading.Thread(target=self._preprocess, daemon=True) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            yield from self._infer()
+        finally:
+            # also stops the stages when the caller stops iterating early
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def _infer(self):
+        for batch in self._batches():
+            names, shapes, ims = zip(*batch)
+
+            start = time.perf_counter()
+            # AutoBackend doesn't move tensors to the device of the model, only numpy inputs
+            im = torch.from_numpy(np.stack(ims)).to(self.model.device)
+            im = (im.half() if self.model.fp16 else im.float()) / 255
+            with torch.inference_mode():
+                preds = self.model(im)
+            self.timer.add('inference', time.perf_counter() - start, len(batch))
+
+            start = time.perf_counter()
+            detections = non_max_suppression(preds, self.conf, self.iou, max_det=self.max_det)
+            results = []
+            for name, shape, det in zip(names, shapes, detections):
+                det[:, :4] = ops.scale_boxes(im.shape[2:], det[:, :4], shape)
+                results.append((name, shape, det.float().cpu().numpy()))
+            self.timer.add('postprocess', time.perf_counter() - start, len(batch))
+
+            yield from results
+
+def import_inference():
+    """
+    Imports ultralytics and torch for the Pipeline and load_model. They take seconds to import,
+    so this is only called once the arguments are parsed and --help and argument errors don't wait for them.
+    """
+    global LetterBox, AutoBackend, ops, select_device, non_max_suppression, torch
+    from ultralytics.data.augment import LetterBox
+    from ultralytics.nn.autobackend import AutoBackend
+    from ultralytics.utils import ops
+    from ultralytics.utils.torch_utils import select_device
+    try:
+        from ultralytics.utils.nms import non_max_suppression
+    except ImportError:
+        # ultralytics < 8.3.x keeps NMS in ops
+        non_max_suppression = ops.non_max_suppression
+    import torch
+
+def load_model(weights, device):
+    """
+    Loads trained weights or an exported model for inference on a device.
+    """
+    model = AutoBackend(weights, device=select_device(device), verbose=False)
+    model.eval()
+    return model
+
+def write_result(args, writer, name, shape, det):
+    """
+    Writes the detections of a frame as a YOLO label file or as a line of the JSONL file.
+    """
+    if args.save_format == 'yolo':
+        height, width = shape
+        boxes = xyxy_to_yolo(det[:, :4], width, height)
+        path = os.path.join(args.output, f'{name}.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(format_labels(det[:, 5].astype(np.int64), boxes))
+    else:
+        writer.write(json.dumps({'name': name, 'height': shape[0], 'width': shape[1],
+                                 'boxes': det[:, :4].round(2).tolist(), 'conf': det[:, 4].round(4).tolist(),
+                                 'cls': det[:, 5].astype(int).tolist()}) + '\n')
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse command line arguments and return them.
+    """
+    parser = argparse.ArgumentParser(
+        prog = 'DNT predict.py',
+        description = 'Runs a trained model over images, directories and videos at throughput.',
+        epilog = 'This program is used for the Leren & Beslissen course at the University of Amsterdam.')
+
+    parser.add_argument('sources',
+                        nargs='+',
+                        help='Image files, video files or directories containing those')
+
+    parser.add_argument('--weights',
+                        required=True,
+                        help='Trained weights (.pt) or an exported model (i.e. .onnx)')
+
+    parser.add_argument('--output',
+                        default='predictions',
+                        help='Directory for the YOLO label files or the JSONL file')
+
+    parser.add_argument('--save-format',
+                        choices=['yolo', 'jsonl'],
+                        default='yolo',
+                        help='Write one YOLO label file per frame or a single predictions.jsonl')
+
+    parser.add_argument('--imgsz',
+                        type=int,
+                        default=640,
+                        help='Inference image size')
+
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=8,
+                        help='Number of frames per inference batch')
+
+    parser.add_argument('--threads',
+                        type=int,
+                        default=2,
+                        help='Number of preprocessing threads')
+
+    parser.add_argument('--conf',
+                        type=float,
+                        default=0.25,
+                        help='Confidence threshold')
+
+    parser.add_argument('--iou',
+                        type=float,
+                        default=0.7,
+                        help='IoU threshold for non-maximum suppression')
+
+    parser.add_argument('--max-det',
+                        type=int,
+                        default=300,
+                        help='Maximum number of detections per frame')
+
+    parser.add_argument('--device',
+                        default='cpu',
+                        help='Device to run on, i.e. cpu or cuda device=0')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    import_inference()
+
+    os.makedirs(args.output, exist_ok=True)
+
+    model = load_model(args.weights, args.device)
+    pipeline = Pipeline(model, args.imgsz, args.batch_size, args.threads, args.conf, args.iou, args.max_det)
+
+    writer = open(os.path.join(args.output, 'predictions.jsonl'), 'w') if args.save_format == 'jsonl' else None
+    frames = 0
+    start = time.perf_counter()
+    for name, shape, det in pipeline.run(args.sources):
+        write_start = time.perf_counter()
+        write_result(args, writer, name, shape, det)
+        pipeline.timer.add('write', time.perf_counter() - write_start)
+        frames += 1
+    elapsed = time.perf_counter() - start
+    if writer is not None:
+        writer.close()
+
+    print(f'Processed {frames} frames in {elapsed:.2f}s: {frames / max(elapsed, 1e-9):.1f} FPS end-to-end')
+    for stage in ('decode', 'preprocess', 'inference', 'postprocess', 'write'):
+        print(f'{stage:>12}: {pipeline.timer.milliseconds_per_frame(stage):8.2f} ms/frame')
@@ -7,17 +7,22 @@ Converts the 'Dataset_maker_faire' annotation data files to the
 See https://docs.ultralytics.com/datasets/detect/#ultralytics-yolo-format for
 more info about the SPLObjDetectDatasetV2 dataset format.
 
-Usage: ./convert_dataset_annotations.py file1.xml file2.xml ... fileN.xml
+The XML files are parsed incrementally, all objects of an image are collected
+and written to its label file at once. The files can be converted by multiple
+processes in parallel.
+
+Usage: ./convert_dataset_annotations.py [--workers N] [--quiet] file1.xml dir2/ ... fileN.xml
+       find . -name '*.xml' | ./convert_dataset_annotations.py -
 """
 
-import sys
+import argparse
 import os
+import sys
+import xml.etree.ElementTree as ElementTree
+from multiprocessing import Pool
+from typing import Optional
 
-try:
-    import xmltodict
-except ImportError:
-    print('Package `xmltodict` not installed, run `pip3 install xmltodict`')
-    sys.exit(1)
+from yolo_labels import write_labels
 
 CLASS_IDS = {
     'ball': 0,
@@ -26,71 +31,138 @@ CLASS_IDS = {
     'goalspot': 3, # spot in front of the goal area for the penalty
 }
 
-def convert_files(filepaths: list[str]) -> None:
-    total_success_files = 0
-    total_filepaths = len(filepaths)
-
-    for index, filepath in enumerate(filepaths):
-        print(f'[{index + 1}/{total_filepaths}] {filepath}')
-
-        # Read XML file and convert to python dict
-        xml_dict = xmltodict.parse(open(filepath, 'r').read())
+def parse_annotation(filepath: str) -> tuple[int, int, list[tuple[str, list[float]]]]:
+    """
+    Parses a VOC XML annotation file with a streaming parser.
+
+    Returns the image width, image height and a list of (name, [xmin, ymin, xmax, ymax])
+    tuples, one for each annotated object.
+    """
+    image_width, image_height = 0, 0
+    objects = []
+
+    for _, element in ElementTree.iterparse(filepath, events=('end',)):
+        if element.tag == 'size':
+            image_width = int(element.findtext('width'))
+            image_height = int(element.findtext('height'))
+        elif element.tag == 'object':
+            bndbox = element.find('bndbox')
+            objects.append((element.findtext('name'),
+                            [float(bndbox.findtext(key)) for key in ('xmin', 'ymin', 'xmax', 'ymax')]))
+        else:
+            continue
 
-        # If there are no annotations, remove the file immediately
-        if 'object' not in xml_dict['annotation']:
-            print('No detected objects present, removing file')
-            os.remove(filepath)
+        # Free the parsed subtree, we only keep the extracted values.
+        element.clear()
+
+    return image_width, image_height, objects
+
+def annotation_labels(filepath: str) -> Optional[tuple[list[int], list[list[float]]]]:
+    """
+    Returns the class ids and normalized YOLO boxes of the objects in an XML annotation file,
+    or None if the file contains no objects.
+    """
+    image_width, image_height, objects = parse_annotation(filepath)
+    if not objects:
+        return None
+
+    class_ids, boxes = [], []
+    for name, (xmin, ymin, xmax, ymax) in objects:
+        # The new dataset does not contain the 'centerspot' class,
+        # therefore we ignore it.
+        if name == 'centerspot':
             continue
 
-        total_success_files += 1
+        # Get the numerical class id for the new dataset based on the name
+        # of the current dataset.
+        class_ids.append(CLASS_IDS[name])
 
-        # Get the full image width
-        image_width = int(xml_dict['annotation']['size']['width'])
-        image_height = int(xml_dict['annotation']['size']['height'])
+        # Calculate the bounding box width and height.
+        bbox_width = xmax - xmin
+        bbox_height = ymax - ymin
 
-        # Sometimes it's one dict, sometimes an array of dict.
-        # Convert a single dict to an array with one item such that
-        # we always have arrays.
-        if not isinstance(xml_dict['annotation']['object'], list):
-            xml_dict['annotation']['object'] = [xml_dict['annotation']['object']]
+        # Calculate the midpoint of the bounding box and rescale everything
+        # by the image width/height such that it's between 0 and 1.
+        boxes.append([(xmin + (bbox_width / 2)) / image_width,
+                      (ymin + (bbox_height / 2)) / image_height,
+                      bbox_width / image_width,
+                      bbox_height / image_height])
 
-        # Loop over each detected object annotation
-        for obj in xml_dict['annotation']['object']:
-            # The new dataset does not contain the 'centerspot' class, 
-            # therefore we ignore it.
-            if obj['name'] == 'centerspot':
-                continue
+    return class_ids, boxes
 
-            # Get the numerical class id for the new dataset based on the name
-            # of the current dataset.
-            class_id = CLASS_IDS[obj['name']]
+def convert_file(filepath: str) -> bool:
+    """
+    Converts a single XML annotation file to a YOLO label file next to it.
 
-            # Calculate the bounding box width and height.
-            bbox_width = int(obj['bndbox']['xmax']) - int(obj['bndbox']['xmin'])
-            bbox_height = int(obj['bndbox']['ymax']) - int(obj['bndbox']['ymin'])
+    Returns False if the file contained no objects, in which case it is removed.
+    """
+    labels = annotation_labels(filepath)
 
-            # Calcualte the midpoint of the bounding box.
-            # Divide by the image widht/height to scale it between 0 and 1
-            midpoint_x = (int(obj['bndbox']['xmin']) + (bbox_width / 2)) / image_width
-            midpoint_y = (int(obj['bndbox']['ymin']) + (bbox_height / 2)) / image_height
+    # If there are no annotations, remove the file immediately
+    if labels is None:
+        os.remove(filepath)
+        return False
 
-            # Rescale the bounding box such that it's between 0 and 1
-            bbox_width_scaled = bbox_width / image_width
-            bbox_height_scaled = bbox_height / image_height
+    class_ids, boxes = labels
+    if class_ids:
+        write_labels('{}.txt'.format(filepath.rsplit('.', 1)[0]), class_ids, boxes)
 
-            contents = f'{class_id} {midpoint_x} {midpoint_y} {bbox_width_scaled} {bbox_height_scaled}'
+    return True
 
-            new_filepath = '{}.txt'.format(filepath.rsplit('.', 1)[0])
-            new_file = open(new_filepath, 'w')
-            new_file.write(contents)
-            new_file.close()
+def convert_files(filepaths: list[str], workers: int = 1, quiet: bool = False) -> None:
+    total_success_files = 0
+    total_filepaths = len(filepaths)
+
+    if workers > 1:
+        pool = Pool(workers)
+        chunksize = max(1, min(256, total_filepaths // (workers * 16)))
+        results = pool.imap(convert_file, filepaths, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(convert_file, filepaths)
+
+    try:
+        for index, (filepath, success) in enumerate(zip(filepaths, results)):
+            if not quiet:
+                print(f'[{index + 1}/{total_filepaths}] {filepath}')
+                if not success:
+                    print('No detected objects present, removing file')
+
+            total_success_files += success
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     print(f'Converted {total_success_files} files successfully.')
 
-if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        print(f'Usage: {sys.argv[0]} file1.xml file2.xml ... fileN.xml')
-        sys.exit(1)
+def collect_filepaths(paths: list[str]) -> list[str]:
+    """
+    Expands the given paths to a sorted list of XML files.
 
-    convert_files(sys.argv[1:])
+    Directories are searched recursively, '-' reads one path per line from stdin.
+    """
+    filepaths = []
+    for path in paths:
+        if path == '-':
+            filepaths.extend(collect_filepaths([line.strip() for line in sys.stdin if line.strip()]))
+        elif os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                filepaths.extend(os.path.join(root, name) for name in files if name.endswith('.xml'))
+        else:
+            filepaths.append(path)
+
+    return sorted(filepaths)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert Dataset_maker_faire XML annotations to YOLO label files.')
+    parser.add_argument('paths', nargs='+',
+                        help="XML files or directories containing them, '-' reads the paths from stdin")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of processes used for converting the files (default: 1)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Only print the summary instead of every converted file')
+    args = parser.parse_args()
+
+    convert_files(collect_filepaths(args.paths), workers=args.workers, quiet=args.quiet)
     print('Done')
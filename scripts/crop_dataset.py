@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Builds a dataset of crops or tiles around the objects of a dataset, for training
+at a small image size without losing the detail of small objects like the ball.
+
+- objects: a square window around every object, with --context times the size of
+  the object as margin on every side, but at least --size pixels. Windows larger
+  than --size are scaled down to it. Objects inside an earlier window of the same
+  image get no window of their own.
+- tiles: a grid of --size pixel tiles with --overlap, at full resolution. Only
+  tiles which contain objects are kept.
+
+Both modes add up to --negatives windows per image without any object. Labels are
+shifted into the window and clipped to it, and labels of which less than
+--min-visibility of the box remains are dropped. Every split of the train config
+is written to DESTINATION/images/<split> and DESTINATION/labels/<split> with a
+<split>.txt listing, together with a train config in the shape of
+config/train_*.yaml, so training runs with --imgsz equal to --size.
+
+Usage: crop_dataset.py DESTINATION --train-config config/train_*.yaml [--mode {objects,tiles}] [--size int]
+                       [--context float] [--overlap float] [--negatives int] [--min-visibility float]
+                       [--splits str [str... ]] [--config ./path] [--datasets-dir ./path] [--workers int] [--seed int]
+"""
+
+import argparse
+import os
+import zlib
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+try:
+    import cv2
+    import yaml
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+from shard_cache import dataset_images
+from yolo_labels import label_path, read_labels, write_labels, xyxy_to_yolo, yolo_to_xyxy
+
+MIN_BOX_PIXELS = 2
+
+
+def object_windows(boxes, width, height, size, context):
+    """
+    Returns the (x0, y0, side) square windows around the (N, 4) xyxy pixel boxes, clamped to the image.
+    """
+    windows = []
+    for x1, y1, x2, y2 in boxes:
+        # an object which is completely inside an earlier window needs no window of its own
+        if any(x0 <= x1 and y0 <= y1 and x2 <= x0 + side and y2 <= y0 + side for x0, y0, side in windows):
+            continue
+
+        side = max(size, (1 + 2 * context) * max(x2 - x1, y2 - y1))
+        side = int(min(side, width, height))
+        x0 = int(np.clip((x1 + x2 - side) / 2, 0, width - side))
+        y0 = int(np.clip((y1 + y2 - side) / 2, 0, height - side))
+        windows.append((x0, y0, side))
+    return windows
+
+
+def tile_windows(width, height, size, overlap):
+    """
+    Returns the (x0, y0, side) windows of a grid of tiles covering the image, the last row and column
+    aligned with the image edges.
+    """
+    side = min(size, width, height)
+    step = max(1, int(side * (1 - overlap)))
+
+    def starts(length):
+        positions = list(range(0, length - side + 1, step))
+        if positions[-1] != length - side:
+            positions.append(length - side)
+        return positions
+
+    return [(x0, y0, side) for y0 in starts(height) for x0 in starts(width)]
+
+
+def crop_labels(ids, boxes, window, min_visibility):
+    """
+    Shifts and clips the xyxy pixel boxes into a window.
+
+    Returns the class ids and boxes which keep at least min_visibility of their area, in pixels of the window.
+    """
+    x0, y0, side = window
+    shifted = boxes - np.array([x0, y0, x0, y0], dtype=np.float64)
+    clipped = np.clip(shifted, 0, side)
+
+    area = np.prod(shifted[:, 2:] - shifted[:, :2], axis=1)
+    visible = np.prod(np.maximum(clipped[:, 2:] - clipped[:, :2], 0), axis=1)
+    keep = (visible >= min_visibility * np.maximum(area, 1e-9)) \
+        & (np.min(clipped[:, 2:] - clipped[:, :2], axis=1) >= MIN_BOX_PIXELS)
+    return ids[keep], clipped[keep]
+
+
+def negative_windows(boxes, width, height, size, count, rng, attempts=20):
+    """
+    Returns up to count random windows of side size which don't overlap any of the boxes.
+    """
+    side = int(min(size, width, height))
+    windows = []
+    for _ in range(count * attempts):
+        if len(windows) == count:
+            break
+        x0, y0 = int(rng.integers(0, width - side + 1)), int(rng.integers(0, height - side + 1))
+        if len(boxes) and np.any((boxes[:, 0] < x0 + side) & (boxes[:, 2] > x0)
+                                 & (boxes[:, 1] < y0 + side) & (boxes[:, 3] > y0)):
+            continue
+        windows.append((x0, y0, side))
+    return windows
+
+
+def crop_image(job):
+    """
+    Writes the crops or tiles of a single image and their label files, returns their relative image paths.
+    """
+    image, stem, destination, split, options = job
+    im = cv2.imread(image)
+    if im is None:
+        return []
+
+    height, width = im.shape[:2]
+    label_file = label_path(image)
+    ids, boxes = read_labels(label_file) if os.path.exists(label_file) else (np.empty(0, np.int64), np.empty((0, 4)))
+    boxes = yolo_to_xyxy(boxes, width, height).reshape(-1, 4)
+
+    size = options['size']
+    crops = []
+    if options['mode'] == 'objects':
+        for window in object_windows(boxes, width, height, size, options['context']):
+            crops.append((window, *crop_labels(ids, boxes, window, options['min_visibility'])))
+    else:
+        for window in tile_windows(width, height, size, options['overlap']):
+            window_ids, window_boxes = crop_labels(ids, boxes, window, options['min_visibility'])
+            if len(window_ids):
+                crops.append((window, window_ids, window_boxes))
+
+    # the negatives of an image only depend on the seed and its name, not on the order of the workers
+    rng = np.random.default_rng([options['seed'], zlib.crc32(image.encode())])
+    for window in negative_windows(boxes, width, height, size, options['negatives'], rng):
+        crops.append((window, np.empty(0, np.int64), np.empty((0, 4))))
+
+    written = []
+    for (x0, y0, side), crop_ids, crop_boxes in crops:
+        crop = im[y0:y0 + side, x0:x0 + side]
+        if side != size:
+            crop = cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
+
+        name = f'{stem}_{x0}_{y0}_{side}'
+        relative = os.path.join('images', split, name + '.jpg')
+        cv2.imwrite(os.path.join(destination, relative), crop, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        write_labels(os.path.join(destination, 'labels', split, name + '.txt'), crop_ids,
+                     xyxy_to_yolo(crop_boxes, side, side))
+        written.append(relative)
+    return written
+
+
+def write_config(config_path, destination, names, splits, datasets_dir):
+    """
+    Writes a train config for the built dataset in the shape of config/train_*.yaml.
+    """
+    destination = os.path.abspath(destination)
+    datasets_dir = os.path.abspath(datasets_dir)
+    # relative to the datasets folder like the configs of this repository, if the dataset lives inside it
+    inside = os.path.commonpath([destination, datasets_dir]) == datasets_dir
+    data = {'path': os.path.relpath(destination, datasets_dir) if inside else destination}
+    data.update({split: f'{split}.txt' for split in splits})
+    data['names'] = names
+
+    os.makedirs(os.path.dirname(os.path.abspath(config_path)), exist_ok=True)
+    with open(config_path, 'w') as file:
+        yaml.safe_dump(data, file, sort_keys=False)
+
+
+def build_crop_dataset(train_config, destination, options, splits=None, config_path=None, datasets_dir='.',
+                       workers=1):
+    """
+    Crops every split of the train config into the destination and writes the train config of the result.
+
+    Returns the number of crops per split.
+    """
+    with open(train_config) as file:
+        data = yaml.safe_load(file)
+    splits = [split for split in (splits or ('train', 'val', 'test')) if data.get(split)]
+
+    counts = {}
+    for split in splits:
+        for folder in ('images', 'labels'):
+            os.makedirs(os.path.join(destination, folder, split), exist_ok=True)
+
+        # the crops are named after the path of their image relative to the folder containing the whole split,
+        # so equally named images in different folders don't overwrite each other's crops
+        images = dataset_images(train_config, datasets_dir, split)
+        root = os.path.commonpath([os.path.dirname(image) for image in images]) if images else ''
+        jobs = [(image, Path(os.path.relpath(image, root)).with_suffix('').as_posix().replace('/', '_'),
+                 destination, split, options) for image in images]
+        if workers > 1 and len(jobs) > 1:
+            with Pool(workers) as pool:
+                results = pool.imap(crop_image, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+                written = [path for paths in results for path in paths]
+        else:
+            written = [path for job in jobs for path in crop_image(job)]
+
+        with open(os.path.join(destination, f'{split}.txt'), 'w') as file:
+            file.writelines(f'./{Path(path).as_posix()}\n' for path in sorted(written))
+        counts[split] = len(written)
+
+    config_path = config_path or os.path.join(destination, f'train_{Path(destination).name}.yaml')
+    write_config(config_path, destination, data['names'], splits, datasets_dir)
+    print(f"Train config written to {config_path}, train with --imgsz={options['size']}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('destination', type=Path,
+                        help="the folder the cropped dataset is created in")
+    parser.add_argument('--train-config', required=True, type=Path,
+                        help="the YAML training config of the dataset to crop")
+    parser.add_argument('--mode', choices=['objects', 'tiles'], default='objects',
+                        help="objects: a window around every object, tiles: a grid of tiles containing objects "
+                             "(default: objects)")
+    parser.add_argument('--size', type=int, default=320,
+                        help="the side of the crops in pixels, and the imgsz to train at (default: 320)")
+    parser.add_argument('--context', type=float, default=1.0,
+                        help="the margin around an object relative to its size, objects mode only (default: 1.0)")
+    parser.add_argument('--overlap', type=float, default=0.2,
+                        help="the overlap of neighbouring tiles as a fraction of their size, tiles mode only "
+                             "(default: 0.2)")
+    parser.add_argument('--negatives', type=int, default=1,
+                        help="the number of windows without objects per image (default: 1)")
+    parser.add_argument('--min-visibility', type=float, default=0.5,
+                        help="the fraction of a box which has to be inside a window to keep its label (default: 0.5)")
+    parser.add_argument('--splits', nargs='+', choices=['train', 'val', 'test'],
+                        help="the splits to crop (default: all splits of the train config)")
+    parser.add_argument('--config', type=Path,
+                        help="the train config to write (default: DESTINATION/train_<DESTINATION name>.yaml)")
+    parser.add_argument('--datasets-dir', type=Path, default=Path(__file__).resolve().parents[1] / 'datasets',
+                        help="the folder relative to which the dataset path of the config is resolved "
+                             "(default: the datasets folder of this repository)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="the number of processes used for cropping (default: all cores)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the seed of the negative windows (default: 0)")
+    args = parser.parse_args()
+
+    if not 0 <= args.overlap < 1 or not 0 < args.min_visibility <= 1:
+        print("\nError\n-----\n--overlap must be in [0, 1) and --min-visibility in (0, 1].\n")
+        exit(1)
+
+    options = {'mode': args.mode, 'size': args.size, 'context': args.context, 'overlap': args.overlap,
+               'negatives': args.negatives, 'min_visibility': args.min_visibility, 'seed': args.seed}
+    counts = build_crop_dataset(args.train_config, args.destination, options, args.splits, args.config,
+                                args.datasets_dir, args.workers)
+    for split, count in counts.items():
+        print(f"{split}.txt contains {count} crops.")
@@ -4,21 +4,73 @@
 Image Augmenter class used for generating augmented images from a dataset.
 
 Usage: data_augmentor.py --augments str [str... ] [--sourcepath ./path] [--prefix str]  [--ratio float]
+                         [--seed int] [--workers int] [--manifest ./path]
+       data_augmentor.py --recipes [prefix=]str[+str...] [...] [--sourcepath ./path] [--ratio float]
+                         [--seed int] [--workers int] [--manifest ./path]
 '''
 
 import argparse
+import hashlib
 import os
+from multiprocessing import Pool
 from pathlib import Path
 from PIL import Image
-from random import shuffle
-try:
-    from torch import Tensor
-    from torchvision.tv_tensors import BoundingBoxes
+from random import Random
+from dataset_manifest import open_manifest
+from yolo_labels import read_labels, write_labels, xyxy_to_yolo, yolo_to_xyxy
+
+# torch and torchvision are imported inside the functions which use them, they take seconds to import
+AUGMENTATIONS = ['colorjitter', 'gaussian_blur', 'adjust_sharpness', 'posterize', 'random_rotation']
+
+
+def build_augmentations():
+    """
+    Creates the dictionary of all available augmentations, keyed by the names in AUGMENTATIONS.
+    """
     from torchvision.transforms import v2
-    from tqdm import tqdm
-except ImportError as e:
-    print(f"\nError\n-----\n{e}.\n")
-    exit(1)
+
+    return {'colorjitter': v2.ColorJitter(brightness=(.5), saturation=(0.5, 1.5), hue=(-0.5, 0.5)),
+            'gaussian_blur': v2.GaussianBlur(kernel_size=(5, 9), sigma=(0.1, 5.)),
+            'adjust_sharpness': v2.RandomAdjustSharpness(sharpness_factor=5),
+            'posterize': v2.RandomPosterize(bits=5),
+            'random_rotation': v2.RandomRotation(degrees=(0, 45))}
+
+
+def image_seed(seed, image_path):
+    """
+    Derives the seed used for augmenting a single image from a base seed and the path of the image relative
+    to its dataset, so equally named images in different folders are augmented differently.
+    """
+    key = f"{seed}:{Path(os.path.normpath(image_path)).as_posix()}".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'little')
+
+
+def augment_sample(transform, img, boxes):
+    """
+    Applies a transform to an image and its boundary boxes.
+
+    Parameters
+    ----------
+    transform : torchvision.transform
+        The (composed) transform to be applied.
+    img : Union[PIL.Image, torch.Tensor]
+        The image, either a PIL image or a (C, H, W) tensor.
+    boxes : np.ndarray
+        The boundary boxes of the image in YOLOv8 format, of shape (N, 4).
+
+    Returns
+    -------
+    tuple[Union[PIL.Image, torch.Tensor], np.ndarray]
+        The transformed image and its boundary boxes in YOLOv8 format.
+    """
+    from torch import Tensor, as_tensor, float32
+    from torchvision.transforms import v2
+    from torchvision.tv_tensors import BoundingBoxes
+
+    H, W = v2.functional.get_size(img)
+    boxes = BoundingBoxes(as_tensor(yolo_to_xyxy(boxes, W, H), dtype=float32), format="XYXY", canvas_size=(H, W))
+    transformed_image, transformed_boxes = transform(img, boxes)
+    return transformed_image, xyxy_to_yolo(transformed_boxes.as_subclass(Tensor).numpy(), W, H)
 
 
 class Image_Augmentor:
@@ -42,52 +94,67 @@ class Image_Augmentor:
             - random_rotation
     images : list[Path]
         list containing paths to all image files in the 'images' folder
+    seed : int
+        base seed from which the image order and every per-image seed is derived
 
     Methods
     -------
-    apply_augmentations(self, augmentations, prefix=None, ratio=0.1):
+    apply_augmentations(self, augmentations, prefix=None, ratio=0.1, workers=1):
         Applies the chosen augmentations to the specified ratio of images.
         Saves the results to a new subdirectory with the chosen prefix.
+    apply_recipes(self, recipes, ratio=0.1, workers=1):
+        Applies several augmentation recipes to the specified ratio of images in a single pass.
+    stream(self, augmentations, ratio=0.1):
+        Lazily yields augmented samples for the specified ratio of images, without writing anything to disk.
     alter_augment(self, augment, parameter, value):
         Alters an augment by changing a parameter to specified value.
     shuffle_order(self):
         Shuffles the order in which the images will be chosen for augmentation.
     new_dir(self, destination):
         Creates a new folder at the specified path, relative to the sourcepath.
+    image_seed(self, image_path):
+        Derives the seed used for augmenting a single image from the base seed.
     yolo_to_bbox(self, x, y, w, h, W, H):
         Converts a boundary box from YOLOv8 format to a standard (x, y, x, y) format.
     bbox_to_yolo(self, x1, y1, x2, y2, W, H):
         Converts a boundary box from a standard (x, y, x, y) format to YOLOv8 format.
     """
 
-    def __init__(self, sourcepath):
+    def __init__(self, sourcepath, seed=0, manifest=None):
         """
         Parameters
         ----------
         sourcepath : Path
             path to the dataset folder in which both an images and a labels folder resides
+        seed : int, optional
+            base seed used for shuffling the images and deriving the per-image seeds
+        manifest : Dataset_Manifest, optional
+            manifest to list the images from, instead of listing the 'images' folder
         """
         self.sourcepath = sourcepath
-        self._augmentations = {'colorjitter': v2.ColorJitter(brightness=(.5), saturation=(0.5, 1.5), hue=(-0.5, 0.5)),
-                               'gaussian_blur': v2.GaussianBlur(kernel_size=(5, 9), sigma=(0.1, 5.)),
-                               'adjust_sharpness': v2.RandomAdjustSharpness(sharpness_factor=5),
-                               'posterize': v2.RandomPosterize(bits=5),
-                               'random_rotation': v2.RandomRotation(degrees=(0, 45))}
-
-        images = [os.path.join(sourcepath, 'images', file)
-                  for file in os.listdir(os.path.join(sourcepath, 'images'))
-                  if file.endswith(('.png', '.jpg', '.jpeg'))]
-        shuffle(images)
+        self.seed = seed
+        self._random = Random(seed)
+        self._augmentations = build_augmentations()
+
+        # sorting before shuffling so the order only depends on the seed, not on the filesystem
+        if manifest is not None:
+            images = [os.path.join(sourcepath, path) for path in manifest.images('images', recursive=False)]
+        else:
+            images = [os.path.join(sourcepath, 'images', file)
+                      for file in sorted(os.listdir(os.path.join(sourcepath, 'images')))
+                      if file.endswith(('.png', '.jpg', '.jpeg'))]
+        self._random.shuffle(images)
 
         self._images = images
 
-    def apply_augmentations(self, augmentations, prefix=None, ratio=0.1):
+    def apply_augmentations(self, augmentations, prefix=None, ratio=0.1, workers=1):
         """
         Applies the chosen augmentations to the specified ratio of images.
         Saves the results to a new subdirectory with the chosen prefix.
 
         If the argument `prefix` isn't passed in, the combination of augmentation names is used.
         If the argument `ratio` isn't passed in, a ratio of 10% is used.
+        Every image is augmented with its own seed, so the output is identical for any number of workers.
 
         Parameters
         ----------
@@ -97,61 +164,161 @@ class Image_Augmentor:
             Prefix to be used for the images and the images and labels folders.
         ratio : float, optional
             The ratio of images to be augmented
+        workers : int, optional
+            The number of processes used for augmenting the images.
+        """
+        self.apply_recipes([(augmentations, prefix)], ratio=ratio, workers=workers)
+
+    def apply_recipes(self, recipes, ratio=0.1, workers=1):
+        """
+        Applies several augmentation recipes to the specified ratio of images in a single pass.
+        Every source image and its labels are decoded once and then augmented by each recipe,
+        the results are saved to the subdirectories with the prefix of the recipe.
+
+        The output of every recipe is identical to calling `apply_augmentations` with that recipe.
+
+        Parameters
+        ----------
+        recipes : list[tuple[list[str], str]]
+            A list of (augmentations, prefix) pairs, the prefix may be None.
+        ratio : float, optional
+            The ratio of images to be augmented
+        workers : int, optional
+            The number of processes used for augmenting the images.
         """
+        from torchvision.transforms import v2
+        from tqdm import tqdm
 
-        # combining the different augmentations chosen
-        transform = v2.Compose(list(set([self._augmentations[x] for x in augmentations])))
+        transforms = []
+        for augmentations, prefix in recipes:
+            # combining the different augmentations chosen, in a fixed order so every process composes them the same way
+            transform = v2.Compose([self._augmentations[x] for x in sorted(set(augmentations))])
 
-        # checking if a prefix has been given, if not: prefix will be names of all augmentations
-        if not prefix:
-            prefix = '_'.join(sorted(augmentations))
+            # checking if a prefix has been given, if not: prefix will be names of all augmentations
+            if not prefix:
+                prefix = '_'.join(sorted(set(augmentations)))
 
-        # creating new directories for the images and labels
-        self.new_dir(os.path.join('images', prefix))
-        self.new_dir(os.path.join('labels', prefix))
+            # creating new directories for the images and labels
+            self.new_dir(os.path.join('images', prefix))
+            self.new_dir(os.path.join('labels', prefix))
+            transforms.append((transform, prefix))
 
-        # iteratively creating N * ratio new images
+        # creating N * ratio new images per recipe
         total_images = int(len(self._images) * ratio)
-        for ix, _ in zip(range(total_images), tqdm(range(total_images), desc="Augmenting Images... ")):
+        jobs = [(image_path, self.image_seed(image_path)) for image_path in self._images[:total_images]]
 
-            # splitting the path to create the image and label paths
-            split_path = os.path.split(self._images[ix])
-            image_path = os.path.join(split_path[0], prefix, prefix + '_' + split_path[1])
-            label_path = os.path.join(self.sourcepath, 'labels', prefix, prefix + '_' + Path(split_path[1]).stem + '.txt')
-            old_label_path = os.path.join(self.sourcepath, 'labels', Path(split_path[1]).stem + '.txt')
+        if workers <= 1:
+            for image_path, seed in tqdm(jobs, desc="Augmenting Images... "):
+                self._augment_image(transforms, image_path, seed)
+            return
 
-            # skipping any files which don't have a corresponding label file
-            if not os.path.exists(old_label_path):
-                continue
+        # every worker receives the augmentor once, afterwards only the (path, seed) jobs are sent
+        chunksize = max(1, len(jobs) // (workers * 16))
+        with Pool(workers, initializer=_init_worker, initargs=(self, transforms)) as pool:
+            for _ in tqdm(pool.imap_unordered(_augment_worker, jobs, chunksize=chunksize),
+                          total=len(jobs), desc="Augmenting Images... "):
+                pass
+
+    def _load_source(self, image):
+        """
+        Decodes an image and loads its labels. Every image is loaded once per pass, by all recipes together.
+
+        Parameters
+        ----------
+        image : Path
+            Path to the image to be loaded.
+
+        Returns
+        -------
+        tuple[PIL.Image, np.ndarray, np.ndarray] or None
+            The decoded image, class ids and YOLOv8 boxes, or None if the image has no label file.
+        """
+        old_label_path = os.path.join(self.sourcepath, 'labels', Path(image).stem + '.txt')
+
+        # skipping any files which don't have a corresponding label file
+        if not os.path.exists(old_label_path):
+            return None
+
+        img = Image.open(image)
+        img.load()
+        return (img, *read_labels(old_label_path))
+
+    def _augment_image(self, transforms, image, seed):
+        """
+        Augments a single image and its labels with every recipe and saves the results in the prefix directories.
 
-            # opening the image and assessing the size
-            img = Image.open(self._images[ix])
-            H, W = v2.functional.get_size(img)
+        Parameters
+        ----------
+        transforms : list[tuple[torchvision.transform, str]]
+            The (composed) transforms to be applied, together with their prefixes.
+        image : Path
+            Path to the image to be augmented.
+        seed : int
+            Seed used for the random parameters of every transform.
+
+        Returns
+        -------
+        bool
+            Whether augmented images have been written.
+        """
+        from torch import manual_seed
 
-            # opening the corresponding labels file and extracting the boundary boxes (converted from YOLOv8 format)
-            ids, boxes = [], []
-            with open(old_label_path) as file:
-                for bbox in file:
-                    id, x, y, w, h = bbox.split(' ')
-                    boxes.append(self.yolo_to_bbox(float(x), float(y), float(w), float(h), W, H))
-                    ids.append(id)
+        source = self._load_source(image)
+        if source is None:
+            return False
 
-            boxes = BoundingBoxes(Tensor(boxes), format="XYXY", canvas_size=(H, W))
+        img, ids, boxes = source
+        split_path = os.path.split(image)
+        for transform, prefix in transforms:
+            # splitting the path to create the image and label paths
+            image_path = os.path.join(split_path[0], prefix, prefix + '_' + split_path[1])
+            label_path = os.path.join(self.sourcepath, 'labels', prefix, prefix + '_' + Path(split_path[1]).stem + '.txt')
 
-            # applying the transformation on both the image and the boundary boxes
-            transformed_image, transformed_boxes = transform(img, boxes)
+            # applying the transformation on both the image and the boundary boxes,
+            # reseeding for every recipe so each one matches a separate run
+            manual_seed(seed)
+            transformed_image, transformed_boxes = augment_sample(transform, img, boxes)
 
             # saving the image inside the newly created directory
             transformed_image.save(image_path)
 
             # creating a new .txt file containing the new boundary boxes (YOLOv8 format)
-            with open(label_path, 'w') as label_file:
-                for id, box in zip(ids, transformed_boxes.tolist()):
-                    label_file.write(id)
-                    box = self.bbox_to_yolo(*box, W, H)
-                    for element in box:
-                        label_file.write(" " + f"{element:.8f}")
-                    label_file.write('\n')
+            write_labels(label_path, ids, transformed_boxes)
+
+        return True
+
+    def stream(self, augmentations, ratio=0.1):
+        """
+        Lazily yields augmented samples for the specified ratio of images, without writing anything to disk.
+
+        Uses the same per-image seeds as `apply_augmentations`, so the samples match the written ones.
+
+        Parameters
+        ----------
+        augmentations : list[str]
+            A list of all augmentations to be applied.
+        ratio : float, optional
+            The ratio of images to be augmented
+
+        Yields
+        ------
+        tuple[Path, PIL.Image, np.ndarray, np.ndarray]
+            The source image path, the augmented image, its class ids and its boxes in YOLOv8 format.
+        """
+        from torch import manual_seed
+        from torchvision.transforms import v2
+
+        transform = v2.Compose([self._augmentations[x] for x in sorted(set(augmentations))])
+
+        for image in self._images[:int(len(self._images) * ratio)]:
+            source = self._load_source(image)
+            if source is None:
+                continue
+
+            img, ids, boxes = source
+            manual_seed(self.image_seed(image))
+            transformed_image, transformed_boxes = augment_sample(transform, img, boxes)
+            yield image, transformed_image, ids, transformed_boxes
 
     def alter_augment(self, augment, parameter, value):
         """
@@ -176,7 +343,7 @@ class Image_Augmentor:
         """
         Shuffles the order in which the images will be chosen for augmentation.
         """
-        shuffle(self._images)
+        self._random.shuffle(self._images)
 
     def new_dir(self, destination):
         """
@@ -191,6 +358,20 @@ class Image_Augmentor:
         if not os.path.exists(folder_path):
             os.mkdir(folder_path)
 
+    def image_seed(self, image_path):
+        """
+        Derives the seed used for augmenting a single image from the base seed.
+
+        The seed only depends on the base seed and the path relative to the sourcepath,
+        not on the order in which (or the process by which) the image is augmented.
+
+        Parameters
+        ----------
+        image_path : Path
+            Path to the image.
+        """
+        return image_seed(self.seed, os.path.relpath(image_path, self.sourcepath))
+
     # converting the YOLO format to bounding boxes
     def yolo_to_bbox(self, x, y, w, h, W, H):
         """
@@ -242,13 +423,107 @@ class Image_Augmentor:
         return [x, y, w, h]
 
 
+class Online_Augmentor:
+    """
+    A class used for augmenting samples on the fly, e.g. inside the dataloader workers during training.
+
+    Uses the same transforms as the Image_Augmentor, but nothing is written to disk and
+    new random parameters are drawn every time a sample is loaded.
+
+    ...
+
+    Attributes
+    ----------
+    ratio : float
+        the probability with which a sample is augmented
+    transform : torchvision.transform
+        the composition of the chosen augmentations
+
+    Methods
+    -------
+    chosen(self):
+        Draws whether the next sample should be augmented.
+    __call__(self, img, boxes):
+        Applies the augmentations to an image and its boundary boxes.
+    """
+
+    def __init__(self, augmentations, ratio=0.1):
+        """
+        Parameters
+        ----------
+        augmentations : list[str]
+            A list of all augmentations to be applied.
+        ratio : float, optional
+            The probability with which a sample is augmented.
+        """
+        from torchvision.transforms import v2
+
+        available = build_augmentations()
+        unknown = set(augmentations) - set(available)
+        if unknown:
+            raise ValueError(f"Unknown augmentation(s): {', '.join(sorted(unknown))}")
+
+        self.ratio = ratio
+        self.transform = v2.Compose([available[x] for x in sorted(set(augmentations))])
+
+    def chosen(self):
+        """
+        Draws whether the next sample should be augmented, using the (per-worker seeded) torch generator.
+        """
+        from torch import rand
+
+        return rand(1).item() < self.ratio
+
+    def __call__(self, img, boxes):
+        """
+        Applies the augmentations to an image and its boundary boxes.
+
+        Parameters
+        ----------
+        img : Union[PIL.Image, torch.Tensor]
+            The image, either a PIL image or a (C, H, W) tensor.
+        boxes : np.ndarray
+            The boundary boxes of the image in YOLOv8 format, of shape (N, 4).
+        """
+        return augment_sample(self.transform, img, boxes)
+
+
+# per-process state of the augmentation workers, set once by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(augmentor, transforms):
+    from torch import set_num_threads
+
+    # one thread per process, the parallelism comes from the pool itself
+    set_num_threads(1)
+    _worker_state.update(augmentor=augmentor, transforms=transforms)
+
+
+def _augment_worker(job):
+    image_path, seed = job
+    return _worker_state['augmentor']._augment_image(_worker_state['transforms'], image_path, seed)
+
+
+def parse_recipe(recipe):
+    """
+    Parses a recipe of the form `[prefix=]augment[+augment...]` into an (augmentations, prefix) pair.
+    """
+    prefix, _, augments = recipe.rpartition('=')
+    return augments.split('+'), prefix.replace(" ", "") or None
+
+
 def main(args):
-    Augmentor = Image_Augmentor(args.sourcepath)
+    manifest = open_manifest(args.sourcepath, args.manifest, args.workers, args.refresh_manifest) if args.manifest else None
+    Augmentor = Image_Augmentor(args.sourcepath, seed=args.seed, manifest=manifest)
 
     # you can change the parameters of different augments here,
     # usage: Augmentor.alter_augment(<augment name>, <parameter name>, <new value>)
 
-    Augmentor.apply_augmentations(args.augments, prefix=args.prefix, ratio=args.ratio)
+    if args.recipes:
+        Augmentor.apply_recipes(args.recipes, ratio=args.ratio, workers=args.workers)
+    else:
+        Augmentor.apply_augmentations(args.augments, prefix=args.prefix, ratio=args.ratio, workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -257,17 +532,43 @@ if __name__ == "__main__":
                         help="the folder where the images folder resides (default: current directory)", )
     parser.add_argument('--prefix', type=str,
                         help="the prefix to be used for the the augmented images and the augmented image and label folders")
-    parser.add_argument('--augments', required=True, nargs='+',
-                        choices=['colorjitter', 'gaussian_blur', 'adjust_sharpness', 'posterize', 'random_rotation'],
-                        help="the type of augmentation to be applied to the images")
+    augments = parser.add_mutually_exclusive_group(required=True)
+    augments.add_argument('--augments', nargs='+', choices=AUGMENTATIONS,
+                          help="the type of augmentation to be applied to the images")
+    augments.add_argument('--recipes', nargs='+', type=parse_recipe,
+                          help="several augmentation recipes applied in a single pass, each of the form "
+                               "[prefix=]augment[+augment...], e.g. colorjitter blurred=gaussian_blur+posterize")
     parser.add_argument('--ratio', type=float, default=0.1,
                         help="the ratio of images on which the augmentation will be applied (default: 0.1)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the base seed from which every per-image seed is derived (default: 0)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used for augmenting the images (default: 1)")
+    parser.add_argument('--manifest', type=Path,
+                        help="a manifest built by dataset_manifest.py to list the images from")
+    parser.add_argument('--refresh-manifest', action='store_true',
+                        help="refresh the manifest even if no folder of the source changed, "
+                             "to pick up files rewritten in place")
     args = parser.parse_args()
 
-    args.augments = list(set(args.augments))
-    args.prefix = args.prefix.replace(" ", "")
+    if args.augments:
+        args.augments = list(set(args.augments))
+    if args.prefix:
+        args.prefix = args.prefix.replace(" ", "")
+    for augmentations, _ in args.recipes or []:
+        unknown = set(augmentations) - set(AUGMENTATIONS)
+        if unknown:
+            parser.error(f"unknown augmentation(s) in recipe: {', '.join(sorted(unknown))}")
     if not os.path.exists(os.path.join(args.sourcepath, 'images')):
         print(f"\nError\n-----\nNo 'images' folder found in path: {args.sourcepath}.\n")
         exit()
 
+    # only importing the heavy dependencies once the arguments are checked, so --help and mistakes return at once
+    try:
+        import torchvision
+        import tqdm
+    except ImportError as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
+
     main(args)
@@ -4,29 +4,58 @@
 Splits the dataset images into a training, validation and optional testing splits
 and saves the file paths to .txt files, to be used with the Ultralytics YOLO format.
 
+By default the images are shuffled randomly. With `--method hash` every image is
+assigned to a split by a stable hash of its path (or content), while streaming
+the directory walk, so memory stays constant and adding images never moves the
+existing ones to another split. `--stratify` additionally balances the class
+counts of the new images across the splits, keeping the existing assignments.
+
+With `--groups` the groups of near-duplicate images written by dedup_dataset.py
+are kept within a single split, so near-identical frames can't inflate the
+validation scores. With the hash method the existing assignments are kept then
+as well, and new images join the split their group already has, so regrouping
+after adding images never moves the existing ones.
+
 Usage: data_splitter.py [--sourcepath ./path] [--splits int [int... ]]
+                        [--method {random,hash}] [--hash-source {path,content}] [--stratify]
+                        [--manifest ./path] [--groups ./duplicate_groups.json]
 """
 
 import argparse
+import hashlib
+import json
 import numpy as np
 import os
 from pathlib import Path
 from random import shuffle
 
+from dataset_manifest import open_manifest
+from yolo_labels import label_path, read_labels
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+SPLIT_NAMES = ['train', 'val', 'test']
+
 
-def split_image_names(sourcepath, split):
+def split_image_names(sourcepath, split, manifest=None, groups=None):
 
-    images = []
-    for path, _, files in os.walk(sourcepath):
-        for name in files:
-            if name.endswith(('.png', '.jpg', '.jpeg')):
-                images.append(os.path.join('./', os.path.relpath(path, sourcepath), name))
+    images = list(list_images(sourcepath, manifest))
+    bounds = [int(len(images) * (split[0] / 100)), int(len(images) * ((split[0] + split[1]) / 100))]
 
-    # shuffle images and split threeways
-    shuffle(images)
-    return np.split(images, 
-                    [int(len(images) * (split[0] / 100)), 
-                     int(len(images) * ((split[0] + split[1]) / 100))])
+    if groups is None:
+        # shuffle images and split threeways
+        shuffle(images)
+        return np.split(images, bounds)
+
+    # shuffle whole groups of near-duplicates, every group goes to the split in which its first image falls
+    units = {}
+    for image in images:
+        units.setdefault(groups.get(image, image), []).append(image)
+    units = list(units.values())
+    shuffle(units)
+    starts = np.cumsum([0] + [len(unit) for unit in units[:-1]])
+    indices = np.searchsorted(bounds, starts, side='right')
+    return [[image for unit, index in zip(units, indices) if index == split_index for image in unit]
+            for split_index in range(3)]
 
 def write_txt_files(sourcepath, split_name, image_list):
     
@@ -36,13 +65,173 @@ def write_txt_files(sourcepath, split_name, image_list):
             file.write(image)
             file.write('\n')
 
+def scan_images(sourcepath, directory=None):
+    """
+    Lazily yields the paths of all images below the sourcepath, in the same
+    './relative/path' form as written to the .txt files.
+    """
+    directory = directory or sourcepath
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_images(sourcepath, entry.path)
+            elif entry.name.endswith(IMAGE_EXTENSIONS):
+                yield os.path.join('./', os.path.relpath(entry.path, sourcepath))
+
+def list_images(sourcepath, manifest=None):
+    """
+    Lazily yields the paths of all images below the sourcepath, from the manifest if one is given.
+    """
+    if manifest is None:
+        yield from scan_images(sourcepath)
+    else:
+        for path in manifest.images():
+            yield './' + path
+
+def hash_fraction(sourcepath, image, content=False, manifest=None):
+    """
+    Maps an image to a stable number in [0, 1), based on a hash of its relative path or its content.
+    The content hash is taken from the manifest if one is given.
+    """
+    if content and manifest is not None:
+        return int.from_bytes(bytes.fromhex(manifest.get(image)['sha1'])[:8], 'little') / 2 ** 64
+
+    digest = hashlib.sha1()
+    if content:
+        with open(os.path.join(sourcepath, image), 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        digest.update(Path(os.path.normpath(image)).as_posix().encode())
+    return int.from_bytes(digest.digest()[:8], 'little') / 2 ** 64
+
+def image_classes(sourcepath, image):
+    """
+    Returns the class ids in the label file of an image, which resides at the
+    same path as the image with the last 'images' folder replaced by 'labels'.
+    """
+    path = os.path.join(sourcepath, label_path(image))
+    if not os.path.exists(path):
+        return np.empty(0, dtype=np.int64)
+    return read_labels(path)[0]
+
+def read_groups(path):
+    """
+    Reads the groups of near-duplicates written by dedup_dataset.py and maps every grouped image to the
+    smallest path of its group, which doesn't depend on the order dedup_dataset.py lists the group in.
+    """
+    with open(path) as file:
+        groups = json.load(file)['groups']
+    return {image: min(group) for group in groups for image in group}
+
+def read_txt_files(sourcepath, names):
+    """
+    Returns the existing split assignments as a dict mapping every image path to its split index.
+    """
+    assignments = {}
+    for index, name in enumerate(names):
+        split_path = os.path.join(sourcepath, name + '.txt')
+        if os.path.exists(split_path):
+            with open(split_path) as file:
+                assignments.update((line.strip(), index) for line in file if line.strip())
+    return assignments
+
+def stream_split(sourcepath, split, content=False, stratify=False, manifest=None, groups=None):
+    """
+    Assigns every image to a split while streaming the directory walk and
+    writes the .txt files incrementally. Returns the number of images per split.
+
+    Without stratify an image goes to the split in which its hash fraction falls.
+    With stratify the existing assignments are kept and each new image goes to the
+    split that lacks most of the classes in its label file, ties broken by its hash.
+    With groups, mapping images to a key of their group of near-duplicates, the existing
+    assignments are kept as well, new images follow the split their group already has
+    and the images of new groups are hashed as the key of their group.
+    """
+    groups = groups or {}
+    group_splits = {}
+    names = SPLIT_NAMES[:len(split)]
+    fractions = np.array(split) / 100
+    bounds = np.cumsum(fractions)
+    counts = np.zeros(len(names), dtype=np.int64)
+
+    # the existing assignments never move with stratify or groups, as the class counts or the groups change
+    # when images are added
+    assignments = read_txt_files(sourcepath, names) if stratify or groups else {}
+    for image, index in assignments.items():
+        group_splits.setdefault(groups.get(image, image), index)
+
+    if stratify:
+        # class counts per split of the existing assignments
+        class_counts = np.zeros((len(names), 0), dtype=np.int64)
+        for image, index in assignments.items():
+            classes = image_classes(sourcepath, image)
+            class_counts = _grow_class_counts(class_counts, classes)
+            np.add.at(class_counts[index], classes, 1)
+
+    # writing to temporary files, replaced at the end so a failed run keeps the old splits
+    files = [open(os.path.join(sourcepath, name + '.txt.tmp'), 'w') for name in names]
+    try:
+        for image in list_images(sourcepath, manifest):
+            group = groups.get(image, image)
+            fraction = hash_fraction(sourcepath, group, content, manifest)
+            index = min(int(np.searchsorted(bounds, fraction, side='right')), len(names) - 1)
+
+            if image in assignments:
+                index = assignments[image]
+            elif group in group_splits:
+                index = group_splits[group]
+            elif stratify:
+                classes = image_classes(sourcepath, image)
+                if len(classes):
+                    class_counts = _grow_class_counts(class_counts, classes)
+                    totals = class_counts.sum(axis=0)[classes] + 1
+                    deficits = (fractions[:, None] * totals - class_counts[:, classes]).sum(axis=1)
+                    best = np.flatnonzero(np.isclose(deficits, deficits.max()))
+                    index = index if index in best else int(best[0])
+                    np.add.at(class_counts[index], classes, 1)
+            if groups:
+                group_splits.setdefault(group, index)
+
+            counts[index] += 1
+            files[index].write(image)
+            files[index].write('\n')
+    finally:
+        for file in files:
+            file.close()
+
+    for name in names:
+        os.replace(os.path.join(sourcepath, name + '.txt.tmp'), os.path.join(sourcepath, name + '.txt'))
+    # a test.txt of an earlier three-way split would be evaluated on with stale images
+    for name in SPLIT_NAMES[len(names):]:
+        if os.path.exists(os.path.join(sourcepath, name + '.txt')):
+            os.remove(os.path.join(sourcepath, name + '.txt'))
+
+    return dict(zip(names, counts.tolist()))
+
+def _grow_class_counts(class_counts, classes):
+    # adds columns to the (split, class) counts for class ids which haven't been seen yet
+    total = int(classes.max()) + 1 if len(classes) else 0
+    if total > class_counts.shape[1]:
+        class_counts = np.pad(class_counts, ((0, 0), (0, total - class_counts.shape[1])))
+    return class_counts
+
 def main(args):
 
+    manifest = open_manifest(args.sourcepath, args.manifest, refresh=args.refresh_manifest) if args.manifest else None
+    groups = read_groups(args.groups) if args.groups else None
+
+    if args.method == 'hash':
+        for name, count in stream_split(args.sourcepath, args.splits, content=args.hash_source == 'content',
+                                        stratify=args.stratify, manifest=manifest, groups=groups).items():
+            print(f"{name}.txt contains {count} items.")
+        return
+
     # split the total images based on given splits
-    splits = split_image_names(args.sourcepath, args.splits)
+    splits = split_image_names(args.sourcepath, args.splits, manifest, groups)
 
     # create txt files: train, val and test
-    for name, split in zip(['train', 'val', 'test'], splits):
+    for name, split in zip(SPLIT_NAMES, splits):
         print(f"{name}.txt contains {len(split)} items.")
         write_txt_files(args.sourcepath, name, split)
 
@@ -51,6 +240,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--sourcepath', type=Path, default='.', help="The folder where the images and labels folders reside (default: current directory).", )
     parser.add_argument('--splits', default=[70, 20, 10], nargs='+', type=int, help="The way the data should be split, into: training, validation and testing respectively. Testing split is optional")
+    parser.add_argument('--method', choices=['random', 'hash'], default='random', help="random: shuffle all images, hash: assign every image by a stable hash, so existing images never change split (default: random)")
+    parser.add_argument('--hash-source', choices=['path', 'content'], default='path', help="What the hash of the hash method is computed from (default: path)")
+    parser.add_argument('--manifest', type=Path, help="A manifest built by dataset_manifest.py to list the images from, instead of walking the source folder")
+    parser.add_argument('--refresh-manifest', action='store_true', help="Refresh the manifest even if no folder of the source changed, to pick up files rewritten in place")
+    parser.add_argument('--groups', type=Path, help="The duplicate_groups.json written by dedup_dataset.py, every group of near-duplicate images is kept within a single split. With the hash method the existing assignments are kept")
+    parser.add_argument('--stratify', action='store_true', help="With the hash method, keep existing assignments and balance the class counts of new images across the splits")
     args = parser.parse_args()
 
     if len(args.splits) < 2 or len(args.splits) > 3:
@@ -62,5 +257,8 @@ if __name__ == "__main__":
     if not os.path.exists(os.path.join(args.sourcepath, 'images')):
         print("\nError\n-\n\nNo 'images' folder found in source folder.\n\n-\nFor help execute: data_splitter.py --help")
         exit()
+    if args.stratify and args.method != 'hash':
+        print("\nError\n-\n\n--stratify requires --method hash.\n\n-\nFor help execute: data_splitter.py --help")
+        exit()
 
     main(args)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""
+Builds and queries a manifest of all images in a dataset.
+
+The manifest is a SQLite database (manifest.sqlite in the dataset folder by
+default) with a row for every image: its path relative to the dataset folder,
+file size, mtime, width and height (read from the image header, without
+decoding the image), SHA-1 content hash and number of labels. Refreshing the
+manifest only reads the images and label files whose size or mtime changed.
+
+The splitter, augmentor and filter accept a `--manifest` path to list the
+images from the manifest instead of walking the dataset. The manifest records
+the mtime of every folder of the dataset, opening it only refreshes it when a
+folder changed, so images that were added, removed or replaced are picked up
+without a stat per file. Files rewritten in place don't change their folder,
+refresh the manifest or pass `--refresh-manifest` after editing them.
+
+Usage: dataset_manifest.py refresh SOURCEPATH [--manifest ./path] [--workers int]
+       dataset_manifest.py info SOURCEPATH [--manifest ./path]
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+
+from PIL import Image
+
+from yolo_labels import label_path
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = 'manifest.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    sha1 TEXT NOT NULL,
+    label_count INTEGER,
+    label_size INTEGER,
+    label_mtime_ns INTEGER
+)
+'''
+
+DIRECTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+)
+'''
+
+
+def scan_files(sourcepath, directory=None):
+    """
+    Lazily yields (relative path, size, mtime) for every image below the sourcepath.
+    """
+    directory = directory or sourcepath
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_files(sourcepath, entry.path)
+            elif entry.name.endswith(IMAGE_EXTENSIONS):
+                stat = entry.stat()
+                yield Path(os.path.relpath(entry.path, sourcepath)).as_posix(), stat.st_size, stat.st_mtime_ns
+
+
+def scan_directories(sourcepath, directory=None):
+    """
+    Lazily yields (relative path, mtime) for the sourcepath and every folder below it.
+    """
+    directory = directory or sourcepath
+    yield Path(os.path.relpath(directory, sourcepath)).as_posix(), os.stat(directory).st_mtime_ns
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_directories(sourcepath, entry.path)
+
+
+def _label_state(sourcepath, path):
+    # the (size, mtime) of the label file of an image, or (None, None) if it has none
+    try:
+        stat = os.stat(os.path.join(sourcepath, label_path(path)))
+    except FileNotFoundError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_image_info(job):
+    """
+    Reads the dimensions, content hash and label count of a single image.
+    """
+    sourcepath, path, size, mtime_ns, label_size, label_mtime_ns = job
+    full_path = os.path.join(sourcepath, path)
+
+    digest = hashlib.sha1()
+    with open(full_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    # opening an image only parses its header, the pixels are never decoded here
+    try:
+        with Image.open(full_path) as img:
+            width, height = img.size
+    except OSError:
+        width, height = None, None
+
+    label_count = None
+    if label_size is not None:
+        with open(os.path.join(sourcepath, label_path(path))) as file:
+            label_count = sum(1 for line in file if line.strip())
+
+    return (path, size, mtime_ns, width, height, digest.hexdigest(), label_count, label_size, label_mtime_ns)
+
+
+class Dataset_Manifest:
+    """
+    A class used for building and querying the image manifest of a dataset.
+
+    ...
+
+    Attributes
+    ----------
+    sourcepath : Path
+        path to the dataset folder, all image paths are relative to it
+    manifest_path : Path
+        path to the SQLite database
+
+    Methods
+    -------
+    refresh(self, workers=1):
+        Brings the manifest up to date with the images and labels on disk.
+    changed(self):
+        Returns whether a folder of the dataset changed since the last refresh.
+    images(self, directory=None, recursive=True):
+        Returns the relative paths of the images in the manifest.
+    get(self, path):
+        Returns the manifest row of an image as a dict.
+    image_size(self, path):
+        Returns the (width, height) of an image.
+    summary(self):
+        Returns the number of images, the number of images with a label file and the total number of labels.
+    """
+
+    def __init__(self, sourcepath, manifest_path=None):
+        """
+        Parameters
+        ----------
+        sourcepath : Path
+            path to the dataset folder
+        manifest_path : Path, optional
+            path to the SQLite database (default: SOURCEPATH/manifest.sqlite)
+        """
+        self.sourcepath = sourcepath
+        self.manifest_path = manifest_path or os.path.join(sourcepath, MANIFEST_NAME)
+        self._connection = sqlite3.connect(self.manifest_path)
+        # a persistent journal doesn't create and delete a file in the dataset folder on every write,
+        # which would change the folder mtimes recorded by `refresh`
+        self._connection.execute('PRAGMA journal_mode=PERSIST')
+        self._connection.execute(SCHEMA)
+        self._connection.execute(DIRECTORY_SCHEMA)
+
+    def refresh(self, workers=1):
+        """
+        Brings the manifest up to date with the images and labels on disk.
+
+        Only images (or label files) whose size or mtime differ from the manifest are read again,
+        images which no longer exist are removed. Returns the number of updated and removed images.
+        """
+        # the folders are stat'ed before the files, a folder changing during the scan is refreshed next time
+        directories = list(scan_directories(self.sourcepath))
+        known = {row[0]: row[1:] for row in self._connection.execute(
+            'SELECT path, size, mtime_ns, label_size, label_mtime_ns FROM images')}
+
+        jobs, seen = [], set()
+        for path, size, mtime_ns in scan_files(self.sourcepath):
+            seen.add(path)
+            state = (size, mtime_ns, *_label_state(self.sourcepath, path))
+            if known.get(path) != state:
+                jobs.append((self.sourcepath, path, *state))
+
+        if workers > 1 and len(jobs) > 1:
+            with Pool(workers) as pool:
+                rows = pool.map(read_image_info, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+        else:
+            rows = [read_image_info(job) for job in jobs]
+
+        removed = [(path,) for path in known.keys() - seen]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._connection.executemany('DELETE FROM images WHERE path = ?', removed)
+            self._connection.execute('DELETE FROM directories')
+            self._connection.executemany('INSERT INTO directories VALUES (?, ?)', directories)
+
+        return len(rows), len(removed)
+
+    def changed(self):
+        """
+        Returns whether a folder of the dataset changed since the last refresh.
+
+        Adding, removing or renaming a file changes the mtime of its folder, this only stats the folders.
+        """
+        known = dict(self._connection.execute('SELECT path, mtime_ns FROM directories'))
+        return known != dict(scan_directories(self.sourcepath))
+
+    def images(self, directory=None, recursive=True):
+        """
+        Returns the sorted relative paths of the images in the manifest.
+
+        Parameters
+        ----------
+        directory : str, optional
+            Only return images inside this folder, relative to the sourcepath.
+        recursive : bool, optional
+            Whether to include images in subfolders of the directory.
+        """
+        paths = [row[0] for row in self._connection.execute('SELECT path FROM images ORDER BY path')]
+        if directory is None:
+            return paths
+
+        directory = Path(directory).as_posix().strip('/')
+        prefix = directory + '/' if directory not in ('', '.') else ''
+        return [path for path in paths if path.startswith(prefix)
+                and (recursive or '/' not in path[len(prefix):])]
+
+    def get(self, path):
+        """
+        Returns the manifest row of an image as a dict, or None if the image is not in the manifest.
+        """
+        cursor = self._connection.execute('SELECT * FROM images WHERE path = ?',
+                                          (Path(os.path.normpath(path)).as_posix(),))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def image_size(self, path):
+        """
+        Returns the (width, height) of an image, as read from its header.
+        """
+        row = self.get(path)
+        return (row['width'], row['height']) if row else None
+
+    def summary(self):
+        """
+        Returns the number of images, the number of images with a label file and the total number of labels.
+        """
+        total, labelled, labels = self._connection.execute(
+            'SELECT COUNT(*), COUNT(label_count), TOTAL(label_count) FROM images').fetchone()
+        return total, labelled, int(labels)
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+def open_manifest(sourcepath, manifest_path=None, workers=1, refresh=False):
+    """
+    Opens the manifest of a dataset, refreshing it when a folder of the dataset changed or refresh is set.
+    """
+    manifest = Dataset_Manifest(sourcepath, manifest_path)
+    if refresh or manifest.changed():
+        updated, removed = manifest.refresh(workers=workers)
+        if updated or removed:
+            print(f"Refreshed the manifest, updated {updated} and removed {removed} images.")
+    return manifest
+
+
+def main(args):
+    manifest = Dataset_Manifest(args.sourcepath, args.manifest)
+
+    if args.command == 'refresh':
+        updated, removed = manifest.refresh(workers=args.workers)
+        print(f"Updated {updated} and removed {removed} images, the manifest contains {len(manifest)} images.")
+    else:
+        total, labelled, labels = manifest.summary()
+        print(f"{total} images, {labelled} with a label file, {labels} labels in total.")
+
+    manifest.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['refresh', 'info'],
+                        help="refresh: (incrementally) update the manifest, info: print a summary")
+    parser.add_argument('sourcepath', type=Path,
+                        help="the dataset folder, with images and labels folders")
+    parser.add_argument('--manifest', type=Path,
+                        help=f"the manifest database (default: SOURCEPATH/{MANIFEST_NAME})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used for reading changed images (default: 1)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sourcepath):
+        print(f"\nError\n-----\nDataset folder not found: {args.sourcepath}.\n")
+        exit(1)
+
+    main(args)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Finds near-duplicate images, like consecutive frames of a video, by their
+perceptual hash and groups or prunes them.
+
+A 64-bit DCT perceptual hash is computed for every image in parallel and kept
+bit-packed in SOURCEPATH/.phash (hashes.npy with one 8 byte row per image and
+index.json), which is updated incrementally by size and mtime. Near-duplicates
+are the pairs of images whose hashes differ in at most --threshold bits. They
+are found by a blocked, vectorized XOR and popcount over all pairs and joined
+into groups by a vectorized label propagation, so no Python loop runs over the
+pairs of images.
+
+- groups: writes the groups to SOURCEPATH/duplicate_groups.json, which
+  data_splitter.py --groups uses to keep every group within a single split,
+  and reports the groups which the existing split files spread over several splits.
+- prune: links one image of every group (and all images without duplicates)
+  with their labels into DESTINATION, using hardlinks where possible.
+
+Usage: dedup_dataset.py groups SOURCEPATH [--threshold int] [--workers int]
+       dedup_dataset.py prune SOURCEPATH DESTINATION [--threshold int] [--workers int] [--link {auto,hard,reflink,copy}]
+"""
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+try:
+    import cv2
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+from data_splitter import SPLIT_NAMES, read_txt_files, scan_images
+from filter_dataset import link_file
+from yolo_labels import label_path
+
+INDEX_DIR = '.phash'
+INDEX_VERSION = 1
+GROUPS_NAME = 'duplicate_groups.json'
+HASH_BYTES = 8
+
+# the number of set bits of every byte, for numpy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def perceptual_hash(path):
+    """
+    Returns the 64-bit DCT perceptual hash of an image as 8 packed bytes, or None if it can't be read.
+
+    The image is decoded at a reduced size, scaled to 32x32 and the signs of its 8x8 lowest
+    frequencies relative to their median form the hash.
+    """
+    im = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if im is None:
+        return None
+    im = cv2.resize(im, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(im)[:8, :8]
+    return np.packbits(low > np.median(low))
+
+
+def _hash_worker(job):
+    sourcepath, image = job
+    return image, perceptual_hash(os.path.join(sourcepath, image))
+
+
+def build_index(sourcepath, workers=1):
+    """
+    Brings the hash index of the sourcepath up to date and returns the image paths and their (N, 8) packed hashes.
+
+    Only images which are new or whose size or mtime changed are hashed again.
+    """
+    index_dir = os.path.join(sourcepath, INDEX_DIR)
+    os.makedirs(index_dir, exist_ok=True)
+
+    known = {}
+    if os.path.exists(os.path.join(index_dir, 'index.json')):
+        with open(os.path.join(index_dir, 'index.json')) as file:
+            index = json.load(file)
+        if index['version'] == INDEX_VERSION:
+            hashes = np.load(os.path.join(index_dir, 'hashes.npy'))
+            known = {image: (state, hashes[row]) for row, (image, state) in enumerate(zip(index['images'],
+                                                                                          index['states']))}
+
+    states, jobs = {}, []
+    for image in scan_images(sourcepath):
+        stat = os.stat(os.path.join(sourcepath, image))
+        states[image] = [stat.st_size, stat.st_mtime_ns]
+        if image not in known or known[image][0] != states[image]:
+            jobs.append((sourcepath, image))
+
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            results = pool.map(_hash_worker, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+    else:
+        results = [_hash_worker(job) for job in jobs]
+
+    computed = dict(results)
+    images, hashes = [], []
+    for image in sorted(states):
+        value = computed[image] if image in computed else known[image][1]
+        if value is None:
+            print(f"Skipping unreadable image: {image}")
+            continue
+        images.append(image)
+        hashes.append(value)
+
+    hashes = np.array(hashes, dtype=np.uint8).reshape(-1, HASH_BYTES)
+    np.save(os.path.join(index_dir, 'hashes.npy'), hashes)
+    with open(os.path.join(index_dir, 'index.json'), 'w') as file:
+        json.dump({'version': INDEX_VERSION, 'images': images, 'states': [states[image] for image in images]}, file)
+
+    print(f"Hashed {len(jobs)} new or changed images, the index contains {len(images)} images")
+    return images, hashes
+
+
+def popcount(values):
+    """
+    Returns the number of set bits of every element of a uint64 array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(np.uint8)].reshape(*values.shape, 8).sum(axis=-1)
+
+
+def near_duplicate_pairs(hashes, threshold, block_elements=1 << 22):
+    """
+    Returns the (i, j) pairs, i < j, of hashes which differ in at most threshold bits, as two arrays.
+
+    The hashes are compared a block of rows at a time against all later rows, which keeps the
+    memory bounded by block_elements distances while numpy does all the work.
+    """
+    values = np.ascontiguousarray(hashes).view(np.uint64).ravel()
+    rows = max(1, block_elements // max(1, len(values)))
+
+    first, second = [], []
+    for start in range(0, len(values), rows):
+        block = values[start:start + rows]
+        # within the block only the pairs above the diagonal, every pair once and never an image with itself
+        i, j = np.nonzero(np.triu(popcount(block[:, None] ^ block[None, :]) <= threshold, k=1))
+        first.append(i + start)
+        second.append(j + start)
+
+        i, j = np.nonzero(popcount(block[:, None] ^ values[None, start + len(block):]) <= threshold)
+        first.append(i + start)
+        second.append(j + start + len(block))
+
+    if not first:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(first), np.concatenate(second)
+
+
+def group_pairs(count, first, second):
+    """
+    Joins the pairs into groups of connected images and returns the groups of two or more as lists of indices.
+
+    Every image is labelled with the smallest index it is connected to, by hooking the labels of the two images
+    of every pair onto the smaller one and flattening the labels, vectorized over all pairs, until no label
+    changes. Every round at least halves the label chains, so only a few rounds run.
+    """
+    labels = np.arange(count)
+    while True:
+        previous = labels
+        low = np.minimum(labels[first], labels[second])
+        labels = labels.copy()
+        np.minimum.at(labels, labels[first], low)
+        np.minimum.at(labels, labels[second], low)
+        # pointer jumping, until every image points at the root of its group
+        while not np.array_equal(labels[labels], labels):
+            labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+
+    order = np.argsort(labels, kind='stable')
+    _, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+    return [order[start:start + size].tolist() for start, size in zip(starts, sizes) if size > 1]
+
+
+def find_groups(sourcepath, threshold, workers=1):
+    """
+    Returns the groups of near-duplicate images of the sourcepath as sorted lists of './relative' image paths.
+    """
+    images, hashes = build_index(sourcepath, workers)
+    first, second = near_duplicate_pairs(hashes, threshold)
+    return [[images[index] for index in group] for group in group_pairs(len(images), first, second)]
+
+
+def split_leaks(sourcepath, groups):
+    """
+    Returns the groups whose images are spread over several of the existing split files.
+    """
+    assignments = read_txt_files(sourcepath, SPLIT_NAMES)
+    return [group for group in groups if len({assignments.get(image) for image in group} - {None}) > 1]
+
+
+def prune(sourcepath, destination, groups, method='auto'):
+    """
+    Links the first image of every group, all images without near-duplicates and their labels into destination.
+
+    Returns the number of linked and pruned images.
+    """
+    pruned = {image for group in groups for image in group[1:]}
+    kept = 0
+    for image in scan_images(sourcepath):
+        if image in pruned:
+            continue
+        for path in (image, label_path(image)):
+            if os.path.exists(os.path.join(sourcepath, path)):
+                os.makedirs(os.path.dirname(os.path.join(destination, path)), exist_ok=True)
+                link_file(os.path.join(sourcepath, path), os.path.join(destination, path), method)
+        kept += 1
+    return kept, len(pruned)
+
+
+def main(args):
+    groups = find_groups(args.sourcepath, args.threshold, args.workers)
+    duplicates = sum(len(group) - 1 for group in groups)
+    print(f"Found {len(groups)} groups of near-duplicates, {duplicates} images are a near-duplicate of another.")
+
+    if args.command == 'groups':
+        with open(os.path.join(args.sourcepath, GROUPS_NAME), 'w') as file:
+            json.dump({'threshold': args.threshold, 'groups': groups}, file, indent=1)
+        print(f"Groups written to {os.path.join(args.sourcepath, GROUPS_NAME)}, "
+              f"pass it to data_splitter.py --groups to keep every group within one split.")
+
+        leaks = split_leaks(args.sourcepath, groups)
+        if leaks:
+            print(f"{len(leaks)} groups are spread over several of the current splits, "
+                  f"e.g. {', '.join(leaks[0][:3])}.")
+    else:
+        kept, pruned = prune(args.sourcepath, args.destination, groups, args.link)
+        print(f"Linked {kept} images into {args.destination}, pruned {pruned} near-duplicates.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['groups', 'prune'],
+                        help="groups: write the groups of near-duplicates for data_splitter.py, "
+                             "prune: build a dataset with one image per group")
+    parser.add_argument('sourcepath', type=Path,
+                        help="the dataset folder, with images and labels folders")
+    parser.add_argument('destination', type=Path, nargs='?',
+                        help="the folder the pruned dataset is created in (prune only)")
+    parser.add_argument('--threshold', type=int, default=6,
+                        help="the maximum number of differing hash bits of near-duplicates (default: 6)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="the number of processes used for hashing (default: all cores)")
+    parser.add_argument('--link', choices=['auto', 'hard', 'reflink', 'copy'], default='auto',
+                        help="how pruned images are created in the destination (default: auto)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sourcepath):
+        print(f"\nError\n-----\nDataset folder not found: {args.sourcepath}.\n")
+        exit(1)
+    if args.command == 'prune' and args.destination is None:
+        print(f"\nError\n-----\nprune requires a DESTINATION.\n")
+        exit(1)
+
+    main(args)
@@ -0,0 +1,140 @@
+"""
+The dataset and trainer train.py trains with when it needs more than the
+ultralytics defaults: online augmentation, the shard cache or a time budget.
+
+Kept apart from train.py, so train.py can parse its arguments before importing
+ultralytics and torch, which takes seconds.
+"""
+
+import time
+
+import numpy as np
+import torch
+from torchvision import tv_tensors
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import LOGGER, colorstr
+from ultralytics.utils.instance import Instances
+
+
+class DNTDataset(YOLODataset):
+    """
+    YOLO training dataset with the optional speedups and augmentations of this repository.
+
+    - online_augmentor: applies the data_augmentor.py augmentations when an image
+      is loaded, i.e. inside the dataloader workers and before the ultralytics
+      mosaic/mixup transforms, so no augmented images are ever written to disk.
+    - shard_cache: reads the images pre-decoded and pre-resized from the
+      memory-mapped shards of scripts/shard_cache.py instead of decoding them.
+    """
+
+    def __init__(self, *args, online_augmentor=None, shard_cache=None, **kwargs):
+        self.online_augmentor = online_augmentor
+        imgsz = kwargs.get('imgsz', 640)
+        if shard_cache is not None and shard_cache.imgsz != imgsz:
+            # the shards would serve images of the wrong size, i.e. a resumed run at another --imgsz
+            LOGGER.warning(f"{colorstr('shard cache:')} built at imgsz={shard_cache.imgsz}, not {imgsz}, "
+                           'decoding the images instead')
+            shard_cache = None
+        self.shard_cache = shard_cache
+        super().__init__(*args, **kwargs)
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        # the shards hold images resized like rect_mode, anything else is left to ultralytics
+        if self.shard_cache is None or self.ims[i] is not None or not rect_mode or kwargs.get('resize_short'):
+            return super().load_image(i, rect_mode, **kwargs)
+
+        cached = self.shard_cache.get(self.im_files[i])
+        if cached is None:
+            return super().load_image(i, rect_mode, **kwargs)
+
+        # same buffer bookkeeping as BaseDataset.load_image, the mosaic samples from the buffer
+        im, (h0, w0) = cached
+        if self.augment:
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                if self.cache != 'ram':
+                    self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+
+        return im, (h0, w0), im.shape[:2]
+
+    def get_image_and_label(self, index):
+        label = super().get_image_and_label(index)
+        if self.online_augmentor is None or not self.online_augmentor.chosen():
+            return label
+
+        # ultralytics loads (H, W, C) BGR images with normalized xywh boxes,
+        # the torchvision transforms expect (C, H, W) RGB images.
+        instances = label['instances']
+        img = torch.from_numpy(np.ascontiguousarray(label['img'][..., ::-1])).permute(2, 0, 1)
+        img, boxes = self.online_augmentor(tv_tensors.Image(img), instances.bboxes)
+
+        label['img'] = np.ascontiguousarray(img.permute(1, 2, 0).numpy()[..., ::-1])
+        label['instances'] = Instances(boxes.astype(np.float32), instances.segments, instances.keypoints,
+                                       bbox_format='xywh', normalized=True)
+        return label
+
+
+class DNTTrainer(DetectionTrainer):
+    """
+    Detection trainer which builds its training dataset as a DNTDataset.
+
+    Set `online_augmentor` and/or `shard_cache` before passing the class to `model.train(trainer=...)`.
+    With a `deadline` (a time.time() timestamp) training stops after the last epoch which is
+    expected to finish before it, leaving a last.pt which can be resumed.
+    """
+
+    online_augmentor = None
+    shard_cache = None
+    deadline = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget_stopped = False
+        self._epoch_times = []
+        if self.deadline is not None:
+            self.add_callback('on_fit_epoch_end', self._check_deadline)
+
+    def _check_deadline(self, trainer):
+        # runs after the epoch has been validated and saved, right before the trainer checks self.stop
+        self._epoch_times.append(self.epoch_time)
+        if self.stop or self.deadline - time.time() >= np.mean(self._epoch_times):
+            return
+
+        self.stop = self.budget_stopped = True
+        LOGGER.info(f'Stopping after epoch {self.epoch + 1}/{self.epochs}, the next epoch would exceed the time '
+                    f'budget. Continue with --resume {self.save_dir}')
+
+    def final_eval(self):
+        # the final evaluation strips the optimizer from last.pt, which would make it impossible to resume
+        if self.budget_stopped:
+            return
+        super().final_eval()
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        if mode != 'train' or (self.online_augmentor is None and self.shard_cache is None):
+            return super().build_dataset(img_path, mode, batch)
+
+        # DDP wraps the model, the stride lives on the wrapped module
+        model = getattr(self.model, 'module', self.model)
+        stride = max(int(model.stride.max() if model else 0), 32)
+        return DNTDataset(
+            online_augmentor=self.online_augmentor,
+            shard_cache=self.shard_cache,
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=True,
+            hyp=self.args,
+            rect=self.args.rect,
+            cache=self.args.cache or None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0,
+            prefix=colorstr(f'{mode}: '),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""
+Filters the labels of a dataset by class and box size and builds a new dataset
+containing only the images that still have labels left.
+
+The source is either a dataset folder with (nested) 'images' and 'labels'
+folders, or a flat folder with the label files next to the images, like
+'Dataset_maker_faire'. Kept images are hardlinked or reflinked into the
+destination where the filesystem supports it, and only copied otherwise.
+
+A manifest in the destination records the state of every filtered file, so
+re-running the same filter only processes new or changed files. With
+--label-store the class and box checks run on the packed label store of the
+source (see label_store.py), which is updated first: all boxes of the dataset
+are checked in one vectorized pass and only the label files of kept images are
+parsed.
+
+Usage: filter_dataset.py SOURCE DESTINATION [--keep int [int... ]] [--drop int [int... ]]
+                         [--remap old:new [old:new... ]] [--min-size float] [--link {auto,hard,reflink,copy}]
+                         [--workers int] [--manifest ./path] [--label-store]
+"""
+
+import argparse
+import errno
+import json
+import os
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from dataset_manifest import open_manifest
+from label_store import Label_Store, build_store, default_store_path
+from yolo_labels import read_labels, write_labels
+
+MANIFEST_NAME = '.filter_manifest.json'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# linux ioctl for cloning the extents of a file (reflink), supported by e.g. btrfs and xfs
+FICLONE = 0x40049409
+
+
+class Label_Filter:
+    """
+    A class used for filtering the boxes of a label file.
+
+    The keep and drop predicates are applied to the original class ids, the remapping afterwards.
+
+    ...
+
+    Attributes
+    ----------
+    keep : set[int] or None
+        class ids to keep, all classes are kept if None
+    drop : set[int]
+        class ids to drop
+    remap : dict[int, int]
+        maps an original class id to a new class id
+    min_size : float
+        minimum normalized width and height of a box
+
+    Methods
+    -------
+    __call__(self, ids, boxes):
+        Returns the filtered (and remapped) class ids and boxes.
+    mask(self, ids, boxes):
+        Returns which boxes pass the filter.
+    signature(self):
+        Returns a description of the filter used to detect changed filters between runs.
+    """
+
+    def __init__(self, keep=None, drop=(), remap=None, min_size=0.):
+        self.keep = set(keep) if keep is not None else None
+        self.drop = set(drop)
+        self.remap = dict(remap or {})
+        self.min_size = min_size
+
+    def __call__(self, ids, boxes):
+        mask = self.mask(ids, boxes)
+        ids, boxes = ids[mask], boxes[mask]
+        remapped = ids.copy()
+        for old, new in self.remap.items():
+            remapped[ids == old] = new
+        return remapped, boxes
+
+    def mask(self, ids, boxes):
+        mask = ~np.isin(ids, list(self.drop))
+        if self.keep is not None:
+            mask &= np.isin(ids, list(self.keep))
+        if self.min_size > 0:
+            mask &= (boxes[:, 2] >= self.min_size) & (boxes[:, 3] >= self.min_size)
+        return mask
+
+    def signature(self):
+        return {'keep': sorted(self.keep) if self.keep is not None else None,
+                'drop': sorted(self.drop),
+                'remap': [list(pair) for pair in sorted(self.remap.items())],
+                'min_size': self.min_size}
+
+
+def link_file(source, destination, method='auto'):
+    """
+    Creates destination as a hardlink, reflink or copy of source.
+
+    With method 'auto' a hardlink is tried first, then a reflink and finally a copy.
+    Returns the method that has been used.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if method in ('auto', 'hard'):
+        try:
+            os.link(source, destination)
+            return 'hard'
+        except OSError:
+            if method == 'hard':
+                raise
+
+    if method in ('auto', 'reflink') and fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError as e:
+            # opening the source or destination may have failed before the destination was created
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if method == 'reflink' or e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                raise
+
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+def labels_folder(sourcepath):
+    """
+    Returns the folder of the label files of a dataset: its 'labels' folder, or the dataset itself if it is flat.
+    """
+    nested = os.path.isdir(os.path.join(sourcepath, 'images'))
+    return os.path.join(sourcepath, 'labels') if nested else str(sourcepath)
+
+
+def find_images(sourcepath, manifest=None):
+    """
+    Yields (image path, label path, relative path) for every image in the source, searched recursively
+    or listed from the manifest if one is given.
+
+    If the source has an 'images' folder, the labels are expected at the same relative
+    path inside the 'labels' folder, otherwise next to the images.
+    """
+    images_dir = os.path.join(sourcepath, 'images')
+    nested = os.path.isdir(images_dir)
+    root_dir = images_dir if nested else sourcepath
+    labels_dir = labels_folder(sourcepath)
+
+    if manifest is not None:
+        paths = [os.path.join(sourcepath, path) for path in manifest.images('images' if nested else None)]
+    else:
+        paths = (os.path.join(root, name) for root, _, files in os.walk(root_dir)
+                 for name in sorted(files) if name.endswith(IMAGE_EXTENSIONS))
+
+    for path in paths:
+        relative_path = os.path.relpath(path, root_dir)
+        label_path = os.path.join(labels_dir, os.path.splitext(relative_path)[0] + '.txt')
+        yield path, label_path, relative_path
+
+
+def _file_state(image_path, label_path):
+    # the size and mtime of both files, used to detect changed files between runs
+    image_stat = os.stat(image_path)
+    try:
+        label_stat = os.stat(label_path)
+    except FileNotFoundError:
+        return [image_stat.st_size, image_stat.st_mtime_ns, None, None]
+    return [image_stat.st_size, image_stat.st_mtime_ns, label_stat.st_size, label_stat.st_mtime_ns]
+
+
+def _output_paths(destination, relative_path):
+    return (os.path.join(destination, 'images', relative_path),
+            os.path.join(destination, 'labels', os.path.splitext(relative_path)[0] + '.txt'))
+
+
+def _remove_output(destination, relative_path):
+    for path in _output_paths(destination, relative_path):
+        if os.path.lexists(path):
+            os.remove(path)
+
+
+def filter_image(job, label_filter, destination, method):
+    """
+    Filters the labels of a single image and links the image into the destination if any are left.
+    The last field of the job is True if a label store has shown that no labels are left, the
+    label file is not read then.
+
+    Returns the relative path and whether the image has been kept.
+    """
+    image_path, label_path, relative_path, dropped = job
+    out_image, out_label = _output_paths(destination, relative_path)
+
+    if not dropped and os.path.exists(label_path):
+        ids, boxes = label_filter(*read_labels(label_path))
+    else:
+        ids, boxes = np.empty(0, dtype=np.int64), None
+
+    if len(ids) == 0:
+        # removing the output of an earlier run in which this image was still kept
+        _remove_output(destination, relative_path)
+        return relative_path, False
+
+    os.makedirs(os.path.dirname(out_image), exist_ok=True)
+    os.makedirs(os.path.dirname(out_label), exist_ok=True)
+    link_file(image_path, out_image, method)
+    write_labels(out_label, ids, boxes)
+    return relative_path, True
+
+
+# per-process state of the filter workers, set once by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(label_filter, destination, method):
+    _worker_state.update(label_filter=label_filter, destination=destination, method=method)
+
+
+def _filter_worker(job):
+    return filter_image(job, _worker_state['label_filter'], _worker_state['destination'], _worker_state['method'])
+
+
+def store_labels(sourcepath, label_filter, jobs, workers=1):
+    """
+    Checks the boxes of the whole dataset at once in the label store of the source, which is updated first.
+
+    Returns the jobs with the images without any boxes left marked as dropped, so their label files are
+    not read. The label files of the kept images are still filtered one by one, as the store only holds
+    float32 coordinates.
+    """
+    labels_dir = labels_folder(sourcepath)
+    store_path = default_store_path(labels_dir)
+    build_store(labels_dir, store_path, workers)
+    store = Label_Store(store_path)
+
+    classes, boxes = np.asarray(store.classes), np.asarray(store.boxes)
+    left = np.bincount(store.image_indices()[label_filter.mask(classes, boxes)], minlength=len(store))
+    positions = {key: position for position, key in enumerate(store.keys)}
+
+    marked = []
+    for image_path, label_path, relative_path, _ in jobs:
+        position = positions.get(store.key(label_path))
+        marked.append((image_path, label_path, relative_path, position is None or not left[position]))
+    return marked
+
+
+def filter_dataset(sourcepath, destination, label_filter, method='auto', workers=1, manifest=None,
+                   label_store=False):
+    """
+    Filters a dataset into the destination, only processing files which are new or changed since the last run.
+    With label_store the labels are read from the label store of the source instead of the label files.
+
+    Returns the number of processed and the number of kept images.
+    """
+    manifest_path = os.path.join(destination, MANIFEST_NAME)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            previous = json.load(file)
+
+    # a different filter invalidates every earlier result
+    files = previous.get('files', {}) if previous.get('filter') == label_filter.signature() else {}
+
+    jobs, states = [], {}
+    for image_path, label_path, relative_path in find_images(sourcepath, manifest):
+        state = _file_state(image_path, label_path)
+        states[relative_path] = state
+        entry = files.get(relative_path)
+        if entry is None or entry['state'] != state:
+            jobs.append((image_path, label_path, relative_path, False))
+
+    # removing the output of images which no longer exist in the source
+    for relative_path in set(files) - set(states):
+        if files[relative_path]['kept']:
+            _remove_output(destination, relative_path)
+        del files[relative_path]
+
+    Path(destination, 'images').mkdir(parents=True, exist_ok=True)
+    Path(destination, 'labels').mkdir(parents=True, exist_ok=True)
+
+    if label_store and jobs:
+        jobs = store_labels(sourcepath, label_filter, jobs, workers)
+
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(label_filter, destination, method)) as pool:
+            results = pool.map(_filter_worker, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+    else:
+        results = [filter_image(job, label_filter, destination, method) for job in jobs]
+
+    for relative_path, kept in results:
+        files[relative_path] = {'state': states[relative_path], 'kept': kept}
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'filter': label_filter.signature(), 'files': files}, file)
+    os.replace(tmp_path, manifest_path)
+
+    return len(jobs), sum(entry['kept'] for entry in files.values())
+
+
+def parse_remap(value):
+    old, new = value.split(':')
+    return int(old), int(new)
+
+
+def main(args):
+    label_filter = Label_Filter(keep=args.keep, drop=args.drop or (), remap=dict(args.remap or []),
+                                min_size=args.min_size)
+    manifest = open_manifest(args.sourcepath, args.manifest, args.workers, args.refresh_manifest) if args.manifest else None
+    processed, kept = filter_dataset(args.sourcepath, args.destination, label_filter,
+                                     method=args.link, workers=args.workers, manifest=manifest,
+                                     label_store=args.label_store)
+    print(f"Processed {processed} new or changed images, {kept} images kept in {args.destination}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sourcepath', type=Path,
+                        help="the dataset folder, with images and labels folders or with the labels next to the images")
+    parser.add_argument('destination', type=Path,
+                        help="the folder in which the filtered images and labels folders are created")
+    parser.add_argument('--keep', nargs='+', type=int,
+                        help="the class ids to keep (default: all)")
+    parser.add_argument('--drop', nargs='+', type=int,
+                        help="the class ids to drop")
+    parser.add_argument('--remap', nargs='+', type=parse_remap,
+                        help="class ids to change after filtering, as old:new pairs")
+    parser.add_argument('--min-size', type=float, default=0.,
+                        help="the minimum normalized width and height of a box (default: 0)")
+    parser.add_argument('--link', choices=['auto', 'hard', 'reflink', 'copy'], default='auto',
+                        help="how kept images are placed in the destination (default: auto, "
+                             "a hardlink, else a reflink, else a copy)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used for filtering (default: 1)")
+    parser.add_argument('--manifest', type=Path,
+                        help="a manifest built by dataset_manifest.py to list the images from")
+    parser.add_argument('--refresh-manifest', action='store_true',
+                        help="refresh the manifest even if no folder of the source changed, "
+                             "to pick up files rewritten in place")
+    parser.add_argument('--label-store', action='store_true',
+                        help="check the classes and boxes in the label store of the source (LABELS_DIR.store), "
+                             "which is built or updated first")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sourcepath):
+        print(f"\nError\n-----\nSource folder not found: {args.sourcepath}.\n")
+        exit(1)
+
+    main(args)
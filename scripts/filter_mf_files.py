@@ -16,55 +16,29 @@ robot           369        210      0.387      0.138      0.105      0.054
 goal_post       369         32          0          0          0          0
 pen_spot        369         26          0          0    0.00947     0.0036
 
+The per-class image and instance counts can be computed without a training run
+using `./scripts/label_store.py stats LABELS_DIR`, and the metrics of a trained
+model on only the ball and robot classes without training again using
+`./evaluate.py --weights WEIGHTS --train-config config/train_mf.yaml --classes ball,robot`.
+
 Usage: ./scripts/filter_mf_files.py DATASET_MAKER_FAIRE_PATH
+
+This is a shorthand for `./scripts/filter_dataset.py DATASET_MAKER_FAIRE_PATH data_cleaned --keep 0 1`.
 """
 
-import sys
-from os import listdir
+import argparse
 from os.path import join
-from pathlib import Path
-from shutil import copyfile
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f'Usage: {sys.argv[0]} DATASET_MAKER_FAIRE_PATH')
-        sys.exit(1)
+from filter_dataset import Label_Filter, filter_dataset
 
-    data_dir = sys.argv[1]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep only the ball and robot labels of the Dataset_maker_faire.')
+    parser.add_argument('data_dir', metavar='DATASET_MAKER_FAIRE_PATH',
+                        help="the dataset folder, the result is written to data_cleaned next to it")
+    data_dir = parser.parse_args().data_dir
     data_cleaned_dir = join(data_dir.rsplit('/', 1)[0], 'data_cleaned')
 
-    # Make sure the new data_cleaned sibling directory exists.
-    Path(data_cleaned_dir).mkdir(parents=True, exist_ok=True)
-    Path(join(data_cleaned_dir, 'images')).mkdir(parents=True, exist_ok=True)
-    Path(join(data_cleaned_dir, 'labels')).mkdir(parents=True, exist_ok=True)
-
-    # Loop over all image files in the specified data_dir.
-    files = [f for f in listdir(data_dir) if f.endswith(('.jpg', 'png', '.jpeg'))]
-    for img_filename in files:
-        # Open the corresponding .txt file
-        try:
-            txt_filename = f'{img_filename.rsplit(".", 1)[0]}.txt'
-            lines = open(join(data_dir, txt_filename)).readlines()
-        except FileNotFoundError:
-            continue
-
-        filtered_lines_indices = []
-
-        # Remove rows that are not class index 0 (ball) or robot (1)
-        for index, line in enumerate(lines):
-            class_index = int(line.split(' ')[0])
-            if class_index in [0, 1]:
-                filtered_lines_indices.append(index)
-
-        # If we have some remaining lines left, then they are index 0 or 1,
-        # and thus we can keep this file by copying it over to the data_cleaned.
-        if len(filtered_lines_indices) > 0:
-            copyfile(join(data_dir, img_filename), join(data_cleaned_dir, 'images', img_filename))
-
-            # Rather than copying the old .txt file, we create a new one only
-            # containing class 0 or 1 or both.
-            with open(join(data_cleaned_dir, 'labels', txt_filename), 'w') as f:
-                for index in filtered_lines_indices:
-                    f.write(f'{lines[index]}')
-                f.write('\n')
-                f.close()
+    # Only keep the rows of class index 0 (ball) or robot (1), images without
+    # any of those are left out. See filter_dataset.py for other filters.
+    processed, kept = filter_dataset(data_dir, data_cleaned_dir, Label_Filter(keep=[0, 1]))
+    print(f'Processed {processed} new or changed images, {kept} images kept in {data_cleaned_dir}.')
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+Compiles the YOLO label files of a dataset into one packed label store and
+queries it.
+
+The store is a directory next to the labels folder (labels.store/ by default)
+containing a flat float32 array with all (x, y, w, h) boxes, an int32 array
+with their class ids and an int64 offset array marking where the boxes of each
+label file start. The arrays are memory-mapped, so reading the store does not
+copy anything. An index.json records the labels folder and the size and mtime of
+every label file, rebuilding the store only re-parses the label files that changed.
+LABELS_DIR is a labels folder, or a flat dataset folder with the label files
+next to the images, like 'Dataset_maker_faire'. filter_dataset.py --label-store
+runs its class and box checks on the store.
+
+Usage: label_store.py build LABELS_DIR [--store ./path] [--workers int]
+       label_store.py stats LABELS_DIR [--store ./path] [--train-config config/train_*.yaml]
+"""
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from yolo_labels import read_labels
+
+STORE_VERSION = 2
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def default_store_path(labels_dir):
+    return f"{str(labels_dir).rstrip(os.sep)}.store"
+
+
+def label_key(path):
+    """
+    Converts an image or label path to the key of its labels in the store.
+
+    The key is the path relative to the last 'images' or 'labels' folder, without extension,
+    so 'data/images/a/b.jpg' and 'data/labels/a/b.txt' both map to 'a/b'. Label_Store.key also
+    handles paths in flat datasets, relative to the labels folder of the store.
+    """
+    parts = Path(path).with_suffix('').parts
+    for index in range(len(parts) - 1, -1, -1):
+        if parts[index] in ('images', 'labels'):
+            return '/'.join(parts[index + 1:])
+    return '/'.join(parts)
+
+
+def _scan_labels(labels_dir):
+    # maps every label key to the (size, mtime) of its label file
+    files = {}
+    for root, _, names in os.walk(labels_dir):
+        # next to images, like in flat datasets, only the .txt files of an image are label files, not train.txt
+        images = {os.path.splitext(name)[0] for name in names if name.lower().endswith(IMAGE_EXTENSIONS)}
+        for name in names:
+            if name.endswith('.txt') and (not images or name[:-4] in images):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                key = Path(os.path.relpath(path, labels_dir)).with_suffix('').as_posix()
+                files[key] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _read_label_file(path):
+    ids, boxes = read_labels(path)
+    return ids.astype(np.int32), boxes.astype(np.float32)
+
+
+def build_store(labels_dir, store_path=None, workers=1):
+    """
+    Builds or incrementally updates the label store of a labels folder.
+
+    Label files whose size and mtime match the existing store are copied from it,
+    all other label files are parsed again.
+
+    Returns the number of label files that have been (re)parsed.
+    """
+    store_path = store_path or default_store_path(labels_dir)
+    files = _scan_labels(labels_dir)
+    keys = sorted(files)
+
+    root = os.path.abspath(labels_dir)
+    old = None
+    if os.path.exists(os.path.join(store_path, 'index.json')):
+        try:
+            old = Label_Store(store_path)
+        except ValueError:
+            # a store of an older version is rebuilt from scratch
+            pass
+    if old is not None and old.files == files and old.root == root:
+        return 0
+
+    stale = [key for key in keys if old is None or old.files.get(key) != files[key]]
+    paths = [os.path.join(labels_dir, key + '.txt') for key in stale]
+    if workers > 1 and len(paths) > 1:
+        with Pool(workers) as pool:
+            parsed = dict(zip(stale, pool.map(_read_label_file, paths, chunksize=max(1, len(paths) // (workers * 16)))))
+    else:
+        parsed = dict(zip(stale, map(_read_label_file, paths)))
+
+    classes, boxes = [], []
+    for key in keys:
+        if key in parsed:
+            ids, bboxes = parsed[key]
+        else:
+            ids, bboxes = old.labels(key)
+        classes.append(ids)
+        boxes.append(bboxes)
+
+    counts = np.array([len(ids) for ids in classes], dtype=np.int64)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    arrays = {
+        'classes': np.concatenate(classes) if classes else np.empty(0, dtype=np.int32),
+        'boxes': np.concatenate(boxes) if boxes else np.empty((0, 4), dtype=np.float32),
+        'offsets': offsets,
+    }
+
+    # the labels copied from the old store are views of its memory maps, dropping them and the store
+    # closes the maps before the files are replaced
+    del classes, boxes, old
+
+    # writing to temporary files first, the index is replaced last so readers never see a half-written store
+    os.makedirs(store_path, exist_ok=True)
+    for name, array in arrays.items():
+        tmp_path = os.path.join(store_path, f'{name}.tmp.npy')
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(store_path, f'{name}.npy'))
+
+    tmp_path = os.path.join(store_path, 'index.json.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump({'version': STORE_VERSION, 'root': root, 'keys': keys, 'files': files}, file)
+    os.replace(tmp_path, os.path.join(store_path, 'index.json'))
+
+    return len(stale)
+
+
+class Label_Store:
+    """
+    A class used for querying a packed, memory-mapped label store.
+
+    ...
+
+    Attributes
+    ----------
+    root : str
+        absolute path to the labels folder the store was built from
+    keys : list[str]
+        the label keys (see `label_key`) of all label files, sorted
+    classes : np.ndarray
+        int32 array with the class id of every box in the dataset
+    boxes : np.ndarray
+        float32 array of shape (N, 4) with every box in the dataset in YOLOv8 format
+    offsets : np.ndarray
+        int64 array, the boxes of label file i are boxes[offsets[i]:offsets[i + 1]]
+    files : dict[str, list[int]]
+        the size and mtime of every label file when the store was built
+
+    Methods
+    -------
+    key(self, path):
+        Returns the label key of an image or label path.
+    labels(self, path):
+        Returns the class ids and boxes of an image or label file.
+    image_indices(self):
+        Returns the index of the label file of every box.
+    images_with_class(self, class_id):
+        Returns the keys of all label files containing the class.
+    class_statistics(self):
+        Computes per-class image counts, instance counts and box sizes.
+    """
+
+    def __init__(self, store_path):
+        """
+        Parameters
+        ----------
+        store_path : Path
+            path to the store directory created by `build_store`
+        """
+        with open(os.path.join(store_path, 'index.json')) as file:
+            index = json.load(file)
+        if index.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported label store version in {store_path}, rebuild the store")
+
+        self.root = index['root']
+        self.keys = index['keys']
+        self.files = index['files']
+        self._positions = {key: position for position, key in enumerate(self.keys)}
+
+        self.classes = np.load(os.path.join(store_path, 'classes.npy'), mmap_mode='r')
+        self.boxes = np.load(os.path.join(store_path, 'boxes.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(store_path, 'offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, path):
+        return self.key(path) in self._positions
+
+    def key(self, path):
+        """
+        Returns the label key of an image or label path, or of a key.
+
+        Paths inside the labels folder of the store, like the images of a flat dataset, are keyed
+        relative to it, all others like `label_key` does. Anything without an image or label
+        extension already is a key, and is never resolved against the working directory.
+        """
+        if not str(path).lower().endswith(('.txt',) + IMAGE_EXTENSIONS):
+            return Path(path).as_posix()
+        absolute = os.path.abspath(path)
+        if os.path.commonpath([absolute, self.root]) == self.root:
+            return Path(os.path.relpath(absolute, self.root)).with_suffix('').as_posix()
+        return label_key(path)
+
+    def labels(self, path):
+        """
+        Returns the class ids and boxes of an image or label file, as read-only views into the store.
+
+        Parameters
+        ----------
+        path : Union[Path, str]
+            Path to the image or label file, or its label key.
+        """
+        position = self._positions[self.key(path)]
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.classes[start:end], self.boxes[start:end]
+
+    def image_indices(self):
+        """
+        Returns the index (into `keys`) of the label file of every box.
+        """
+        return np.repeat(np.arange(len(self.keys)), np.diff(self.offsets))
+
+    def images_with_class(self, class_id):
+        """
+        Returns the keys of all label files containing at least one box of the class.
+        """
+        return [self.keys[index] for index in np.unique(self.image_indices()[self.classes == class_id])]
+
+    def class_statistics(self):
+        """
+        Computes per-class statistics in a single vectorized pass.
+
+        Returns a dict mapping every class id to its number of images, number of instances
+        and the mean, min and max normalized box width and height.
+        """
+        classes = np.asarray(self.classes)
+        boxes = np.asarray(self.boxes)
+        total = int(classes.max()) + 1 if len(classes) else 0
+
+        instances = np.bincount(classes, minlength=total)
+        pairs = np.unique(self.image_indices().astype(np.int64) * total + classes)
+        images = np.bincount(pairs % total, minlength=total) if total else instances
+
+        statistics = {}
+        for class_id in np.flatnonzero(instances):
+            sizes = boxes[classes == class_id, 2:]
+            statistics[int(class_id)] = {
+                'images': int(images[class_id]),
+                'instances': int(instances[class_id]),
+                'mean_size': sizes.mean(axis=0).tolist(),
+                'min_size': sizes.min(axis=0).tolist(),
+                'max_size': sizes.max(axis=0).tolist(),
+            }
+        return statistics
+
+
+def print_statistics(store, names=None):
+    names = names or {}
+    statistics = store.class_statistics()
+
+    print(f"{'Class':>12} {'Images':>8} {'Instances':>10} {'Mean w':>8} {'Mean h':>8} {'Min w':>8} {'Min h':>8}")
+    print(f"{'all':>12} {len(store):>8} {len(store.classes):>10}")
+    for class_id, row in statistics.items():
+        print(f"{names.get(class_id, class_id):>12} {row['images']:>8} {row['instances']:>10} "
+              f"{row['mean_size'][0]:>8.4f} {row['mean_size'][1]:>8.4f} "
+              f"{row['min_size'][0]:>8.4f} {row['min_size'][1]:>8.4f}")
+
+
+def main(args):
+    store_path = args.store or default_store_path(args.labels_dir)
+
+    parsed = build_store(args.labels_dir, store_path, workers=args.workers)
+    if args.command == 'build':
+        print(f"Parsed {parsed} label files, store saved to {store_path}")
+        return
+
+    names = None
+    if args.train_config:
+        import yaml
+        with open(args.train_config) as file:
+            names = yaml.safe_load(file).get('names')
+
+    print_statistics(Label_Store(store_path), names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build', 'stats'],
+                        help="build: (incrementally) compile the label store, stats: print per-class statistics")
+    parser.add_argument('labels_dir', type=Path,
+                        help="the folder containing the YOLO label files, searched recursively")
+    parser.add_argument('--store', type=Path,
+                        help="the store directory (default: LABELS_DIR.store)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used for parsing label files (default: 1)")
+    parser.add_argument('--train-config', type=Path,
+                        help="a train config whose class names are used in the statistics")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.labels_dir):
+        print(f"\nError\n-----\nNo labels folder found at: {args.labels_dir}.\n")
+        exit(1)
+
+    main(args)
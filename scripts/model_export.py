@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""
+Exports trained weights to ONNX, quantizes them to INT8 and reports the
+accuracy, size and CPU latency of every variant.
+
+The INT8 variant is statically quantized with onnxruntime, its activation
+ranges are calibrated on a random sample of the training split of the train
+config. The end of the detection head (DFL, concatenations and sigmoid) is kept
+in float, quantizing it costs a lot of accuracy for very little speed. Every
+variant, including the PyTorch weights, is validated on the val split and timed
+on the CPU at batch 1 and batch N. The report is printed as a table and written
+to export_report.json next to the weights.
+
+Usage: model_export.py WEIGHTS --train-config config/train_*.yaml [--formats onnx,int8] [--imgsz int]
+                       [--batch int] [--calibration-images int] [--accuracy-budget float] [--datasets-dir ./path]
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+try:
+    import cv2
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+from shard_cache import dataset_images
+
+# torch and ultralytics are imported inside the functions which use them, they take seconds to import
+FORMATS = ('onnx', 'int8')
+REPORT_NAME = 'export_report.json'
+
+
+def preprocess(path, imgsz):
+    """
+    Reads an image and letterboxes it into the (1, 3, imgsz, imgsz) float32 RGB input of the model.
+    """
+    from ultralytics.data.augment import LetterBox
+
+    im = LetterBox((imgsz, imgsz), auto=False)(image=cv2.imread(path))
+    return np.ascontiguousarray(im[..., ::-1].transpose(2, 0, 1))[None].astype(np.float32) / 255
+
+
+def export_onnx(weights, imgsz):
+    """
+    Exports the weights to an ONNX model with a dynamic batch size and returns its path.
+    """
+    from ultralytics import YOLO
+
+    return YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=True, verbose=False)
+
+
+def check_formats(formats):
+    """
+    Checks that the formats are known and that their packages are installed, before anything is exported.
+
+    Raises a ValueError for unknown formats and an ImportError for missing packages.
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown export formats {', '.join(sorted(unknown))}, choose from {', '.join(FORMATS)}")
+    if 'int8' in formats:
+        _import_quantization()
+
+
+def _import_quantization():
+    try:
+        import onnx
+        from onnxruntime import quantization
+    except ImportError as e:
+        raise ImportError(f"{e}, INT8 quantization needs the onnx and onnxruntime packages") from e
+    return onnx, quantization
+
+
+def quantize_int8(onnx_path, images, imgsz):
+    """
+    Statically quantizes an ONNX model to INT8, calibrated on the given images, and returns its path.
+    """
+    onnx, quantization = _import_quantization()
+
+    class Calibration_Reader(quantization.CalibrationDataReader):
+        # feeds the calibration images one by one, so only a single image is in memory at a time
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.images = iter(images)
+
+        def get_next(self):
+            path = next(self.images, None)
+            return None if path is None else {self.input_name: preprocess(path, imgsz)}
+
+    base = os.path.splitext(onnx_path)[0]
+    prepared_path, int8_path = f'{base}_prepared.onnx', f'{base}_int8.onnx'
+    # symbolic shape inference fails on the dynamic batch axis, the ONNX shape inference suffices
+    quantization.quant_pre_process(onnx_path, prepared_path, skip_symbolic_shape=True)
+
+    # the head is the module with the highest index, only its box and class convolutions are quantized
+    model = onnx.load(prepared_path)
+    indices = [int(match.group(1)) for node in model.graph.node if (match := re.match(r'/model\.(\d+)/', node.name))]
+    head = f'/model.{max(indices)}/' if indices else None
+    excluded = [node.name for node in model.graph.node
+                if head and node.name.startswith(head) and not re.match(re.escape(head) + r'(one2one_)?cv[23]\b',
+                                                                        node.name)]
+
+    quantization.quantize_static(prepared_path, int8_path, Calibration_Reader(model.graph.input[0].name),
+                                 quant_format=quantization.QuantFormat.QDQ,
+                                 activation_type=quantization.QuantType.QUInt8,
+                                 weight_type=quantization.QuantType.QInt8,
+                                 per_channel=True, nodes_to_exclude=excluded)
+    os.remove(prepared_path)
+    return int8_path
+
+
+def evaluate(path, train_config, imgsz, batch):
+    """
+    Validates a model on the val split of the train config on the CPU and returns its (mAP50, mAP50-95).
+    """
+    from ultralytics import YOLO
+
+    metrics = YOLO(path, task='detect').val(data=train_config, imgsz=imgsz, batch=batch, device='cpu',
+                                            plots=False, verbose=False)
+    return float(metrics.box.map50), float(metrics.box.map)
+
+
+def measure_latency(path, imgsz, batch, repeat=20):
+    """
+    Returns the median CPU latency of a single forward pass at the given batch size in milliseconds.
+    """
+    import torch
+    from ultralytics.nn.autobackend import AutoBackend
+
+    model = AutoBackend(path, device=torch.device('cpu'), verbose=False)
+    im = torch.rand(batch, 3, imgsz, imgsz)
+
+    times = []
+    with torch.inference_mode():
+        for index in range(repeat + 3):
+            start = time.perf_counter()
+            model(im)
+            # the first passes warm up the allocators and kernels
+            if index >= 3:
+                times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def export_report(weights, train_config, formats, imgsz=640, batch=8, calibration_images=64,
+                  accuracy_budget=0.01, datasets_dir=None):
+    """
+    Exports the weights in the given formats, evaluates every variant and returns the report rows.
+
+    The INT8 variant is quantized from the ONNX export, which is therefore always reported along with it.
+    """
+    from ultralytics import settings
+
+    check_formats(formats)
+
+    variants = {'pytorch': str(weights)}
+    onnx_path = export_onnx(weights, imgsz)
+    variants['onnx'] = onnx_path
+    if 'int8' in formats:
+        images = dataset_images(train_config, datasets_dir or settings['datasets_dir'])
+        sample = random.Random(0).sample(images, min(calibration_images, len(images)))
+        print(f"Calibrating the INT8 model on {len(sample)} training images")
+        variants['int8'] = quantize_int8(onnx_path, sample, imgsz)
+
+    rows = []
+    for name, path in variants.items():
+        map50, map50_95 = evaluate(path, train_config, imgsz, batch)
+        rows.append({
+            'model': name,
+            'path': path,
+            'size_mb': os.path.getsize(path) / 1e6,
+            'map50': map50,
+            'map50_95': map50_95,
+            'latency_ms_b1': measure_latency(path, imgsz, 1),
+            f'latency_ms_b{batch}': measure_latency(path, imgsz, batch),
+        })
+
+    report_path = os.path.join(os.path.dirname(str(weights)), REPORT_NAME)
+    with open(report_path, 'w') as file:
+        json.dump({'imgsz': imgsz, 'batch': batch, 'accuracy_budget': accuracy_budget, 'variants': rows},
+                  file, indent=2)
+
+    print_report(rows, batch, accuracy_budget)
+    print(f"Report written to {report_path}")
+    return rows
+
+
+def print_report(rows, batch, accuracy_budget):
+    """
+    Prints the report as a table, followed by the fastest variant within the accuracy budget.
+
+    The budget is the largest allowed mAP50-95 drop relative to the PyTorch weights.
+    """
+    print(f"{'Model':>8} {'Size MB':>8} {'mAP50':>7} {'mAP50-95':>9} {'ms/img b1':>10} {f'ms/img b{batch}':>10}")
+    for row in rows:
+        print(f"{row['model']:>8} {row['size_mb']:>8.1f} {row['map50']:>7.3f} {row['map50_95']:>9.3f} "
+              f"{row['latency_ms_b1']:>10.1f} {row[f'latency_ms_b{batch}'] / batch:>10.1f}")
+
+    reference = rows[0]['map50_95']
+    within = [row for row in rows if reference - row['map50_95'] <= accuracy_budget]
+    fastest = min(within, key=lambda row: row['latency_ms_b1'])
+    print(f"Fastest within a mAP50-95 drop of {accuracy_budget}: {fastest['model']} ({fastest['path']})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', type=Path,
+                        help="the trained weights (.pt) to export")
+    parser.add_argument('--train-config', required=True, type=Path,
+                        help="the YAML training config, its train split is used for calibration, its val split "
+                             "for evaluation")
+    parser.add_argument('--formats', type=lambda formats: formats.split(','), default=list(FORMATS),
+                        help=f"comma separated export formats, from {', '.join(FORMATS)} (default: all)")
+    parser.add_argument('--imgsz', type=int, default=640,
+                        help="the image size to export and evaluate at (default: 640)")
+    parser.add_argument('--batch', type=int, default=8,
+                        help="the batch size N of the second latency measurement and of validation (default: 8)")
+    parser.add_argument('--calibration-images', type=int, default=64,
+                        help="the number of training images used for INT8 calibration (default: 64)")
+    parser.add_argument('--accuracy-budget', type=float, default=0.01,
+                        help="the mAP50-95 drop allowed when picking the fastest variant (default: 0.01)")
+    parser.add_argument('--datasets-dir', type=Path, default=Path(__file__).resolve().parents[1] / 'datasets',
+                        help="the folder relative to which the dataset path of the config is resolved "
+                             "(default: the datasets folder of this repository)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.weights):
+        print(f"\nError\n-----\nWeights not found: {args.weights}.\n")
+        exit(1)
+
+    try:
+        from ultralytics import settings
+    except ImportError as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
+
+    # ultralytics resolves the dataset path of the config the same way train.py configures it
+    settings.update({'datasets_dir': str(args.datasets_dir)})
+
+    try:
+        export_report(args.weights, args.train_config, args.formats, args.imgsz, args.batch,
+                      args.calibration_images, args.accuracy_budget, args.datasets_dir)
+    except (ValueError, ImportError) as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
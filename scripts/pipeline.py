@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+
+"""
+Builds a trainable dataset from raw annotated images with the stages of a
+pipeline YAML, re-running only the stages and files affected by a change.
+
+A pipeline, like config/pipeline_mf.yaml, names a source folder, an output folder
+and its stages, every stage listing the stages it needs:
+
+- convert: converts the XML annotation next to every image of the source to a
+  label file like convert_dataset_annotations.py, without touching the source.
+- filter: filters the labels by class and box size like filter_dataset.py and
+  keeps the images which have labels left.
+- augment: writes an augmented copy of a ratio of the images like data_augmentor.py.
+  The images are chosen by a stable hash, so new images don't change the choice.
+- split: lists the images of the stages it needs in train.txt, val.txt and
+  test.txt in the output folder by a stable hash, like data_splitter.py --method hash.
+  Augmented copies are hashed as their original image, so they end up in its split.
+
+Every stage writes its images and labels to OUTPUT/<stage>/images and
+OUTPUT/<stage>/labels and records the content hashes of the inputs and outputs
+of every file in OUTPUT/.pipeline/<stage>.json. A file is only processed again
+when the hash of its inputs or the settings of its stage changed, and the
+outputs of files which are gone are removed. Source files are only hashed again
+when their size or mtime changed. Stages run as soon as the stages they need are
+done, so independent stages run concurrently, and the files of the stages are
+processed by one pool of --workers processes, which the stages running at the
+same time share.
+
+Usage: pipeline.py PIPELINE [--datasets-dir ./path] [--workers int]
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+try:
+    import yaml
+    from PIL import Image
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+from convert_dataset_annotations import annotation_labels
+from data_augmentor import AUGMENTATIONS, augment_sample, build_augmentations, image_seed
+from data_splitter import IMAGE_EXTENSIONS, SPLIT_NAMES, hash_fraction, write_txt_files
+from filter_dataset import Label_Filter, filter_image, link_file
+from yolo_labels import format_labels, read_labels
+
+# the pools are started from the stage threads, a child forked while another thread holds a lock (of the
+# import system, logging, ...) can deadlock on it, so the worker processes are started clean
+POOL_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                           else 'spawn')
+
+STATE_DIR = '.pipeline'
+STATE_VERSION = 1
+HASHES_NAME = 'hashes.json'
+
+# the settings of every stage type and their defaults, None marks a required setting
+SETTINGS = {
+    'convert': {'link': 'auto'},
+    'filter': {'keep': None, 'drop': [], 'remap': {}, 'min_size': 0., 'link': 'auto'},
+    'augment': {'augments': None, 'ratio': 0.1, 'seed': 0},
+    'split': {'splits': [70, 20, 10]},
+}
+OPTIONAL = {('filter', 'keep')}
+
+
+def load_pipeline(path, datasets_dir):
+    """
+    Reads a pipeline YAML and returns its source and output folders and its stages, ordered so that
+    every stage comes after the stages it needs.
+
+    The source and output are resolved relative to the datasets folder, like the path of a train config.
+    """
+    with open(path) as file:
+        pipeline = yaml.safe_load(file) or {}
+    for key in ('source', 'output', 'stages'):
+        if not pipeline.get(key):
+            raise ValueError(f"{path} has no {key}")
+
+    stages = {}
+    for name, stage in pipeline['stages'].items():
+        stage = dict(stage or {})
+        stage_type, needs = stage.pop('type', name), stage.pop('needs', [])
+        if stage_type not in SETTINGS:
+            raise ValueError(f"Stage {name} has the unknown type {stage_type}, choose from {', '.join(SETTINGS)}")
+        if (stage_type == 'convert') == bool(needs):
+            raise ValueError(f"Stage {name}: convert stages read the source and need no other stages, "
+                             f"all other stages need at least one")
+        unknown = (set(needs) - set(pipeline['stages'])) or (set(stage) - set(SETTINGS[stage_type]))
+        if unknown:
+            raise ValueError(f"Stage {name} has unknown needs or settings: {', '.join(map(str, sorted(unknown)))}")
+
+        settings = {**SETTINGS[stage_type], **stage}
+        missing = [key for key, value in settings.items() if value is None and (stage_type, key) not in OPTIONAL]
+        if missing:
+            raise ValueError(f"Stage {name} needs the settings {', '.join(missing)}")
+        if stage_type == 'augment' and set(settings['augments']) - set(AUGMENTATIONS):
+            raise ValueError(f"Stage {name} has unknown augmentations, choose from {', '.join(AUGMENTATIONS)}")
+        if stage_type == 'split' and (len(settings['splits']) not in (2, 3) or sum(settings['splits']) != 100):
+            raise ValueError(f"Stage {name} needs 2 or 3 splits which sum up to 100")
+        stages[name] = {'name': name, 'type': stage_type, 'needs': list(needs), 'settings': settings}
+
+    splits = [name for name, stage in stages.items() if stage['type'] == 'split']
+    if len(splits) > 1 or any(set(splits) & set(stage['needs']) for stage in stages.values()):
+        raise ValueError("A pipeline has at most one split stage and no stage needs it, the split files are "
+                         "written to the output folder")
+
+    ordered, done = [], set()
+    while len(ordered) < len(stages):
+        ready = [name for name, stage in stages.items() if name not in done and set(stage['needs']) <= done]
+        if not ready:
+            raise ValueError(f"The stages {', '.join(sorted(set(stages) - done))} need each other")
+        ordered.extend(stages[name] for name in ready)
+        done.update(ready)
+
+    source, output = (os.path.abspath(Path(datasets_dir) / pipeline[key]) for key in ('source', 'output'))
+    return source, output, ordered
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 content hash of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _write_json(path, data):
+    # replacing the file at once, so an interrupted run keeps the previous state
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)
+
+
+class Worker_Pool:
+    """
+    A class used for the process pool shared by all stages, started once a stage first needs it.
+
+    The stages running concurrently map their files onto the same processes, so they never start more than
+    `workers` processes together.
+
+    ...
+
+    Attributes
+    ----------
+    workers : int
+        the number of worker processes
+
+    Methods
+    -------
+    map(self, function, jobs):
+        Applies the function to every job in the worker processes and returns the results in order.
+    close(self):
+        Stops the worker processes, if they were started.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def map(self, function, jobs):
+        with self._lock:
+            if self._pool is None:
+                self._pool = POOL_CONTEXT.Pool(self.workers)
+        return self._pool.map(function, jobs, chunksize=max(1, len(jobs) // (self.workers * 16)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+class File_Hashes:
+    """
+    A class used for the content hashes of the source files, cached by their size and mtime.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        path to the JSON file in which the hashes are kept between runs
+
+    Methods
+    -------
+    digests(self, paths, pool=None):
+        Returns the content hash of every path, only reading new and changed files.
+    save(self):
+        Writes the hashes to the JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._files = {}
+        # convert stages running concurrently share the hashes
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as file:
+                cache = json.load(file)
+            if cache.get('version') == STATE_VERSION:
+                self._files = cache['files']
+
+    def digests(self, paths, pool=None):
+        """
+        Returns a dict with the content hash of every path, only reading the files which are new or whose
+        size or mtime changed.
+        """
+        states = {}
+        for path in paths:
+            stat = os.stat(path)
+            states[path] = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            changed = [path for path, state in states.items() if self._files.get(path, [None])[:2] != state]
+
+        if pool is not None and pool.workers > 1 and len(changed) > 1:
+            digests = pool.map(file_digest, changed)
+        else:
+            digests = [file_digest(path) for path in changed]
+
+        with self._lock:
+            self._files.update((path, [*states[path], digest]) for path, digest in zip(changed, digests))
+            return {path: self._files[path][2] for path in paths}
+
+    def save(self):
+        """
+        Writes the hashes to the JSON file.
+        """
+        with self._lock:
+            _write_json(self.path, {'version': STATE_VERSION, 'files': self._files})
+
+
+def stage_paths(destination, key):
+    """
+    Returns the image and label path of a file in the folder of a stage, the key being its path
+    relative to the source.
+    """
+    return (os.path.join(destination, 'images', key),
+            os.path.join(destination, 'labels', os.path.splitext(key)[0] + '.txt'))
+
+
+def _convert_worker(job):
+    key, image, annotation, destination, method, image_digest = job
+    labels = annotation_labels(annotation)
+    if labels is None or not labels[0]:
+        return key, None
+
+    out_image, out_label = stage_paths(destination, key)
+    os.makedirs(os.path.dirname(out_image), exist_ok=True)
+    os.makedirs(os.path.dirname(out_label), exist_ok=True)
+    link_file(image, out_image, method)
+    text = format_labels(*labels)
+    with open(out_label, 'w') as file:
+        file.write(text)
+    return key, (out_image, out_label, image_digest, text_digest(text))
+
+
+def _filter_worker(job):
+    key, image, label, destination, label_filter, method, image_digest = job
+    _, kept = filter_image((image, label, key, False), label_filter, destination, method)
+    if not kept:
+        return key, None
+
+    out_image, out_label = stage_paths(destination, key)
+    # the image is linked, only the label changes
+    return key, (out_image, out_label, image_digest, file_digest(out_label))
+
+
+# the composed transforms of the augment stages per process, only built once a file has to be augmented
+_transforms = {}
+
+
+def augment_transform(augments):
+    """
+    Returns the composition of the augmentations, built once per process.
+    """
+    from torch import set_num_threads
+    from torchvision.transforms import v2
+
+    if augments not in _transforms:
+        # one thread per process, the parallelism comes from the pool itself
+        set_num_threads(1)
+        available = build_augmentations()
+        _transforms[augments] = v2.Compose([available[name] for name in augments])
+    return _transforms[augments]
+
+
+def _augment_worker(job):
+    from torch import manual_seed
+
+    key, image, label, destination, augments, seed = job
+    transform = augment_transform(augments)
+    img = Image.open(image)
+    img.load()
+    ids, boxes = read_labels(label)
+
+    # the torchvision transforms only draw from the global torch generator, the worker process runs one job
+    # at a time, so seeding it makes it private to the job
+    manual_seed(seed)
+    transformed_image, transformed_boxes = augment_sample(transform, img, boxes)
+
+    out_image, out_label = stage_paths(destination, key)
+    os.makedirs(os.path.dirname(out_image), exist_ok=True)
+    os.makedirs(os.path.dirname(out_label), exist_ok=True)
+    transformed_image.save(out_image)
+    text = format_labels(ids, transformed_boxes)
+    with open(out_label, 'w') as file:
+        file.write(text)
+    return key, (out_image, out_label, file_digest(out_image), text_digest(text))
+
+
+def source_jobs(stage, source, output, hashes, pool):
+    """
+    Returns the jobs of a convert stage: every image of the source with an XML annotation next to it.
+    """
+    images = []
+    for root, folders, files in os.walk(source):
+        # the output may live inside the source
+        folders[:] = sorted(folder for folder in folders if os.path.join(root, folder) != output)
+        images.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(IMAGE_EXTENSIONS)
+                      and os.path.exists(os.path.splitext(os.path.join(root, name))[0] + '.xml'))
+
+    annotations = [os.path.splitext(image)[0] + '.xml' for image in images]
+    digests = hashes.digests(images + annotations, pool)
+    destination = os.path.join(output, stage['name'])
+
+    jobs = {}
+    for image, annotation in zip(images, annotations):
+        key = Path(os.path.relpath(image, source)).as_posix()
+        jobs[key] = ([digests[image], digests[annotation]], key,
+                     (key, image, annotation, destination, stage['settings']['link'], digests[image]))
+    return jobs
+
+
+def item_jobs(stage, output, items):
+    """
+    Returns the jobs of a filter or augment stage, one for every file produced by the stages it needs.
+    """
+    settings = stage['settings']
+    destination = os.path.join(output, stage['name'])
+    if stage['type'] == 'filter':
+        label_filter = Label_Filter(keep=settings['keep'], drop=settings['drop'], remap=settings['remap'],
+                                    min_size=settings['min_size'])
+
+    jobs = {}
+    for key, item in items.items():
+        if stage['type'] == 'filter':
+            job = (key, item['image'], item['label'], destination, label_filter, settings['link'],
+                   item['digests'][0])
+        else:
+            # a stable choice of images, which adding or removing other images doesn't change
+            choice = hashlib.sha1(f"{settings['seed']}:{key}".encode()).digest()
+            if int.from_bytes(choice[:8], 'little') / 2 ** 64 >= settings['ratio']:
+                continue
+            job = (key, item['image'], item['label'], destination, tuple(sorted(set(settings['augments']))),
+                   image_seed(settings['seed'], key))
+        jobs[key] = (item['digests'], item['origin'], job)
+    return jobs
+
+
+def read_state(output, stage):
+    """
+    Returns the recorded files of a stage and whether they were recorded with its current settings.
+    """
+    path = os.path.join(output, STATE_DIR, stage['name'] + '.json')
+    if not os.path.exists(path):
+        return {}, False
+    with open(path) as file:
+        state = json.load(file)
+    if state.get('version') != STATE_VERSION:
+        return {}, False
+    # compared after a JSON round trip, which turns tuples into lists and keys into strings
+    settings = json.loads(json.dumps([stage['type'], stage['settings']]))
+    return state['files'], state.get('settings') == settings
+
+
+def write_state(output, stage, files):
+    _write_json(os.path.join(output, STATE_DIR, stage['name'] + '.json'),
+                {'version': STATE_VERSION, 'settings': [stage['type'], stage['settings']], 'files': files})
+
+
+def _remove_outputs(output, record):
+    for path in (record['outputs'] or [])[:2]:
+        if os.path.lexists(os.path.join(output, path)):
+            os.remove(os.path.join(output, path))
+
+
+def run_jobs(stage, output, jobs, pool):
+    """
+    Runs the jobs of a stage whose inputs changed since the last run and returns the files it produced,
+    as a dict mapping every key to its image and label path, their content hashes and its origin.
+
+    Jobs are (input hashes, origin, job) tuples by key, the outputs of keys without a job are removed.
+    """
+    start = time.perf_counter()
+    files, current = read_state(output, stage)
+    if not current:
+        # every file is processed again with the new settings, which may not produce some of the old outputs
+        for record in files.values():
+            _remove_outputs(output, record)
+        files = {}
+    for key in set(files) - set(jobs):
+        _remove_outputs(output, files.pop(key))
+
+    def up_to_date(key, digests):
+        record = files.get(key)
+        return (record is not None and record['inputs'] == digests
+                and all(os.path.exists(os.path.join(output, path)) for path in (record['outputs'] or [])[:2]))
+
+    todo = [job for key, (digests, _, job) in jobs.items() if not up_to_date(key, digests)]
+    worker = {'convert': _convert_worker, 'filter': _filter_worker, 'augment': _augment_worker}[stage['type']]
+    pooled = pool.workers > 1 and len(todo) > 1
+    if stage['type'] == 'augment':
+        # always in worker processes, augment stages running concurrently in the threads of this process would
+        # share its global torch generator
+        pooled = bool(todo)
+    if pooled:
+        results = pool.map(worker, todo)
+    else:
+        results = [worker(job) for job in todo]
+
+    for key, outputs in results:
+        if key in files:
+            _remove_outputs(output, files[key])
+        if outputs is not None:
+            outputs = [Path(os.path.relpath(path, output)).as_posix() for path in outputs[:2]] + list(outputs[2:])
+        files[key] = {'inputs': jobs[key][0], 'origin': jobs[key][1], 'outputs': outputs}
+    write_state(output, stage, files)
+
+    produced = {key: record for key, record in files.items() if record['outputs'] is not None}
+    print(f"{stage['name']}: processed {len(todo)} new or changed of {len(jobs)} files, {len(produced)} files "
+          f"in {os.path.join(output, stage['name'])} ({time.perf_counter() - start:.1f}s)")
+    return {key: {'image': os.path.join(output, record['outputs'][0]),
+                  'label': os.path.join(output, record['outputs'][1]),
+                  'digests': record['outputs'][2:], 'origin': record['origin']} for key, record in produced.items()}
+
+
+def run_split(stage, output, needed):
+    """
+    Writes the split files of the files of the stages a split stage needs, unless they didn't change.
+    """
+    images = {}
+    for items in needed:
+        for item in items.values():
+            images['./' + Path(os.path.relpath(item['image'], output)).as_posix()] = item['origin']
+
+    names = SPLIT_NAMES[:len(stage['settings']['splits'])]
+    files, current = read_state(output, stage)
+    inputs = hashlib.sha1(json.dumps(sorted(images.items())).encode()).hexdigest()
+    if current and files.get('inputs') == inputs and all(os.path.exists(os.path.join(output, name + '.txt')) for name in names):
+        print(f"{stage['name']}: {len(images)} files, up to date")
+        return {}
+
+    # every image is hashed as the image it originates from, so augmented copies follow their original
+    bounds = np.cumsum(np.array(stage['settings']['splits']) / 100)
+    splits = [[] for _ in names]
+    for image, origin in images.items():
+        index = int(np.searchsorted(bounds, hash_fraction(output, './' + origin), side='right'))
+        splits[min(index, len(names) - 1)].append(image)
+
+    for name, split in zip(names, splits):
+        write_txt_files(output, name, split)
+    write_state(output, stage, {'inputs': inputs})
+    print(f"{stage['name']}: " + ', '.join(f"{name}.txt contains {len(split)} files"
+                                             for name, split in zip(names, splits)))
+    return {}
+
+
+def run_stage(stage, source, output, hashes, pool, needed):
+    """
+    Runs a stage once the stages it needs are done and returns the files it produced.
+    """
+    needed = [future.result() for future in needed]
+    if stage['type'] == 'split':
+        return run_split(stage, output, needed)
+    if stage['type'] == 'convert':
+        return run_jobs(stage, output, source_jobs(stage, source, output, hashes, pool), pool)
+
+    items = {}
+    for name, produced in zip(stage['needs'], needed):
+        duplicates = set(items) & set(produced)
+        if duplicates:
+            raise ValueError(f"Stage {stage['name']} receives {sorted(duplicates)[0]} from several stages")
+        items.update(produced)
+    return run_jobs(stage, output, item_jobs(stage, output, items), pool)
+
+
+def run_pipeline(source, output, stages, workers=1):
+    """
+    Runs all stages of a pipeline, every stage as soon as the stages it needs are done.
+    """
+    hashes = File_Hashes(os.path.join(output, STATE_DIR, HASHES_NAME))
+    pool = Worker_Pool(workers)
+    futures = {}
+    try:
+        # a thread per stage, which waits for the stages it needs, the stages are ordered by their needs
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+            for stage in stages:
+                needed = [futures[name] for name in stage['needs']]
+                futures[stage['name']] = executor.submit(run_stage, stage, source, output, hashes, pool, needed)
+        for future in futures.values():
+            future.result()
+    finally:
+        pool.close()
+        hashes.save()
+
+
+def main(args):
+    start = time.perf_counter()
+    run_pipeline(args.source, args.output, args.stages, args.workers)
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s, the dataset is in {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pipeline', type=Path,
+                        help="the pipeline YAML, see config/pipeline_mf.yaml")
+    parser.add_argument('--datasets-dir', type=Path, default=Path(__file__).resolve().parents[1] / 'datasets',
+                        help="the folder relative to which the source and output of the pipeline are resolved "
+                             "(default: the datasets folder of this repository)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="the number of processes used for the files of every stage (default: all cores)")
+    args = parser.parse_args()
+
+    try:
+        args.source, args.output, args.stages = load_pipeline(args.pipeline, args.datasets_dir)
+    except (OSError, ValueError) as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
+    if not os.path.isdir(args.source):
+        print(f"\nError\n-----\nSource folder not found: {args.source}.\n")
+        exit(1)
+
+    try:
+        main(args)
+    except ValueError as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Decodes the training images of a dataset once and stores them, resized to the
+training image size, in memory-mapped shard files.
+
+Every image is resized the same way as the ultralytics training dataloader does
+(longest side to imgsz, linear interpolation) and placed in a fixed imgsz x imgsz
+slot of a uint8 shard, padded with the letterbox colour. An index.json maps every
+image to its shard, slot and shapes, together with the size and mtime of the
+source image. The cache lives in a subfolder keyed by the train config and
+imgsz. Rebuilding it only decodes new or changed images, changed images are
+rewritten in their own slot.
+
+Usage: shard_cache.py --train-config config/train_*.yaml [--imgsz int] [--cache-dir ./path]
+                      [--datasets-dir ./path] [--workers int]
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+try:
+    import cv2
+    import yaml
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+SHARD_SIZE = 512
+PAD_VALUE = 114
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def dataset_images(train_config, datasets_dir, split='train'):
+    """
+    Returns the absolute paths of all images of a split in a train config, resolved the same way as ultralytics.
+
+    The split may be a .txt file listing images, a folder of images, or a list of those.
+    """
+    with open(train_config) as file:
+        data = yaml.safe_load(file)
+
+    root = Path(data.get('path', ''))
+    if not root.is_absolute():
+        root = Path(datasets_dir) / root
+
+    sources = data[split] if isinstance(data[split], list) else [data[split]]
+    images = []
+    for source in sources:
+        source = root / source
+        if source.is_dir():
+            images.extend(str(path) for path in sorted(source.rglob('*')) if path.suffix.lower() in IMAGE_EXTENSIONS)
+        else:
+            with open(source) as file:
+                for line in file:
+                    line = line.strip()
+                    if line:
+                        images.append(str(source.parent / line[2:]) if line.startswith('./') else line)
+
+    return [os.path.abspath(image) for image in images]
+
+
+def letterbox(im, imgsz):
+    """
+    Resizes an image so its longest side equals imgsz and pads it to an imgsz x imgsz slot.
+
+    Returns the slot and the (height, width) of the resized image inside it.
+    """
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        im = cv2.resize(im, (min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)),
+                        interpolation=cv2.INTER_LINEAR)
+
+    h, w = im.shape[:2]
+    slot = np.full((imgsz, imgsz, 3), PAD_VALUE, dtype=np.uint8)
+    slot[:h, :w] = im
+    return slot, (h, w)
+
+
+def _shard_path(cache_dir, shard):
+    return os.path.join(cache_dir, f'shard_{shard:05d}.npy')
+
+
+def _decode_worker(job):
+    # decodes a single image straight into its slot, so no pixels are sent back to the main process
+    cache_dir, imgsz, path, shard, slot = job
+    im = cv2.imread(path)
+    if im is None:
+        return path, None
+
+    h0, w0 = im.shape[:2]
+    data, (h, w) = letterbox(im, imgsz)
+    shards = np.load(_shard_path(cache_dir, shard), mmap_mode='r+')
+    shards[slot] = data
+    shards.flush()
+    return path, [h0, w0, h, w]
+
+
+class Shard_Cache:
+    """
+    A class used for reading pre-decoded, pre-resized images from memory-mapped shards.
+
+    The shards are only opened on first use, so instances can be sent to dataloader workers cheaply.
+
+    ...
+
+    Attributes
+    ----------
+    cache_dir : Path
+        path to the folder containing the shards and index.json
+    imgsz : int
+        the size the images have been resized to
+    images : dict[str, list]
+        maps every absolute image path to [shard, slot, h0, w0, h, w, size, mtime_ns]
+
+    Methods
+    -------
+    build(train_config, imgsz, cache_root, datasets_dir, workers=1):
+        Builds or incrementally updates the cache of a train config and returns it.
+    get(self, path):
+        Returns the resized image and its original (height, width), or None if it isn't cached.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Parameters
+        ----------
+        cache_dir : Path
+            path to the folder containing the shards and index.json
+        """
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'index.json')) as file:
+            index = json.load(file)
+        self.imgsz = index['imgsz']
+        self.images = index['images']
+        self._shards = {}
+
+    def __getstate__(self):
+        # never pickle the memory maps, every process opens its own
+        return {**self.__dict__, '_shards': {}}
+
+    def get(self, path):
+        """
+        Returns a copy of the resized image and its original (height, width), or None if it isn't cached.
+        """
+        record = self.images.get(os.path.abspath(path))
+        if record is None:
+            return None
+
+        shard, slot, h0, w0, h, w = record[:6]
+        if shard not in self._shards:
+            self._shards[shard] = np.load(_shard_path(self.cache_dir, shard), mmap_mode='r')
+        return np.array(self._shards[shard][slot, :h, :w]), (h0, w0)
+
+    @staticmethod
+    def build(train_config, imgsz, cache_root, datasets_dir, workers=1):
+        """
+        Builds or incrementally updates the shard cache of the training images of a train config.
+
+        Only images which are new, or whose size or mtime changed, are decoded. Returns the Shard_Cache.
+        """
+        with open(train_config, 'rb') as file:
+            key = hashlib.sha1(file.read() + f'{imgsz}:{os.path.abspath(datasets_dir)}'.encode()).hexdigest()[:16]
+        cache_dir = os.path.join(cache_root, f'{Path(train_config).stem}_{imgsz}_{key}')
+        index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        index = {'imgsz': imgsz, 'slots': 0, 'free': [], 'images': {}}
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                index = json.load(file)
+        images, free, next_slot = index['images'], index['free'], index['slots']
+
+        states = {}
+        for path in dataset_images(train_config, datasets_dir):
+            stat = os.stat(path)
+            states[path] = [stat.st_size, stat.st_mtime_ns]
+
+        # slots of images which are no longer part of the dataset are reused for new images
+        free.extend(images.pop(path)[:2] for path in set(images) - set(states))
+
+        jobs = []
+        for path, state in states.items():
+            record = images.get(path)
+            if record is not None and record[6:] == state:
+                continue
+            if record is not None:
+                shard, slot = record[:2]
+            elif free:
+                shard, slot = free.pop()
+            else:
+                shard, slot = divmod(next_slot, SHARD_SIZE)
+                next_slot += 1
+            jobs.append((cache_dir, imgsz, path, shard, slot))
+            images[path] = [shard, slot, None, None, None, None, *state]
+
+        # creating the shard files which don't exist yet, every shard holds SHARD_SIZE slots
+        total_shards = math.ceil(next_slot / SHARD_SIZE)
+        for shard in range(total_shards):
+            if not os.path.exists(_shard_path(cache_dir, shard)):
+                np.lib.format.open_memmap(_shard_path(cache_dir, shard), mode='w+', dtype=np.uint8,
+                                          shape=(SHARD_SIZE, imgsz, imgsz, 3))
+
+        if workers > 1 and len(jobs) > 1:
+            with Pool(workers) as pool:
+                results = pool.map(_decode_worker, jobs, chunksize=max(1, len(jobs) // (workers * 16)))
+        else:
+            results = [_decode_worker(job) for job in jobs]
+
+        for path, shapes in results:
+            if shapes is None:
+                # unreadable images are left to the ultralytics dataloader, which reports them
+                free.append(images.pop(path)[:2])
+            else:
+                images[path][2:6] = shapes
+
+        index.update(imgsz=imgsz, slots=next_slot, free=free, images=images)
+        with open(index_path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(index_path + '.tmp', index_path)
+
+        print(f"Decoded {len(jobs)} images into the shard cache at {cache_dir}")
+        return Shard_Cache(cache_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train-config', required=True, type=Path,
+                        help="the YAML training config whose training images are cached")
+    parser.add_argument('--imgsz', type=int, default=640,
+                        help="the image size used for training (default: 640)")
+    parser.add_argument('--cache-dir', type=Path, default='shard_cache',
+                        help="the folder in which the caches are stored (default: ./shard_cache)")
+    parser.add_argument('--datasets-dir', type=Path, default=Path(__file__).resolve().parents[1] / 'datasets',
+                        help="the folder relative to which the dataset path of the config is resolved "
+                             "(default: the datasets folder of this repository)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used for decoding the images (default: 1)")
+    args = parser.parse_args()
+
+    Shard_Cache.build(args.train_config, args.imgsz, args.cache_dir, args.datasets_dir, workers=args.workers)
@@ -0,0 +1,208 @@
+"""
+Records where the time of a training run goes, using ultralytics callbacks.
+
+Per batch the time spent waiting on the dataloader (decoding, augmentation and
+collation in the workers) and the compute time (forward, backward and optimizer
+step) are recorded, together with the RSS of the training process. Per epoch
+the validation time, the RSS of the training process and its dataloader workers
+and the CPU utilization are recorded. At the end of training the records are
+written to profile_metrics.json and a Chrome trace, profile_trace.json, in the
+run folder. The trace can be opened in chrome://tracing or ui.perfetto.dev.
+
+Nothing is registered unless train.py is run with --profile.
+"""
+
+import json
+import os
+import time
+
+try:
+    import psutil
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+METRICS_NAME = 'profile_metrics.json'
+TRACE_NAME = 'profile_trace.json'
+
+# the trace rows, the trace format expects numeric thread ids
+THREADS = {'train': 0, 'epochs': 1}
+
+
+class Training_Profiler:
+    """
+    A class used for timing the phases of a training run through ultralytics callbacks.
+
+    ...
+
+    Attributes
+    ----------
+    batches : list[dict]
+        the dataloader wait, compute time and RSS of every training batch
+    epochs : list[dict]
+        the wall, dataloader wait, compute and validation time, RSS and CPU utilization of every epoch
+    events : list[dict]
+        the Chrome trace events
+
+    Methods
+    -------
+    register(self, model):
+        Adds the callbacks of the profiler to a YOLO model.
+    summary(self):
+        Returns the total time per phase and the peak RSS of the run.
+    save(self, directory):
+        Writes the metrics JSON and the Chrome trace to the directory.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.epochs = []
+        self.events = []
+        self._process = psutil.Process()
+        self._start = time.perf_counter()
+        self._cpu_times = {}
+        self._epoch = None
+        self._mark = None
+        self._wait = None
+        self._val_start = None
+        self._final_val_s = 0.
+
+    def _now(self):
+        return time.perf_counter() - self._start
+
+    def _span(self, name, start, end, tid, **args):
+        # a complete ('X') event, the trace timestamps are in microseconds
+        self.events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                            'pid': self._process.pid, 'tid': THREADS[tid], 'args': args})
+
+    def _counter(self, name, at, **values):
+        self.events.append({'name': name, 'ph': 'C', 'ts': at * 1e6, 'pid': self._process.pid, 'args': values})
+
+    def _processes(self):
+        # the training process and its (dataloader worker) children which are still alive
+        try:
+            return [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return [self._process]
+
+    def _cpu_seconds(self):
+        # CPU seconds used since the previous call, tracked per process since workers come and go
+        used = 0.
+        for process in self._processes():
+            try:
+                times = process.cpu_times()
+            except psutil.Error:
+                continue
+            total = times.user + times.system
+            used += total - self._cpu_times.get(process.pid, 0.)
+            self._cpu_times[process.pid] = total
+        return used
+
+    def _total_rss(self):
+        rss = 0
+        for process in self._processes():
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                continue
+        return rss
+
+    def on_train_start(self, trainer):
+        self._cpu_seconds()
+
+    def on_train_epoch_start(self, trainer):
+        now = self._now()
+        self._epoch = {'epoch': trainer.epoch + 1, 'start': now, 'dataloader_wait_s': 0., 'compute_s': 0.,
+                       'val_s': 0., 'batches': 0}
+        self._mark = now
+
+    def on_train_batch_start(self, trainer):
+        now = self._now()
+        self._wait = now - self._mark
+        self._span('dataloader wait', self._mark, now, 'train')
+        self._epoch['dataloader_wait_s'] += self._wait
+        self._mark = now
+
+    def on_train_batch_end(self, trainer):
+        now = self._now()
+        rss_mb = self._process.memory_info().rss / 1e6
+        self._span('compute', self._mark, now, 'train')
+        self._counter('rss', now, main_mb=rss_mb)
+
+        self._epoch['compute_s'] += now - self._mark
+        self._epoch['batches'] += 1
+        self.batches.append({'epoch': self._epoch['epoch'], 'batch': self._epoch['batches'],
+                             'dataloader_wait_ms': 1000 * self._wait, 'compute_ms': 1000 * (now - self._mark),
+                             'rss_mb': rss_mb})
+        self._mark = now
+
+    def on_val_start(self, validator):
+        self._val_start = self._now()
+
+    def on_val_end(self, validator):
+        now = self._now()
+        self._span('validation', self._val_start, now, 'train')
+        # the final validation of the best weights runs after the last epoch has been recorded
+        if self._epoch is not None and 'end' not in self._epoch:
+            self._epoch['val_s'] += now - self._val_start
+        else:
+            self._final_val_s += now - self._val_start
+
+    def on_fit_epoch_end(self, trainer):
+        # the trainer runs this callback once more after the final validation, which is not an epoch
+        if self._epoch is None or 'end' in self._epoch:
+            return
+
+        now = self._now()
+        epoch = self._epoch
+        epoch['end'] = now
+        epoch['wall_s'] = now - epoch['start']
+        epoch['rss_mb'] = self._total_rss() / 1e6
+        epoch['cpu_percent'] = 100 * self._cpu_seconds() / max(epoch['wall_s'], 1e-9)
+        self.epochs.append(epoch)
+
+        self._span(f"epoch {epoch['epoch']}", epoch['start'], now, 'epochs', batches=epoch['batches'])
+        self._counter('rss', now, total_mb=epoch['rss_mb'])
+        self._counter('cpu', now, percent=epoch['cpu_percent'])
+
+    def on_train_end(self, trainer):
+        self.save(trainer.save_dir)
+
+    def register(self, model):
+        """
+        Adds the callbacks of the profiler to a YOLO model, the trainer and validator copy them from the model.
+        """
+        for event in ('on_train_start', 'on_train_epoch_start', 'on_train_batch_start', 'on_train_batch_end',
+                      'on_val_start', 'on_val_end', 'on_fit_epoch_end', 'on_train_end'):
+            model.add_callback(event, getattr(self, event))
+
+    def summary(self):
+        """
+        Returns the total time per phase and the peak RSS of the run.
+        """
+        totals = {key: sum(epoch[key] for epoch in self.epochs)
+                  for key in ('wall_s', 'dataloader_wait_s', 'compute_s', 'val_s')}
+        totals['other_s'] = totals['wall_s'] - totals['dataloader_wait_s'] - totals['compute_s'] - totals['val_s']
+        totals['final_val_s'] = self._final_val_s
+        totals['peak_rss_mb'] = max((epoch['rss_mb'] for epoch in self.epochs), default=0.)
+        totals['cpu_count'] = os.cpu_count()
+        return totals
+
+    def save(self, directory):
+        """
+        Writes the metrics JSON and the Chrome trace to the directory and prints the summary.
+        """
+        summary = self.summary()
+        with open(os.path.join(directory, METRICS_NAME), 'w') as file:
+            json.dump({'summary': summary, 'epochs': self.epochs, 'batches': self.batches}, file, indent=2)
+
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': self._process.pid, 'tid': tid, 'args': {'name': name}}
+                 for name, tid in THREADS.items()]
+        with open(os.path.join(directory, TRACE_NAME), 'w') as file:
+            json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, file)
+
+        wall = max(summary['wall_s'], 1e-9)
+        print(f"Profile of {len(self.epochs)} epochs ({summary['wall_s']:.1f}s), peak RSS "
+              f"{summary['peak_rss_mb']:.0f} MB, written to {directory}")
+        for key in ('dataloader_wait_s', 'compute_s', 'val_s', 'other_s'):
+            print(f"{key[:-2]:>16}: {summary[key]:8.1f}s {summary[key] / wall:6.1%}")
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Checks a dataset for problems which otherwise only surface during training.
+
+Images are checked for unreadable or corrupt headers, unsupported formats,
+tiny sizes and truncated JPEGs (with --full they are decoded completely).
+Label files are parsed line by line: every line needs a class id and four
+normalized coordinates, the class id has to be in the class map of the train
+config and the box has to lie within the image. Images without a label file
+and label files without an image are reported as orphans, as are images
+listed in the split files of the train config which don't exist.
+
+The results are cached per file by size and mtime in SOURCEPATH/.validation_cache.json,
+so validating a grown dataset only checks the new and changed files. The exit
+code is 1 when errors were found.
+
+Usage: validate_dataset.py SOURCEPATH [--train-config config/train_*.yaml] [--workers int] [--full]
+                           [--report ./path] [--max-listed int]
+"""
+
+import argparse
+import json
+import os
+from collections import Counter
+from multiprocessing import Pool
+from pathlib import Path
+
+try:
+    import yaml
+    from PIL import Image
+except ImportError as e:
+    print(f"\nError\n-----\n{e}.\n")
+    exit(1)
+
+from yolo_labels import label_path
+
+CACHE_NAME = '.validation_cache.json'
+CACHE_VERSION = 1
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+IMAGE_FORMATS = ('PNG', 'JPEG')
+# the split lists written by data_splitter.py, which are not label files
+SPLIT_NAMES = ('train.txt', 'val.txt', 'test.txt')
+MIN_IMAGE_SIZE = 10
+
+
+def scan_dataset(sourcepath, directory=None, images=None, labels=None):
+    """
+    Returns the (size, mtime) of every image and of every label file below the sourcepath,
+    as two dicts keyed by the path relative to the sourcepath.
+
+    Label files are the .txt files in a 'labels' folder, or next to the images in a flat dataset.
+    """
+    images = {} if images is None else images
+    labels = {} if labels is None else labels
+    directory = directory or sourcepath
+
+    texts, has_images = {}, False
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                scan_dataset(sourcepath, entry.path, images, labels)
+                continue
+
+            name = entry.name.lower()
+            if name.endswith(IMAGE_EXTENSIONS) or name.endswith('.txt'):
+                stat = entry.stat()
+                path = Path(os.path.relpath(entry.path, sourcepath)).as_posix()
+                has_images |= name.endswith(IMAGE_EXTENSIONS)
+                (images if name.endswith(IMAGE_EXTENSIONS) else texts)[path] = (stat.st_size, stat.st_mtime_ns)
+
+    for path, state in texts.items():
+        if 'labels' in Path(path).parts[:-1] or (has_images and Path(path).name not in SPLIT_NAMES):
+            labels[path] = state
+    return images, labels
+
+
+def class_names(train_config):
+    """
+    Returns the class map {id: name} of a train config.
+    """
+    with open(train_config) as file:
+        names = yaml.safe_load(file)['names']
+    return dict(enumerate(names)) if isinstance(names, list) else {int(key): value for key, value in names.items()}
+
+
+def check_image(path, full=False):
+    """
+    Returns the list of (severity, kind, detail) problems of an image.
+    """
+    try:
+        with Image.open(path) as img:
+            img.verify()
+            width, height = img.size
+            image_format = img.format
+    except Exception as e:
+        return [('error', 'corrupt image', str(e))]
+
+    issues = []
+    if image_format not in IMAGE_FORMATS:
+        issues.append(('error', 'unsupported image format', image_format))
+    if width < MIN_IMAGE_SIZE or height < MIN_IMAGE_SIZE:
+        issues.append(('error', 'image too small', f'{width}x{height}'))
+
+    if image_format == 'JPEG':
+        # a complete JPEG ends with the end of image marker
+        with open(path, 'rb') as file:
+            file.seek(-2, os.SEEK_END)
+            if file.read() != b'\xff\xd9':
+                issues.append(('error', 'truncated JPEG', 'missing end of image marker'))
+
+    if full and not issues:
+        try:
+            with Image.open(path) as img:
+                img.load()
+        except Exception as e:
+            issues.append(('error', 'corrupt image', str(e)))
+    return issues
+
+
+def check_labels(path, classes=None):
+    """
+    Returns the list of (severity, kind, detail) problems of a label file.
+
+    Parameters
+    ----------
+    path : Path
+        path to the label file
+    classes : collection of int, optional
+        the valid class ids, any non-negative class id is accepted if omitted
+    """
+    try:
+        with open(path) as file:
+            lines = file.read().splitlines()
+    except (OSError, UnicodeDecodeError) as e:
+        return [('error', 'unreadable label file', str(e))]
+
+    issues, seen = [], set()
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != 5:
+            issues.append(('error', 'malformed label line', f'line {number}: expected 5 values, found {len(fields)}'))
+            continue
+        try:
+            values = [float(field) for field in fields]
+        except ValueError:
+            issues.append(('error', 'malformed label line', f'line {number}: "{line.strip()}"'))
+            continue
+
+        class_id, x, y, w, h = values
+        if class_id != int(class_id) or class_id < 0:
+            issues.append(('error', 'invalid class id', f'line {number}: {fields[0]}'))
+        elif classes is not None and int(class_id) not in classes:
+            issues.append(('error', 'unknown class id', f'line {number}: {int(class_id)}'))
+
+        if w <= 0 or h <= 0:
+            issues.append(('error', 'box without area', f'line {number}: {w:g}x{h:g}'))
+        elif min(x - w / 2, y - h / 2) < -1e-6 or max(x + w / 2, y + h / 2) > 1 + 1e-6:
+            issues.append(('error', 'box outside the image', f'line {number}: {x:g} {y:g} {w:g} {h:g}'))
+
+        if tuple(values) in seen:
+            issues.append(('warning', 'duplicate label', f'line {number}'))
+        seen.add(tuple(values))
+
+    if not seen and not issues:
+        issues.append(('warning', 'empty label file', 'no labels'))
+    return issues
+
+
+def _check_worker(job):
+    sourcepath, path, kind, classes, full = job
+    full_path = os.path.join(sourcepath, path)
+    return path, check_image(full_path, full) if kind == 'image' else check_labels(full_path, classes)
+
+
+def validate_dataset(sourcepath, classes=None, workers=1, full=False, cache_path=None):
+    """
+    Validates all images and label files below the sourcepath.
+
+    Only files which are new or whose size or mtime changed since the previous run are checked.
+    Returns a dict mapping the relative path of every file with problems to its list of
+    (severity, kind, detail) problems, and the number of files which were checked.
+    """
+    cache_path = cache_path or os.path.join(sourcepath, CACHE_NAME)
+    signature = {'version': CACHE_VERSION, 'classes': sorted(classes) if classes is not None else None,
+                 'full': full}
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            previous = json.load(file)
+        # the label results depend on the class map, the image results on --full
+        if previous.get('signature') == signature:
+            cache = previous['files']
+
+    images, labels = scan_dataset(sourcepath)
+    files = {**{path: ('image', state) for path, state in images.items()},
+             **{path: ('label', state) for path, state in labels.items()}}
+
+    jobs = [(sourcepath, path, kind, classes, full) for path, (kind, state) in files.items()
+            if cache.get(path, [None])[:2] != list(state)]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            results = list(pool.imap_unordered(_check_worker, jobs, chunksize=max(1, len(jobs) // (workers * 16))))
+    else:
+        results = [_check_worker(job) for job in jobs]
+
+    cache = {path: cache[path] for path in files if path in cache}
+    for path, issues in results:
+        cache[path] = [*files[path][1], [list(issue) for issue in issues]]
+
+    with open(cache_path + '.tmp', 'w') as file:
+        json.dump({'signature': signature, 'files': cache}, file)
+    os.replace(cache_path + '.tmp', cache_path)
+
+    problems = {path: [tuple(issue) for issue in record[2]] for path, record in cache.items() if record[2]}
+
+    # orphans are never cached, they depend on the other files
+    expected_labels = {Path(label_path(path)).as_posix(): path for path in images}
+    for path in images:
+        if Path(label_path(path)).as_posix() not in labels:
+            problems.setdefault(path, []).append(('warning', 'image without a label file', label_path(path)))
+    for path in labels:
+        if path not in expected_labels:
+            problems.setdefault(path, []).append(('warning', 'label file without an image', path))
+
+    return problems, len(jobs)
+
+
+def missing_split_images(train_config, datasets_dir):
+    """
+    Returns the images listed in the splits of a train config which don't exist.
+    """
+    from shard_cache import dataset_images
+
+    with open(train_config) as file:
+        data = yaml.safe_load(file)
+    splits = [split for split in ('train', 'val', 'test') if data.get(split)]
+
+    missing = []
+    for split in splits:
+        try:
+            images = dataset_images(train_config, datasets_dir, split)
+        except FileNotFoundError as e:
+            missing.append(f'{split} split file {e.filename}')
+            continue
+        missing.extend(image for image in images if not os.path.exists(image))
+    return missing
+
+
+def print_problems(problems, max_listed):
+    """
+    Prints the number of problems per kind and lists the files with errors, followed by those with warnings.
+    """
+    kinds = Counter((severity, kind) for issues in problems.values() for severity, kind, _ in issues)
+    for (severity, kind), count in sorted(kinds.items(), key=lambda item: (item[0][0] != 'error', -item[1])):
+        print(f"{count:>8} {severity:<8} {kind}")
+
+    listed = sorted(problems.items(), key=lambda item: (all(issue[0] != 'error' for issue in item[1]), item[0]))
+    for path, issues in listed[:max_listed]:
+        for severity, kind, detail in issues:
+            print(f"{severity:>8}: {path}: {kind} ({detail})")
+    if len(listed) > max_listed:
+        print(f"... and {len(listed) - max_listed} more files, see --report for all of them")
+
+
+def main(args):
+    classes = None
+    if args.train_config:
+        classes = set(class_names(args.train_config))
+
+    problems, checked = validate_dataset(args.sourcepath, classes, workers=args.workers, full=args.full)
+    print(f"Checked {checked} new or changed files")
+
+    if args.train_config:
+        for image in missing_split_images(args.train_config, args.datasets_dir):
+            problems.setdefault(str(args.train_config), []).append(
+                ('error', 'listed image not found', image))
+
+    print_problems(problems, args.max_listed)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump({path: [list(issue) for issue in issues] for path, issues in sorted(problems.items())},
+                      file, indent=2)
+
+    errors = sum(issue[0] == 'error' for issues in problems.values() for issue in issues)
+    warnings = sum(issue[0] == 'warning' for issues in problems.values() for issue in issues)
+    print(f"{errors} errors and {warnings} warnings in {len(problems)} files.")
+    if errors:
+        exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sourcepath', type=Path,
+                        help="the dataset folder, with (nested) images and labels folders or a flat layout")
+    parser.add_argument('--train-config', type=Path,
+                        help="the YAML training config, whose class map the class ids are checked against "
+                             "and whose split files are checked for missing images")
+    parser.add_argument('--datasets-dir', type=Path, default=Path(__file__).resolve().parents[1] / 'datasets',
+                        help="the folder relative to which the dataset path of the config is resolved "
+                             "(default: the datasets folder of this repository)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="the number of processes used for checking files (default: all cores)")
+    parser.add_argument('--full', action='store_true',
+                        help="decode every image completely instead of only checking its header and end")
+    parser.add_argument('--report', type=Path,
+                        help="a JSON file to write all problems to")
+    parser.add_argument('--max-listed', type=int, default=50,
+                        help="the maximum number of files with problems which are printed (default: 50)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sourcepath):
+        print(f"\nError\n-----\nDataset folder not found: {args.sourcepath}.\n")
+        exit(1)
+
+    main(args)
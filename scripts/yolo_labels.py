@@ -0,0 +1,85 @@
+"""
+Helpers for reading, writing and converting YOLOv8 label files in bulk.
+
+Every label file is loaded into NumPy arrays in one go and written back with a
+single buffered write. The box conversions work on arrays of shape (..., 4) and
+broadcast the image sizes, so they convert all boxes of an image, or of a batch
+of same-size images, at once.
+
+See https://docs.ultralytics.com/datasets/detect/#ultralytics-yolo-format for
+more info about the label format.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+LINE_FORMAT = '%d %.8f %.8f %.8f %.8f\n'
+
+
+def label_path(image_path):
+    """
+    Returns the path of the label file of an image, which is the image path with
+    the last 'images' folder replaced by 'labels' and a .txt extension.
+    """
+    parts = list(Path(image_path).with_suffix('.txt').parts)
+    if 'images' in parts:
+        parts[len(parts) - 1 - parts[::-1].index('images')] = 'labels'
+    return str(Path(*parts))
+
+
+def read_labels(label_path):
+    """
+    Reads a YOLOv8 label file.
+
+    Returns the class ids as an int64 array of shape (N,) and the normalized
+    (x, y, w, h) boxes as a float64 array of shape (N, 4). Blank lines are ignored.
+    """
+    with open(label_path) as file:
+        values = np.array(file.read().split(), dtype=np.float64).reshape(-1, 5)
+    return values[:, 0].astype(np.int64), values[:, 1:]
+
+
+def format_labels(ids, boxes):
+    """
+    Formats class ids and normalized (x, y, w, h) boxes as the contents of a YOLOv8 label file.
+    """
+    values = np.empty((len(ids), 5), dtype=object)
+    values[:, 0] = np.asarray(ids, dtype=np.int64)
+    values[:, 1:] = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return (LINE_FORMAT * len(values)) % tuple(values.ravel().tolist())
+
+
+def write_labels(label_path, ids, boxes):
+    """
+    Writes class ids and normalized (x, y, w, h) boxes to a YOLOv8 label file with a single write.
+    """
+    with open(label_path, 'w') as file:
+        file.write(format_labels(ids, boxes))
+
+
+def yolo_to_xyxy(boxes, W, H):
+    """
+    Converts boxes from YOLOv8 format to absolute (x1, y1, x2, y2) coordinates.
+
+    `W` and `H` are scalars or arrays broadcastable against boxes[..., 0],
+    e.g. of shape (B, 1) for boxes of shape (B, N, 4).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    W, H = np.asarray(W, dtype=np.float64), np.asarray(H, dtype=np.float64)
+    x, y, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    return np.stack([(x - w / 2.) * W, (y - h / 2.) * H,
+                     (x + w / 2.) * W, (y + h / 2.) * H], axis=-1)
+
+
+def xyxy_to_yolo(boxes, W, H):
+    """
+    Converts boxes from absolute (x1, y1, x2, y2) coordinates to YOLOv8 format.
+
+    `W` and `H` broadcast the same way as in `yolo_to_xyxy`.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    W, H = np.asarray(W, dtype=np.float64), np.asarray(H, dtype=np.float64)
+    x1, y1, x2, y2 = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    return np.stack([((x1 + x2) / 2.) / W, ((y1 + y2) / 2.) / H,
+                     (x2 - x1) / W, (y2 - y1) / H], axis=-1)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import hashlib
+import subprocess
+import queue
+import time
+import json
+import csv
+import os
+import sys
+import argparse
+
+import yaml
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+
+from shard_cache import dataset_images
+
+# the parameters of a run and the train.py arguments they are passed as
+PARAMETERS = {
+    'yolo_config': '--yolo-config',
+    'train_config': '--train-config',
+    'epochs': '--epochs',
+    'batch': '--batch-size',
+    'imgsz': '--imgsz',
+}
+DEFAULTS = {'epochs': 1, 'batch': 16, 'imgsz': 640}
+RESULT_NAME = 'result.json'
+
+# the thread pools of torch, OpenCV and the BLAS libraries all size themselves from these
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def load_runs(path):
+    """
+    Reads a sweep YAML and returns the list of runs, every run being a dict of PARAMETERS.
+
+    The YAML may contain a `grid` mapping every parameter to a list of values, of which
+    every combination is run, and/or a `runs` list of explicit runs.
+    """
+    with open(path) as file:
+        sweep = yaml.safe_load(file) or {}
+
+    runs = []
+    grid = sweep.get('grid')
+    if grid:
+        keys = list(grid)
+        values = [value if isinstance(value, list) else [value] for value in grid.values()]
+        runs.extend(dict(zip(keys, combination)) for combination in itertools.product(*values))
+    runs.extend(sweep.get('runs') or [])
+
+    for run in runs:
+        unknown = set(run) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown sweep parameters {', '.join(sorted(unknown))}, "
+                             f"choose from {', '.join(PARAMETERS)}")
+        if 'yolo_config' not in run or 'train_config' not in run:
+            raise ValueError(f"Every run needs a yolo_config and a train_config: {run}")
+        for key, value in DEFAULTS.items():
+            run.setdefault(key, value)
+    return runs
+
+def run_name(run):
+    """
+    Returns the folder name of a run, which identifies it across restarts of the sweep.
+
+    The name ends in a hash of the full run, configs with the same file name in different folders
+    would otherwise share a folder.
+    """
+    yolo = os.path.splitext(os.path.basename(run['yolo_config']))[0]
+    train = os.path.splitext(os.path.basename(run['train_config']))[0]
+    digest = hashlib.sha1(json.dumps(run, sort_keys=True, default=str).encode()).hexdigest()[:8]
+    return f"{yolo}-{train}-e{run['epochs']}-b{run['batch']}-i{run['imgsz']}-{digest}"
+
+def partition_cores(parallel, cores_per_run=None):
+    """
+    Splits the CPU cores available to this process into `parallel` disjoint sets.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_run = cores_per_run or max(1, len(cores) // parallel)
+    if cores_per_run * parallel > len(cores):
+        raise ValueError(f"{parallel} runs of {cores_per_run} cores need more than the {len(cores)} available cores")
+    return [cores[i * cores_per_run:(i + 1) * cores_per_run] for i in range(parallel)]
+
+def count_images(run):
+    # the number of training images, used for the throughput of a run
+    try:
+        return len(dataset_images(run['train_config'], os.path.join(ROOT_DIR, 'datasets')))
+    except (OSError, KeyError):
+        return None
+
+def read_metrics(run_dir):
+    """
+    Returns the mAP50 and mAP50-95 of the last epoch and the best mAP50-95 from the results.csv of ultralytics.
+    """
+    try:
+        with open(os.path.join(run_dir, 'results.csv')) as file:
+            rows = [{key.strip(): value for key, value in row.items()} for row in csv.DictReader(file)]
+    except FileNotFoundError:
+        return {}
+    if not rows:
+        return {}
+
+    return {
+        'map50': float(rows[-1]['metrics/mAP50(B)']),
+        'map50_95': float(rows[-1]['metrics/mAP50-95(B)']),
+        'best_map50_95': max(float(row['metrics/mAP50-95(B)']) for row in rows),
+    }
+
+def execute_run(run, run_dir, cores, extra_arguments):
+    """
+    Runs train.py for a single run pinned to the given cores and writes its result.json.
+    """
+    command = [sys.executable, os.path.join(ROOT_DIR, 'train.py'), '--device', 'cpu',
+               '--project', os.path.dirname(run_dir), '--name', os.path.basename(run_dir)]
+    for key, argument in PARAMETERS.items():
+        command += [argument, str(run[key])]
+    command += extra_arguments
+
+    environment = {**os.environ, **{variable: str(len(cores)) for variable in THREAD_VARIABLES}}
+    os.makedirs(run_dir, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, 'sweep.log'), 'w') as log:
+        process = subprocess.Popen(command, env=environment, stdout=log, stderr=subprocess.STDOUT)
+        # pinning from the parent, a preexec_fn is not safe to run in a forked child of a threaded process.
+        # The run is still starting the interpreter, every thread it creates later inherits the affinity
+        try:
+            os.sched_setaffinity(process.pid, cores)
+        except ProcessLookupError:
+            pass
+        process.wait()
+    wall = time.perf_counter() - start
+
+    images = count_images(run)
+    result = {
+        **run,
+        'name': os.path.basename(run_dir),
+        'returncode': process.returncode,
+        'cores': cores,
+        'wall_s': wall,
+        'images_per_s': images * run['epochs'] / wall if images else None,
+        **read_metrics(run_dir),
+    }
+    if process.returncode == 0:
+        with open(os.path.join(run_dir, RESULT_NAME), 'w') as file:
+            json.dump(result, file, indent=2)
+    return result
+
+def run_sweep(runs, output, parallel=1, cores_per_run=None, extra_arguments=()):
+    """
+    Runs all runs, `parallel` at a time on disjoint cores, and returns their results.
+
+    Runs with a result.json in their folder completed earlier and are not run again.
+    """
+    slots = queue.Queue()
+    for cores in partition_cores(parallel, cores_per_run):
+        slots.put(cores)
+
+    def worker(run):
+        run_dir = os.path.join(output, run_name(run))
+        result_path = os.path.join(run_dir, RESULT_NAME)
+        if os.path.exists(result_path):
+            with open(result_path) as file:
+                print(f"Skipping {run_name(run)}, it completed earlier")
+                return json.load(file)
+
+        # a run takes a free set of cores and gives it back when it finishes, the rest waits in the executor
+        cores = slots.get()
+        try:
+            print(f"Starting {run_name(run)} on cores {','.join(map(str, cores))}")
+            result = execute_run(run, run_dir, cores, list(extra_arguments))
+        finally:
+            slots.put(cores)
+        status = 'finished' if result['returncode'] == 0 else f"failed ({result['returncode']}), see sweep.log"
+        print(f"{run_name(run)} {status} in {result['wall_s']:.0f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(worker, runs))
+
+def write_summary(results, output):
+    """
+    Prints the results as a table and writes them to summary.csv in the output folder.
+    """
+    columns = ['name', 'returncode', 'wall_s', 'images_per_s', 'map50', 'map50_95', 'best_map50_95']
+    with open(os.path.join(output, 'summary.csv'), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(PARAMETERS) + columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+    def number(value, width, precision):
+        return f"{value:>{width}.{precision}f}" if value is not None else f"{'-':>{width}}"
+
+    width = max(len(result['name']) for result in results)
+    print(f"{'Run':<{width}} {'Status':>7} {'Wall s':>8} {'img/s':>7} {'mAP50':>7} {'mAP50-95':>9} {'best':>7}")
+    for result in results:
+        status = 'ok' if result['returncode'] == 0 else 'failed'
+        print(f"{result['name']:<{width}} {status:>7} {number(result['wall_s'], 8, 0)} "
+              f"{number(result.get('images_per_s'), 7, 1)} {number(result.get('map50'), 7, 3)} "
+              f"{number(result.get('map50_95'), 9, 3)} {number(result.get('best_map50_95'), 7, 3)}")
+    print(f"Summary written to {os.path.join(output, 'summary.csv')}")
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse command line arguments and return them.
+    """
+    parser = argparse.ArgumentParser(
+        prog = 'DNT sweep.py',
+        description = 'Runs a sweep of train.py runs in parallel, every run pinned to its own CPU cores.',
+        epilog = 'This program is used for the Leren & Beslissen course at the University of Amsterdam. '
+                 'Arguments after -- are passed to every train.py run.')
+
+    parser.add_argument('sweep',
+                        help='YAML file with a grid and/or a list of runs, see config/sweep.yaml')
+
+    parser.add_argument('--output',
+                        default=os.path.join(ROOT_DIR, 'sweeps'),
+                        help='Folder in which every run gets its own folder and the summary is written')
+
+    parser.add_argument('--parallel',
+                        type=int,
+                        default=1,
+                        help='Number of runs executed at the same time')
+
+    parser.add_argument('--cores-per-run',
+                        type=int,
+                        help='Number of CPU cores pinned to every run, by default the cores are divided evenly')
+
+    arguments = sys.argv[1:]
+    extra = arguments[arguments.index('--') + 1:] if '--' in arguments else []
+    args = parser.parse_args(arguments[:arguments.index('--')] if '--' in arguments else arguments)
+    args.extra = extra
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    try:
+        runs = load_runs(args.sweep)
+        if not runs:
+            raise ValueError(f"{args.sweep} contains no runs")
+        partition_cores(args.parallel, args.cores_per_run)
+    except (OSError, ValueError) as e:
+        print(f"\nError\n-----\n{e}.\n")
+        exit(1)
+
+    if '--dataloader-workers' in args.extra:
+        print("Warning: ultralytics loads the data in the training process on CPU, --dataloader-workers has no effect")
+
+    os.makedirs(args.output, exist_ok=True)
+    results = run_sweep(runs, os.path.abspath(args.output), args.parallel, args.cores_per_run, args.extra)
+    write_summary(results, args.output)
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
-from ultralytics import YOLO, settings
 import os
+import sys
+import time
 import argparse
 
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+START_TIME = time.time()
 
 def parse_arguments() -> argparse.Namespace:
     """
@@ -16,12 +18,10 @@ def parse_arguments() -> argparse.Namespace:
         epilog = 'This program is used for the Leren & Beslissen course at the University of Amsterdam.')
 
     parser.add_argument('--yolo-config',
-                        required=True,
-                        help='YAML YOLO config passed to the YOLO class constructor')
+                        help='YAML YOLO config passed to the YOLO class constructor, required unless resuming')
 
     parser.add_argument('--train-config',
-                        required=True,
-                        help='YAML training config passed to model.train()')
+                        help='YAML training config passed to model.train(), required unless resuming')
 
     parser.add_argument('--epochs',
                         type=int,
@@ -35,15 +35,162 @@ def parse_arguments() -> argparse.Namespace:
                         type=int,
                         help='Specify the batch size during training')
 
-    return parser.parse_args()
+    parser.add_argument('--imgsz',
+                        type=int,
+                        default=640,
+                        help='Image size used for training')
+
+    parser.add_argument('--time-budget',
+                        type=float,
+                        metavar='HOURS',
+                        help='Wall clock time this invocation may take, training stops after the last epoch which '
+                             'fits and can be continued with --resume')
+
+    parser.add_argument('--resume',
+                        nargs='?',
+                        const=True,
+                        metavar='RUN',
+                        help='Continue an interrupted or time budgeted run from its last.pt, given as the run folder '
+                             'or checkpoint, by default the most recent run')
+
+    parser.add_argument('--patience',
+                        type=int,
+                        help='Stop early when the validation fitness (mostly mAP50-95) has not improved for this many '
+                             'epochs')
+
+    parser.add_argument('--project',
+                        help='Folder in which the run folder is created, by default detect/ in this repository')
+
+    parser.add_argument('--name',
+                        help='Name of the run folder, an existing folder with this name is reused')
+
+    parser.add_argument('--dataloader-workers',
+                        type=int,
+                        help='Number of dataloader worker processes, by default chosen by ultralytics. '
+                             'Has no effect on CPU and MPS, where ultralytics loads the data in the training process')
+
+    parser.add_argument('--online-augment',
+                        type=lambda augments: augments.split(','),
+                        help='Comma separated data_augmentor.py augmentations applied on the fly to training images, '
+                             'i.e. colorjitter,random_rotation')
+
+    parser.add_argument('--augment-ratio',
+                        type=float,
+                        default=0.1,
+                        help='Probability with which a training image is augmented by --online-augment')
+
+    parser.add_argument('--cache-shards',
+                        metavar='DIR',
+                        help='Decode and resize the training images once into memory-mapped shards in DIR, '
+                             'reused across runs, and train from those')
+
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of processes used for building the shard cache')
+
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Record the dataloader wait, compute and validation time, RSS and CPU utilization '
+                             'to profile_metrics.json and a Chrome trace, profile_trace.json, in the run folder')
+
+    parser.add_argument('--export',
+                        type=lambda formats: formats.split(','),
+                        help='Comma separated formats the best weights are exported to after training, i.e. onnx,int8, '
+                             'followed by an accuracy and CPU latency report of every variant')
+
+    parser.add_argument('--export-batch',
+                        type=int,
+                        default=8,
+                        help='Batch size N of the batched latency measurement of --export')
+
+    args = parser.parse_args()
+    if not args.resume and (args.yolo_config is None or args.train_config is None):
+        parser.error('--yolo-config and --train-config are required unless resuming')
+    if (args.cache_shards or args.export) and args.train_config is None:
+        parser.error('--cache-shards and --export require --train-config')
+    return args
+
+def resume_checkpoint(resume):
+    """
+    Returns the last.pt to resume from, given a run folder, a checkpoint or True for the most recent run.
+    """
+    if resume is True:
+        from ultralytics.utils.files import get_latest_run
+        return get_latest_run(ROOT_DIR)
+    if os.path.isdir(resume):
+        return os.path.join(resume, 'weights', 'last.pt')
+    return resume
 
 if __name__ == '__main__':
+    args = parse_arguments()
+
+    # ultralytics and torch take seconds to import, --help and argument errors don't wait for them
+    from ultralytics import YOLO, settings
     settings.update({
         'runs_dir': ROOT_DIR,
         'datasets_dir': os.path.join(ROOT_DIR, 'datasets')
     })
 
-    args = parse_arguments()
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+    from dnt_trainer import DNTTrainer
+
+    trainer = None
+    if args.online_augment or args.cache_shards or args.time_budget:
+        trainer = DNTTrainer
+
+    if args.time_budget:
+        DNTTrainer.deadline = START_TIME + args.time_budget * 3600
+
+    if args.online_augment:
+        from data_augmentor import Online_Augmentor
+        DNTTrainer.online_augmentor = Online_Augmentor(args.online_augment, ratio=args.augment_ratio)
+
+    if args.cache_shards:
+        from shard_cache import Shard_Cache
+        DNTTrainer.shard_cache = Shard_Cache.build(args.train_config, args.imgsz, args.cache_shards,
+                                                   settings['datasets_dir'], workers=args.workers)
+
+    if args.export:
+        # checking the formats and their packages before training, not after hours of it
+        from model_export import check_formats, export_report
+        try:
+            check_formats(args.export)
+        except (ValueError, ImportError) as e:
+            print(f"\nError\n-----\n{e}.\n")
+            exit(1)
+
+    if args.resume:
+        checkpoint = resume_checkpoint(args.resume)
+        if not checkpoint or not os.path.isfile(checkpoint):
+            print(f"\nError\n-----\nNo checkpoint to resume from: {checkpoint or args.resume}.\n")
+            exit(1)
+        # the data, epochs and other settings of the run are restored from the checkpoint
+        model = YOLO(checkpoint)
+        if (model.ckpt or {}).get('epoch', -1) < 0:
+            print(f"\nError\n-----\nThe run of {checkpoint} has already finished, there is nothing to resume.\n")
+            exit(1)
+        train_args = {key: value for key, value in {'device': args.device, 'batch': args.batch_size}.items()
+                      if value is not None}
+        train_args['resume'] = True
+    else:
+        model = YOLO(args.yolo_config)
+        train_args = {'data': args.train_config, 'epochs': args.epochs, 'device': args.device,
+                      'batch': args.batch_size, 'imgsz': args.imgsz}
+
+    if args.profile:
+        from training_profiler import Training_Profiler
+        Training_Profiler().register(model)
+
+    # only passing the optional settings which are given, so ultralytics keeps its own defaults
+    options = {'project': args.project, 'name': args.name, 'workers': args.dataloader_workers,
+               'patience': args.patience}
+    options = {key: value for key, value in options.items() if value is not None}
+    if args.name:
+        options['exist_ok'] = True
+
+    results = model.train(trainer=trainer, **train_args, **options)
 
-    model = YOLO(args.yolo_config)
-    results = model.train(data=args.train_config, epochs=args.epochs, device=args.device, batch=args.batch_size)
+    # a run stopped by its time budget is exported once it is resumed and finished
+    if args.export and not getattr(model.trainer, 'budget_stopped', False):
+        export_report(model.trainer.best, args.train_config, args.export, args.imgsz, args.export_batch)